@@ -0,0 +1,168 @@
+from CAN_manager import CanManager
+
+import asyncio
+import logging
+_logger = logging.getLogger("CAN_async_manager")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+
+class AsyncCanManager(CanManager):
+    """
+    asyncio front end of CanManager.
+
+    Frames are read by the running event loop (through the socket file
+    descriptor on SocketCAN), so no receive thread is started and every
+    callback, iterator and waiter runs in the loop. Waiters on a signal
+    share one signal subscription and are only futures, so thousands of
+    them cost one predicate call each per update of that signal.
+    """
+
+    def __init__(self, *args, frame_queue_size=1024, logger=_logger, **kwargs):
+        super(AsyncCanManager, self).__init__(*args, logger=logger, **kwargs)
+        self.__loop = None
+        self.__frame_queue_size = frame_queue_size
+        self.__frame_queues = set()
+        self.__user_on_can_msg_callback = None
+        self.__signal_waiters = dict()  # signal name -> (subscription, {future: predicate})
+
+    async def start(self):
+        self.__loop = asyncio.get_running_loop()
+        super(AsyncCanManager, self).start(loop=self.__loop)
+
+    async def stop(self):
+        super(AsyncCanManager, self).stop()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    """
+    Received frames
+    """
+
+    def set_on_can_msg_callback(self, callback):
+        self.__user_on_can_msg_callback = callback
+        self.__update_frame_callback()
+
+    def __update_frame_callback(self):
+        # Only take every frame while someone actually iterates or listens
+        if self.__frame_queues or self.__user_on_can_msg_callback:
+            super(AsyncCanManager, self).set_on_can_msg_callback(self.__on_frame)
+        else:
+            super(AsyncCanManager, self).set_on_can_msg_callback(None)
+
+    def __on_frame(self, msg):
+        if self.__user_on_can_msg_callback:
+            self.__user_on_can_msg_callback(msg)
+        if not self.__frame_queues:
+            return
+
+        try:
+            data = self.decode_msg(msg)
+        except Exception:
+            data = None  # Not in the DBC or malformed, still hand out the raw frame
+        for queue in self.__frame_queues:
+            if queue.full():
+                queue.get_nowait()  # Slow consumer, drop its oldest frame
+            queue.put_nowait((msg, data))
+
+    async def frames(self):
+        # Yields (can.Message, decoded dict or None) for every received frame
+        queue = asyncio.Queue(maxsize=self.__frame_queue_size)
+        self.__frame_queues.add(queue)
+        self.__update_frame_callback()
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.__frame_queues.discard(queue)
+            self.__update_frame_callback()
+
+    def __aiter__(self):
+        return self.frames()
+
+    """
+    Signal waiters
+    """
+
+    async def wait_for_signal(self, signal_name, predicate=None, timeout=None):
+        # Physical value of the first update satisfying predicate, asyncio.TimeoutError otherwise
+        if predicate is None:
+            predicate = lambda value: True
+
+        store = self.signal_store
+        if store is not None and signal_name in store.signal_ids:
+            value, _, count = store.get(signal_name)
+            if count and predicate(value):
+                return value
+
+        future = self.__loop.create_future()
+        if signal_name not in self.__signal_waiters:
+            subscription = self.subscribe_signal(signal_name, self.__on_signal)
+            self.__signal_waiters[signal_name] = (subscription, dict())
+        self.__signal_waiters[signal_name][1][future] = predicate
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            subscription, waiters = self.__signal_waiters[signal_name]
+            waiters.pop(future, None)
+            if not waiters:
+                del self.__signal_waiters[signal_name]
+                self.unsubscribe(subscription)
+
+    def __on_signal(self, signal_name, value, timestamp):
+        entry = self.__signal_waiters.get(signal_name)
+        if entry is None:
+            return
+        for future, predicate in entry[1].items():
+            if future.done():
+                continue
+            try:
+                if predicate(value):
+                    future.set_result(value)
+            except Exception as e:
+                future.set_exception(e)
+
+    """
+    Transmitted frames
+    """
+
+    async def modify_tx_msg(self, msg_id, can_data, event=False, **signals):
+        return super(AsyncCanManager, self).modify_tx_msg(msg_id, can_data, event=event, **signals)
+
+    async def send_evt_msg(self, msg_id, can_data, **signals):
+        return await self.modify_tx_msg(msg_id, can_data, event=True, **signals)
+
+
+if __name__ == '__main__':
+    import os
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    init_tx_msgs_path = os.path.join(cwd, r'res/init_tx_msgs.json')
+    last_modified_msgs_path = os.path.join(cwd, r'res/last_modified_msgs.json')
+
+    async def main():
+        async with AsyncCanManager(dbc_path=dbc_path,
+                                   init_tx_msgs_json_path=init_tx_msgs_path,
+                                   last_modified_tx_msgs_json_path=last_modified_msgs_path) as can_mgr:
+            await can_mgr.modify_tx_msg(msg_id="0x101", can_data={
+                "GTW_epasTuneRequest": 3, "GTW_epasControlType": 1})
+            try:
+                value = await can_mgr.wait_for_signal('DI_vehicleSpeed', lambda v: v > 10, timeout=5)
+                print(f"DI_vehicleSpeed reached {value}")
+            except asyncio.TimeoutError:
+                print("DI_vehicleSpeed did not exceed 10 within 5 s")
+
+    asyncio.run(main())
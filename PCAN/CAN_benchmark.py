@@ -0,0 +1,336 @@
+from CAN_message import CanMessage
+from CAN_manager import CanManager
+from CAN_decoder import CanDecodeCache
+from CAN_bulk_decoder import CanBulkDecoder
+from CAN_startup_cache import CanStartupCache
+
+import can
+from cantools.database.errors import EncodeError
+import cantools
+import json
+import math
+import numpy as np
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+import logging
+
+"""
+Every result is {"value", "unit", "higher_is_better"} so a run can be
+compared to a stored baseline without knowing the individual benchmarks.
+"""
+
+
+def _result(value, unit, higher_is_better):
+    return {"value": float(value), "unit": unit, "higher_is_better": higher_is_better}
+
+
+def _quiet_logger():
+    logger = logging.getLogger("CAN_benchmark")
+    logger.setLevel(logging.CRITICAL)
+    return logger
+
+
+def _signal_updates(msg):
+    # A valid value for every signal: its current one nudged inside [min, max]
+    updates = []
+    for signal in msg.dbc.get_message_by_frame_id(msg.can_id).signals:
+        if signal.is_multiplexer or signal.multiplexer_ids is not None or signal.choices:
+            continue
+        value = msg.can_data[signal.name]
+        step = signal.scale
+        if signal.maximum is not None and value + step > signal.maximum:
+            step = -step
+        if signal.minimum is not None and value + step < signal.minimum:
+            continue  # No second valid value, e.g. an empty DBC [min, max]
+        updates.append((signal.name, value, value + step))
+    return updates
+
+
+def _init_can_data(msg_dbc):
+    # Every signal at raw 0, moved onto the nearest raw value inside its DBC [min, max]
+    can_data = dict()
+    for signal in msg_dbc.signals:
+        if signal.is_signed:
+            raw_min, raw_max = -(1 << (signal.length - 1)), (1 << (signal.length - 1)) - 1
+        else:
+            raw_min, raw_max = 0, (1 << signal.length) - 1
+        raw = 0
+        if signal.is_multiplexer:
+            # The first page that carries signals
+            pages = sorted(page for other in msg_dbc.signals
+                           if other.multiplexer_signal == signal.name for page in other.multiplexer_ids)
+            raw = pages[0] if pages else 0
+        elif signal.minimum is not None and signal.maximum is not None and \
+                signal.minimum <= signal.maximum:
+            low, high = sorted(((signal.minimum - signal.offset) / signal.scale,
+                                (signal.maximum - signal.offset) / signal.scale))
+            raw = min(max(0, math.ceil(low)), math.floor(high))
+        raw = min(max(raw, raw_min), raw_max)
+        can_data[signal.name] = raw * signal.scale + signal.offset
+    return can_data
+
+
+class CanBenchmark:
+    """
+    Benchmarks of the encode, decode, RX and TX paths on python-can's
+    in-process virtual interface, so no vcan0 is needed.
+    """
+
+    def __init__(self, dbc_path, init_tx_msgs_json_path, duration=1.0):
+        self.__dbc_path = dbc_path
+        self.__init_tx_msgs_json_path = init_tx_msgs_json_path
+        self.__dbc = cantools.database.load_file(dbc_path)
+        self.__duration = duration
+        self.__logger = _quiet_logger()
+        self.__channel_index = 0
+
+    def run(self, only=None):
+        benchmarks = {"encode": self.bench_encode,
+                      "decode": self.bench_decode,
+                      "rx_latency": self.bench_rx_latency,
+                      "tx_period": self.bench_tx_period,
+                      "startup": self.bench_startup}
+        results = dict()
+        for name, bench in benchmarks.items():
+            if only and name not in only:
+                continue
+            results.update(bench())
+        return {"meta": {"python": platform.python_version(),
+                         "platform": platform.platform(),
+                         "python-can": can.__version__,
+                         "cantools": cantools.__version__,
+                         "duration": self.__duration,
+                         "time": time.time()},
+                "results": results}
+
+    def __channel(self):
+        self.__channel_index += 1
+        return f"bench_{os.getpid()}_{self.__channel_index}"
+
+    def __all_messages(self):
+        # Every DBC message with explicit init data, default values do not encode for some
+        msgs = []
+        for msg_dbc in self.__dbc.messages:
+            can_data = _init_can_data(msg_dbc)
+            try:
+                msg = CanMessage(dbc=self.__dbc, can_id=msg_dbc.frame_id,
+                                 init_can_data=dict(can_data), logger=self.__logger)
+            except EncodeError:
+                # The DBC gives some signals an empty [min, max], raw 0 is still a valid frame
+                msg = CanMessage(dbc=self.__dbc, can_id=msg_dbc.frame_id, init_can_data=can_data,
+                                 logger=self.__logger,
+                                 init_payload=msg_dbc.encode(can_data, strict=False))
+            msgs.append(msg)
+        return msgs
+
+    """
+    Benchmarks
+    """
+
+    def bench_encode(self):
+        # Signal updates per second through CanMessage.modify_signals, per message
+        results = dict()
+        per_msg_duration = self.__duration / 10
+        for msg in self.__all_messages():
+            updates = _signal_updates(msg)
+            if not updates:
+                continue
+            batches = [{name: a for name, a, _ in updates}, {name: b for name, _, b in updates}]
+            count = 0
+            start = time.perf_counter()
+            deadline = start + per_msg_duration
+            while time.perf_counter() < deadline:
+                for _ in range(100):
+                    msg.modify_signals(can_data=batches[count & 1])
+                    count += 1
+            elapsed = time.perf_counter() - start
+            results[f"encode.{msg.msg_name}"] = _result(count * len(updates) / elapsed,
+                                                        "signals/s", True)
+        return results
+
+    def bench_decode(self):
+        rng = np.random.default_rng(0)
+        msg_ids = np.array([msg_dbc.frame_id for msg_dbc in self.__dbc.messages
+                            if not msg_dbc.is_multiplexed()], dtype=np.uint32)
+        n = 20000
+        ids = rng.choice(msg_ids, size=n)
+        payloads = rng.integers(0, 256, size=(n, 8), dtype=np.uint8)
+        frames = [(int(msg_id), bytes(payload)) for msg_id, payload in zip(ids, payloads)]
+
+        uncached = CanDecodeCache(self.__dbc, max_size=0)
+        start = time.perf_counter()
+        for msg_id, data in frames[:5000]:
+            uncached.decode(msg_id, data)
+        uncached_rate = 5000 / (time.perf_counter() - start)
+
+        cached = CanDecodeCache(self.__dbc, max_size=64)
+        repeated = frames[:32] * (n // 32)
+        start = time.perf_counter()
+        for msg_id, data in repeated:
+            cached.decode(msg_id, data)
+        cached_rate = len(repeated) / (time.perf_counter() - start)
+
+        bulk = CanBulkDecoder(self.__dbc)
+        start = time.perf_counter()
+        bulk.decode(np.arange(n) * 0.001, ids, payloads)
+        bulk_rate = n / (time.perf_counter() - start)
+        return {"decode.uncached": _result(uncached_rate, "frames/s", True),
+                "decode.cached": _result(cached_rate, "frames/s", True),
+                "decode.bulk": _result(bulk_rate, "frames/s", True)}
+
+    def bench_rx_latency(self, subscriber_counts=(1, 10, 100)):
+        # Send to last subscriber callback of the frame, measured per frame
+        results = dict()
+        for subscribers in subscriber_counts:
+            channel = self.__channel()
+            can_mgr = self.__manager(channel)
+            latencies = []
+            sent_at = dict()
+            remaining = dict()
+            done = threading.Event()
+            frames = 200
+
+            def on_signal(name, value, timestamp):
+                key = round(value)
+                remaining[key] -= 1
+                if remaining[key] == 0:
+                    latencies.append(time.perf_counter() - sent_at[key])
+                    if len(latencies) == frames:
+                        done.set()
+
+            for i in range(subscribers):
+                can_mgr.subscribe_signal('DAS_steeringAngleRequest', on_signal)
+            can_mgr.start()
+            sender = can.interface.Bus(interface='virtual', channel=channel)
+            msg = CanMessage(dbc=self.__dbc, can_id=0x488, logger=self.__logger)
+            for i in range(frames):
+                value = -1600 + i * 10
+                msg.modify_signals(can_data={'DAS_steeringAngleRequest': value})
+                remaining[value] = subscribers
+                sent_at[value] = time.perf_counter()
+                sender.send(msg.can_msg)
+                time.sleep(0.001)
+            done.wait(5)
+            sender.shutdown()
+            can_mgr.stop()
+            if latencies:
+                results[f"rx_latency.p50.{subscribers}_subscribers"] = _result(
+                    np.percentile(latencies, 50), "s", False)
+                results[f"rx_latency.p99.{subscribers}_subscribers"] = _result(
+                    np.percentile(latencies, 99), "s", False)
+        return results
+
+    def bench_tx_period(self):
+        # Every DBC message cycling at its DBC period through the scheduler
+        channel = self.__channel()
+        can_mgr = self.__manager(channel, tx_scheduler=True)
+        msgs = self.__all_messages()
+        for msg in msgs:
+            if not msg.period:
+                msg.period = 100
+        can_mgr.add_tx_msgs(msgs)
+
+        receiver = can.interface.Bus(interface='virtual', channel=channel)
+        can_mgr.start()
+        arrivals = dict()
+        deadline = time.perf_counter() + max(self.__duration * 2, 1.0)
+        while time.perf_counter() < deadline:
+            rx_msg = receiver.recv(timeout=0.1)
+            if rx_msg is not None:
+                arrivals.setdefault(rx_msg.arbitration_id, []).append(rx_msg.timestamp)
+        can_mgr.stop()
+        receiver.shutdown()
+
+        errors = []
+        cycling = 0
+        for msg in msgs:
+            times = arrivals.get(msg.can_id, [])
+            if len(times) > 2:
+                cycling += 1
+                errors.extend(np.abs(np.diff(times) - msg.period / 1000).tolist())
+        results = {"tx_period.dbc_messages": _result(len(self.__dbc.messages), "messages", True),
+                   "tx_period.messages": _result(len(msgs), "messages", True),
+                   "tx_period.cycling_messages": _result(cycling, "messages", True)}
+        if errors:
+            results["tx_period.mean_error"] = _result(np.mean(errors), "s", False)
+            results["tx_period.p99_error"] = _result(np.percentile(errors, 99), "s", False)
+        return results
+
+    def bench_startup(self):
+        channel = self.__channel()
+        start = time.perf_counter()
+        self.__manager(channel).stop()
+        cold = time.perf_counter() - start
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            CanStartupCache(cache_dir=cache_dir, logger=self.__logger).prewarm(
+                self.__dbc_path, self.__init_tx_msgs_json_path)
+            start = time.perf_counter()
+            self.__manager(self.__channel(), use_startup_cache=True,
+                           startup_cache_dir=cache_dir).stop()
+            warm = time.perf_counter() - start
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        return {"startup.cold": _result(cold, "s", False),
+                "startup.warm_cache": _result(warm, "s", False)}
+
+    def __manager(self, channel, **kwargs):
+        return CanManager(dbc_path=self.__dbc_path,
+                          init_tx_msgs_json_path=self.__init_tx_msgs_json_path,
+                          last_modified_tx_msgs_json_path=os.devnull,
+                          channel=channel, interface='virtual', logger=self.__logger, **kwargs)
+
+
+def compare(results, baseline, threshold=0.1):
+    # Names of results that are worse than the baseline by more than threshold
+    regressions = dict()
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or not base["value"]:
+            continue
+        change = (result["value"] - base["value"]) / abs(base["value"])
+        if not result["higher_is_better"]:
+            change = -change
+        if change < -threshold:
+            regressions[name] = {"baseline": base["value"], "value": result["value"],
+                                 "change": change}
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark encode, decode, RX and TX paths on the virtual interface.")
+    parser.add_argument('--dbc', default=os.path.join('res', 'tesla_can.dbc'))
+    parser.add_argument('--init', default=os.path.join('res', 'init_tx_msgs.json'))
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help="Seconds spent per throughput benchmark")
+    parser.add_argument('--only', nargs='*',
+                        choices=('encode', 'decode', 'rx_latency', 'tx_period', 'startup'))
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    parser.add_argument('--baseline', help="Compare against results of an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative change counted as a regression")
+    args = parser.parse_args()
+
+    results = CanBenchmark(args.dbc, args.init, duration=args.duration).run(only=args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    for name, result in sorted(results["results"].items()):
+        print(f"{name:60s} {result['value']:14.6g} {result['unit']}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), threshold=args.threshold)
+        for name, regression in sorted(regressions.items()):
+            print(f"REGRESSION {name}: {regression['baseline']:.6g} -> {regression['value']:.6g} "
+                  f"({regression['change']:+.1%})")
+        sys.exit(1 if regressions else 0)
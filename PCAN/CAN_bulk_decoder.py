@@ -0,0 +1,113 @@
+from CAN_codec import get_codec, BIG_ENDIAN
+
+import numpy as np
+
+
+class CanBulkDecoder:
+    """
+    Vectorized decoder for batches of recorded frames.
+
+    Frames are grouped by arbitration ID and every signal is extracted with
+    NumPy shifts and masks over the whole group at once. The result maps each
+    message name to per-signal columns (scaling applied) plus a `timestamp`
+    column. Signals of a mux page that is not selected in a row are NaN.
+    """
+
+    def __init__(self, dbc):
+        self.__dbc = dbc
+
+    def decode(self, timestamps, arbitration_ids, payloads):
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        arbitration_ids = np.asarray(arbitration_ids)
+        payloads = np.asarray(payloads, dtype=np.uint8)
+        if payloads.ndim != 2 or payloads.shape[0] != arbitration_ids.shape[0]:
+            raise ValueError(
+                f"[{self.__class__.__name__}] payloads must be an N x 8 uint8 array matching arbitration_ids!")
+
+        decoded = dict()
+        msg_ids, inverse = np.unique(arbitration_ids, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(msg_ids) + 1))
+        for i, msg_id in enumerate(msg_ids):
+            try:
+                msg_dbc = self.__dbc.get_message_by_frame_id(int(msg_id))
+            except KeyError:
+                continue
+            rows = order[bounds[i]:bounds[i + 1]]
+            columns = self.decode_message(msg_dbc, payloads[rows])
+            columns["timestamp"] = timestamps[rows]
+            decoded[msg_dbc.name] = columns
+        return decoded
+
+    def decode_message(self, msg_dbc, payloads):
+        codec = get_codec(msg_dbc)
+        length = codec.length
+        if payloads.shape[1] < length:
+            raise ValueError(
+                f"[{self.__class__.__name__}] {codec.name} needs {length} bytes per payload!")
+
+        big = np.zeros(payloads.shape[0], dtype=np.uint64)
+        little = np.zeros(payloads.shape[0], dtype=np.uint64)
+        for i in range(length):
+            big = (big << np.uint64(8)) | payloads[:, i]
+            little = (little << np.uint64(8)) | payloads[:, length - 1 - i]
+
+        raws = dict()
+        for layout in codec.layouts.values():
+            packed = big if layout.byteorder == BIG_ENDIAN else little
+            raws[layout.name] = self.__extract_raw(layout, packed)
+
+        columns = dict()
+        for layout in codec.layouts.values():
+            raw = raws[layout.name]
+            if layout.is_float or isinstance(layout.scale, float) or isinstance(layout.offset, float):
+                value = raw * layout.scale + layout.offset
+            else:
+                value = raw * int(layout.scale) + int(layout.offset)
+            if layout.multiplexer_ids is not None:
+                active = self.__active_rows(codec, layout, raws)
+                value = np.where(active, value, np.nan)
+            columns[layout.name] = value
+        return columns
+
+    @staticmethod
+    def __extract_raw(layout, packed):
+        raw = (packed >> np.uint64(layout.shift)) & np.uint64(layout.value_mask)
+        if layout.is_float:
+            if layout.length == 32:
+                return raw.astype(np.uint32).view(np.float32).astype(np.float64)
+            return raw.view(np.float64)
+
+        raw = raw.astype(np.int64)
+        if layout.is_signed:
+            sign_bit = np.int64(1) << np.int64(layout.length - 1)
+            raw = np.where(raw & sign_bit, raw - (sign_bit << np.int64(1)), raw)
+        return raw
+
+    def __active_rows(self, codec, layout, raws):
+        if layout.multiplexer_ids is None:
+            return True
+        selector = codec.get_layout(layout.multiplexer_signal)
+        active = np.isin(raws[selector.name], layout.multiplexer_ids)
+        return active & self.__active_rows(codec, selector, raws)
+
+
+if __name__ == '__main__':
+    import cantools
+    import os
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    dbc = cantools.database.load_file(dbc_path)
+
+    rng = np.random.default_rng(0)
+    n = 100000
+    ids = rng.choice([0x488, 0x108, 0x3ee], size=n)
+    payloads = rng.integers(0, 256, size=(n, 8), dtype=np.uint8)
+    timestamps = np.arange(n) * 0.001
+
+    decoder = CanBulkDecoder(dbc)
+    result = decoder.decode(timestamps, ids, payloads)
+    for msg_name in result:
+        print(f"{msg_name}: {len(result[msg_name]['timestamp'])} frames, "
+              f"{len(result[msg_name]) - 1} signals")
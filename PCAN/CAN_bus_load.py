@@ -0,0 +1,169 @@
+import math
+import threading
+
+
+def frame_bits(length, extended=False, stuffing=True):
+    """
+    Bits on the wire of a classic CAN data frame with `length` data bytes,
+    including the 3 bit interframe space. With `stuffing`, the worst case
+    number of stuff bits is added (Davis et al., 2007).
+    """
+    if extended:
+        bits = 67 + 8 * length
+        stuffed = 54 + 8 * length
+    else:
+        bits = 47 + 8 * length
+        stuffed = 34 + 8 * length
+    if stuffing:
+        bits += (stuffed - 1) // 4
+    return bits
+
+
+def _priority_key(msg_id, extended):
+    # Arbitration order: base ID first, a standard frame beats an extended one with the same base
+    if extended:
+        return msg_id >> 18, 1, msg_id & 0x3ffff
+    return msg_id, 0, 0
+
+
+class CanBusLoad:
+    """
+    Bus load model of a periodic TX schedule.
+
+    Utilization uses the worst-case stuffed frame length of every message.
+    Worst-case latencies come from the response time analysis of
+    non-preemptive fixed priority CAN: blocking by the longest lower
+    priority frame plus interference of every higher priority frame.
+    Received frames can be fed to observe() to measure the actual load.
+    """
+
+    def __init__(self, bitrate):
+        self.__bitrate = bitrate
+        self.__bit_time = 1 / bitrate
+        self.__schedule = dict()  # msg_id -> (frame time, period, extended, length)
+        self.__lock = threading.Lock()
+        self.__observed = dict()  # (length, extended) -> frames
+        self.__observe_since = None
+        self.__observe_last = None
+
+    def frame_time(self, length, extended=False):
+        return frame_bits(length, extended) * self.__bit_time
+
+    def add(self, msg_id, length, period, extended=False):
+        if period <= 0:
+            raise ValueError(f"[{self.__class__.__name__}] Period of {hex(msg_id)} must be positive!")
+        self.__schedule[msg_id] = (self.frame_time(length, extended), period, extended, length)
+
+    def remove(self, msg_id):
+        self.__schedule.pop(msg_id, None)
+
+    def projected_utilization(self, msg_id=None, length=0, period=None, extended=False):
+        # Utilization of the schedule, optionally with msg_id added or replaced
+        utilization = sum(frame_time / frame_period for scheduled_id, (frame_time, frame_period, _, _)
+                          in self.__schedule.items() if scheduled_id != msg_id)
+        if msg_id is not None and period:
+            utilization += self.frame_time(length, extended) / period
+        return utilization
+
+    @property
+    def utilization(self):
+        return self.projected_utilization()
+
+    def worst_case_latencies(self):
+        # msg_id -> worst-case response time in seconds, None when it can miss its period
+        entries = sorted(self.__schedule.items(), key=lambda item: _priority_key(item[0], item[1][2]))
+        latencies = dict()
+        for index, (msg_id, (frame_time, period, _, _)) in enumerate(entries):
+            higher = [entry[1] for entry in entries[:index]]
+            blocking = max((entry[1][0] for entry in entries[index + 1:]), default=0.0)
+            latencies[msg_id] = self.__response_time(frame_time, period, higher, blocking)
+        return latencies
+
+    def __response_time(self, frame_time, period, higher, blocking):
+        # Busy period may contain several instances of the message itself
+        busy = blocking + frame_time
+        while True:
+            next_busy = blocking + math.ceil(busy / period) * frame_time + sum(
+                math.ceil(busy / hp_period) * hp_time for hp_time, hp_period, _, _ in higher)
+            if next_busy == busy:
+                break
+            if next_busy > 1000 * period:
+                return None
+            busy = next_busy
+
+        worst = 0.0
+        for instance in range(math.ceil(busy / period)):
+            queuing = blocking + instance * frame_time
+            while True:
+                next_queuing = blocking + instance * frame_time + sum(
+                    (math.floor((queuing + self.__bit_time) / hp_period) + 1) * hp_time
+                    for hp_time, hp_period, _, _ in higher)
+                if next_queuing == queuing:
+                    break
+                if next_queuing + frame_time - instance * period > period:
+                    return None
+                queuing = next_queuing
+            worst = max(worst, queuing + frame_time - instance * period)
+        if worst > period:
+            return None
+        return worst
+
+    """
+    Measured load of received frames
+    """
+
+    def observe(self, msg):
+        key = (len(msg.data), msg.is_extended_id)
+        with self.__lock:
+            self.__observed[key] = self.__observed.get(key, 0) + 1
+            if self.__observe_since is None:
+                self.__observe_since = msg.timestamp
+            self.__observe_last = msg.timestamp
+
+    def measured_utilization(self, reset=True):
+        with self.__lock:
+            observed, since, last = self.__observed, self.__observe_since, self.__observe_last
+            if reset:
+                self.__observed = dict()
+                self.__observe_since = None
+                self.__observe_last = None
+        if since is None or last <= since:
+            return None
+        busy = sum(count * self.frame_time(length, extended)
+                   for (length, extended), count in observed.items())
+        return busy / (last - since)
+
+    def report(self):
+        return {"bitrate": self.__bitrate,
+                "utilization": self.utilization,
+                "worst_case_latencies": {hex(msg_id): latency for msg_id, latency
+                                         in self.worst_case_latencies().items()}}
+
+    @property
+    def bitrate(self):
+        return self.__bitrate
+
+    @property
+    def schedule(self):
+        return {msg_id: (period, extended, length)
+                for msg_id, (_, period, extended, length) in self.__schedule.items()}
+
+
+if __name__ == '__main__':
+    import cantools
+    import os
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    dbc = cantools.database.load_file(dbc_path)
+
+    for bitrate in (500000, 125000):
+        bus_load = CanBusLoad(bitrate)
+        for msg_dbc in dbc.messages:
+            bus_load.add(msg_dbc.frame_id, msg_dbc.length, (msg_dbc.cycle_time or 100) / 1000,
+                         msg_dbc.is_extended_frame)
+        latencies = bus_load.worst_case_latencies()
+        unschedulable = [hex(msg_id) for msg_id, latency in latencies.items() if latency is None]
+        print(f"{bitrate} bit/s: utilization {bus_load.utilization:.1%}, "
+              f"worst latency {max(l for l in latencies.values() if l is not None) * 1000:.2f} ms, "
+              f"unschedulable {unschedulable}")
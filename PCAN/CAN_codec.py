@@ -0,0 +1,271 @@
+from cantools.database.errors import EncodeError
+
+import struct
+
+BIG_ENDIAN = 'big'
+LITTLE_ENDIAN = 'little'
+
+
+class CanSignalLayout:
+    """
+    Precomputed bit layout of one DBC signal inside its message payload.
+
+    The payload is viewed as a single integer (big- or little-endian depending
+    on the signal byte order), so a signal always occupies a contiguous run of
+    bits starting at `shift`.
+    """
+    __slots__ = ('name', 'index', 'byteorder', 'start', 'length', 'shift', 'mask',
+                 'value_mask', 'is_signed', 'is_float', 'float_fmt', 'scale', 'offset',
+                 'minimum', 'maximum', 'to_raw', 'choice_to_number', 'choices', 'tolerance',
+                 'is_multiplexer', 'multiplexer_ids', 'multiplexer_signal', 'signal')
+
+    def __init__(self, signal, index, msg_length):
+        self.signal = signal
+        self.name = signal.name
+        self.index = index
+        self.start = signal.start
+        self.length = signal.length
+        self.value_mask = (1 << signal.length) - 1
+        if signal.byte_order == 'big_endian':
+            self.byteorder = BIG_ENDIAN
+            byte, bit = divmod(signal.start, 8)
+            msb = (msg_length - 1 - byte) * 8 + bit
+            self.shift = msb - signal.length + 1
+        else:
+            self.byteorder = LITTLE_ENDIAN
+            self.shift = signal.start
+        self.mask = self.value_mask << self.shift
+        self.is_signed = signal.is_signed
+        self.is_float = signal.is_float
+        self.float_fmt = {32: '>f', 64: '>d'}.get(signal.length)
+        self.scale = signal.scale
+        self.offset = signal.offset
+        self.minimum = signal.minimum
+        self.maximum = signal.maximum
+        # Reuse the cantools conversion so rounding matches encode() exactly
+        self.to_raw = signal.conversion.numeric_scaled_to_raw
+        self.choices = signal.conversion.choices
+        self.tolerance = abs(signal.scale) * 1e-6
+        self.choice_to_number = signal.conversion.choice_to_number
+        self.is_multiplexer = signal.is_multiplexer
+        self.multiplexer_ids = signal.multiplexer_ids
+        self.multiplexer_signal = signal.multiplexer_signal
+
+    def raw_from_int(self, payload_int):
+        raw = (payload_int >> self.shift) & self.value_mask
+        if self.is_float:
+            return struct.unpack(self.float_fmt, raw.to_bytes(self.length // 8, 'big'))[0]
+        if self.is_signed and raw >> (self.length - 1):
+            raw -= 1 << self.length
+        return raw
+
+    def raw_to_bits(self, raw):
+        if self.is_float:
+            return int.from_bytes(struct.pack(self.float_fmt, raw), 'big')
+
+        if self.is_signed:
+            limit = 1 << (self.length - 1)
+            if raw < -limit or raw >= limit:
+                raise OverflowError(
+                    f"Signed integer value {raw} out of range.")
+        elif raw < 0 or raw > self.value_mask:
+            raise OverflowError(
+                f"Unsigned integer value {raw} out of range.")
+        return raw & self.value_mask
+
+    def physical_to_bits(self, value, scaling=True):
+        if isinstance(value, str):
+            raw = self.choice_to_number(value)
+        elif isinstance(value, (int, float)):
+            if scaling:
+                raw = self.to_raw(value)
+            else:
+                raw = value if self.is_float else round(value)
+        else:
+            # NamedSignalValue
+            raw = value.value
+        return self.raw_to_bits(raw)
+
+    def check_range(self, value):
+        # Same range check as cantools encode(strict=True)
+        if not isinstance(value, (int, float)):
+            return
+        if self.choices and self.to_raw(value) in self.choices:
+            return
+        if self.minimum is not None and value < self.minimum - self.tolerance:
+            raise EncodeError(f'Expected signal "{self.name}" value greater than '
+                              f'or equal to {self.minimum}, but got {value}.')
+        if self.maximum is not None and value > self.maximum + self.tolerance:
+            raise EncodeError(f'Expected signal "{self.name}" value smaller than '
+                              f'or equal to {self.maximum}, but got {value}.')
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name}, {self.byteorder}, shift={self.shift}, length={self.length})"
+
+
+class CanCodec:
+    """
+    Compiled encoder for one DBC message.
+
+    Built once per cantools message (see `get_codec`); updates patch only the
+    bits of the affected signal inside a cached payload `bytearray` and give
+    the same bytes as `cantools` `encode`.
+    """
+
+    def __init__(self, msg_dbc):
+        self.__msg_dbc = msg_dbc
+        self.__frame_id = msg_dbc.frame_id
+        self.__name = msg_dbc.name
+        self.__length = msg_dbc.length
+        self.__extended = msg_dbc.is_extended_frame
+        self.__layouts = dict()
+        for index, signal in enumerate(msg_dbc.signals):
+            self.__layouts[signal.name] = CanSignalLayout(
+                signal, index, self.__length)
+        self.__is_multiplexed = msg_dbc.is_multiplexed()
+
+    def encode(self, can_data, scaling=True, strict=True):
+        payload = bytearray(self.__length)
+        big, little = 0, 0
+        for layout in self.__layouts.values():
+            if self.__is_multiplexed and not self.__is_selected(layout, can_data):
+                continue
+            if strict and scaling:
+                layout.check_range(can_data[layout.name])
+            bits = layout.physical_to_bits(can_data[layout.name], scaling) << layout.shift
+            if layout.byteorder == BIG_ENDIAN:
+                big |= bits
+            else:
+                little |= bits
+        self.__store(payload, big, little)
+        return payload
+
+    def patch(self, payload, signal_name, signal_value, scaling=True, strict=True):
+        layout = self.__layouts[signal_name]
+        if self.__is_multiplexed and not self.is_active(layout, payload):
+            return payload
+        if strict and scaling:
+            layout.check_range(signal_value)
+        bits = layout.physical_to_bits(signal_value, scaling)
+        order = layout.byteorder
+        value = int.from_bytes(payload, order)
+        value = (value & ~layout.mask) | (bits << layout.shift)
+        payload[:] = value.to_bytes(self.__length, order)
+        return payload
+
+    def patch_raw(self, payload, layout, bits):
+        order = layout.byteorder
+        value = int.from_bytes(payload, order)
+        value = (value & ~layout.mask) | ((bits & layout.value_mask) << layout.shift)
+        payload[:] = value.to_bytes(self.__length, order)
+        return payload
+
+    def raw_value(self, payload, signal_name):
+        layout = self.__layouts[signal_name]
+        return layout.raw_from_int(int.from_bytes(payload, layout.byteorder))
+
+    def is_active(self, layout, payload):
+        if layout.multiplexer_ids is None:
+            return True
+        selector = self.__layouts[layout.multiplexer_signal]
+        if not self.is_active(selector, payload):
+            return False
+        return self.raw_value(payload, selector.name) in layout.multiplexer_ids
+
+    def __is_selected(self, layout, can_data):
+        if layout.multiplexer_ids is None:
+            return True
+        selector = self.__layouts[layout.multiplexer_signal]
+        if not self.__is_selected(selector, can_data):
+            return False
+        mux = can_data[selector.name]
+        if isinstance(mux, str):
+            mux = selector.choice_to_number(mux)
+        elif isinstance(mux, (int, float)):
+            mux = selector.to_raw(mux)
+        else:
+            mux = mux.value
+        return mux in layout.multiplexer_ids
+
+    def __store(self, payload, big, little):
+        little = int.from_bytes(little.to_bytes(
+            self.__length, LITTLE_ENDIAN), BIG_ENDIAN)
+        payload[:] = (big | little).to_bytes(self.__length, BIG_ENDIAN)
+
+    def get_layout(self, signal_name):
+        return self.__layouts[signal_name]
+
+    @property
+    def layouts(self):
+        return self.__layouts
+
+    @property
+    def signal_names(self):
+        return list(self.__layouts)
+
+    @property
+    def msg_dbc(self):
+        return self.__msg_dbc
+
+    @property
+    def frame_id(self):
+        return self.__frame_id
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def length(self):
+        return self.__length
+
+    @property
+    def extended(self):
+        return self.__extended
+
+    @property
+    def is_multiplexed(self):
+        return self.__is_multiplexed
+
+
+_CODEC_ATTR = '_pcan_codec'
+
+
+def get_codec(msg_dbc):
+    # One compiled codec per cantools message object, stored on the message
+    # itself so it lives and dies with the loaded DBC
+    codec = getattr(msg_dbc, _CODEC_ATTR, None)
+    if codec is None:
+        codec = CanCodec(msg_dbc)
+        setattr(msg_dbc, _CODEC_ATTR, codec)
+    return codec
+
+
+def register_codec(codec):
+    # Used when codecs are restored from the startup cache instead of compiled
+    setattr(codec.msg_dbc, _CODEC_ATTR, codec)
+
+
+if __name__ == '__main__':
+    import cantools
+    import os
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    dbc = cantools.database.load_file(dbc_path)
+
+    msg_dbc = dbc.get_message_by_name('DAS_steeringControl')
+    codec = get_codec(msg_dbc)
+    can_data = {
+        "DAS_steeringHapticRequest": 1,
+        "DAS_steeringAngleRequest": 777,
+        "DAS_steeringControlType": 1,
+        "DAS_steeringControlCounter": 4,
+        "DAS_steeringControlChecksum": 7
+    }
+    payload = codec.encode(can_data)
+    print(f"codec: {payload.hex()} cantools: {msg_dbc.encode(can_data).hex()}")
+
+    codec.patch(payload, 'DAS_steeringAngleRequest', 774)
+    can_data['DAS_steeringAngleRequest'] = 774
+    print(f"codec: {payload.hex()} cantools: {msg_dbc.encode(can_data).hex()}")
@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+import threading
+
+
+class CanDecodeCache:
+    """
+    Bounded LRU cache of decoded frames keyed on (arbitration_id, payload bytes).
+
+    Periodic traffic mostly repeats identical payloads, so a hit returns the
+    dict decoded earlier without running cantools again. The returned dicts
+    are shared between all consumers and must be treated as read-only.
+    """
+
+    def __init__(self, dbc, max_size=1024):
+        self.__dbc = dbc
+        self.__max_size = max_size
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    def decode(self, msg_id, data):
+        key = (msg_id, bytes(data))
+        with self.__lock:
+            decoded = self.__cache.get(key)
+            if decoded is not None:
+                self.__cache.move_to_end(key)
+                self.__hits += 1
+                return decoded
+            self.__misses += 1
+
+        decoded = self.__dbc.get_message_by_frame_id(msg_id).decode(key[1])
+        if self.__max_size > 0:
+            with self.__lock:
+                self.__cache[key] = decoded
+                if len(self.__cache) > self.__max_size:
+                    self.__cache.popitem(last=False)
+        return decoded
+
+    def decode_msg(self, msg):
+        return self.decode(msg.arbitration_id, msg.data)
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+            self.__hits = 0
+            self.__misses = 0
+
+    def cache_info(self):
+        with self.__lock:
+            return {"hits": self.__hits, "misses": self.__misses,
+                    "max_size": self.__max_size, "size": len(self.__cache)}
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    @property
+    def max_size(self):
+        return self.__max_size
@@ -0,0 +1,120 @@
+import itertools
+
+STANDARD_ID_MASK = 0x7ff
+
+# Above this many candidate implicants the cover is chosen greedily
+_EXACT_COVER_LIMIT = 12
+
+
+def _prime_implicants(msg_ids, width):
+    # Quine-McCluskey over the accepted IDs only: an implicant is
+    # (value, dont_care) and covers every ID equal to value outside dont_care
+    current = {(msg_id, 0) for msg_id in msg_ids}
+    primes = set()
+    while current:
+        merged = set()
+        combined = set()
+        for value, dont_care in current:
+            for bit in range(width):
+                flag = 1 << bit
+                if dont_care & flag or value & flag:
+                    continue
+                partner = (value | flag, dont_care)
+                if partner in current:
+                    combined.add((value, dont_care | flag))
+                    merged.add((value, dont_care))
+                    merged.add(partner)
+        primes |= current - merged
+        current = combined
+    return primes
+
+
+def _covered_ids(implicant, msg_ids):
+    value, dont_care = implicant
+    return frozenset(msg_id for msg_id in msg_ids if msg_id & ~dont_care == value)
+
+
+def _minimum_cover(primes, msg_ids):
+    coverage = {prime: _covered_ids(prime, msg_ids) for prime in primes}
+    uncovered = set(msg_ids)
+    chosen = []
+
+    # Essential primes: the only implicant covering some ID
+    for msg_id in msg_ids:
+        covering = [prime for prime in coverage if msg_id in coverage[prime]]
+        if len(covering) == 1 and covering[0] not in chosen:
+            chosen.append(covering[0])
+            uncovered -= coverage[covering[0]]
+
+    candidates = [prime for prime in coverage
+                  if prime not in chosen and coverage[prime] & uncovered]
+    if not uncovered:
+        return chosen
+
+    if len(candidates) <= _EXACT_COVER_LIMIT:
+        for size in range(1, len(candidates) + 1):
+            for combination in itertools.combinations(candidates, size):
+                if uncovered <= frozenset().union(*(coverage[prime] for prime in combination)):
+                    return chosen + list(combination)
+
+    while uncovered:
+        best = max(candidates, key=lambda prime: len(coverage[prime] & uncovered))
+        chosen.append(best)
+        uncovered -= coverage[best]
+    return chosen
+
+
+def compile_id_masks(msg_ids, width=11):
+    """
+    Smallest set of (can_id, can_mask) pairs accepting exactly `msg_ids`.
+    """
+    msg_ids = sorted(set(msg_ids))
+    if not msg_ids:
+        return []
+    full_mask = (1 << width) - 1
+    cover = _minimum_cover(_prime_implicants(msg_ids, width), msg_ids)
+    return sorted((value, full_mask & ~dont_care) for value, dont_care in cover)
+
+
+def compile_can_filters(msg_ids, extended_msg_ids=None):
+    """
+    python-can filter list for a mix of standard and extended IDs.
+
+    IDs above 0x7FF are always treated as extended; `extended_msg_ids`
+    marks low IDs that are sent as 29-bit frames.
+    """
+    extended_msg_ids = set(extended_msg_ids or ())
+    standard = [msg_id for msg_id in msg_ids
+                if msg_id <= STANDARD_ID_MASK and msg_id not in extended_msg_ids]
+    extended = [msg_id for msg_id in msg_ids
+                if msg_id > STANDARD_ID_MASK or msg_id in extended_msg_ids]
+
+    can_filters = []
+    for can_id, can_mask in compile_id_masks(standard, width=11):
+        can_filters.append({"can_id": can_id, "can_mask": can_mask, "extended": False})
+    for can_id, can_mask in compile_id_masks(extended, width=29):
+        can_filters.append({"can_id": can_id, "can_mask": can_mask, "extended": True})
+    return can_filters
+
+
+def filter_accepts(can_filters, msg_id, extended=False):
+    for can_filter in can_filters:
+        if can_filter["extended"] == extended and \
+                msg_id & can_filter["can_mask"] == can_filter["can_id"] & can_filter["can_mask"]:
+            return True
+    return False
+
+
+if __name__ == '__main__':
+    import cantools
+    import os
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    dbc = cantools.database.load_file(dbc_path)
+
+    for sender in ('DI', 'ESP', 'GTW', 'NEO'):
+        ids = [msg.frame_id for msg in dbc.messages if sender in msg.senders]
+        can_filters = compile_can_filters(ids)
+        print(f"{sender}: {len(ids)} IDs -> {len(can_filters)} filters: "
+              f"{[(hex(f['can_id']), hex(f['can_mask'])) for f in can_filters]}")
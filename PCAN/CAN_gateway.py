@@ -0,0 +1,291 @@
+from CAN_transceiver import CanTransceiver, VCAN, SOCKET_CAN, BAUD_RATE_500K
+from CAN_codec import get_codec, BIG_ENDIAN
+from CAN_frame_rules import load_frame_rules
+from CAN_metrics import CanHistogram, LATENCY_BUCKETS
+
+import can
+import json
+import threading
+import time
+import logging
+_logger = logging.getLogger("CAN_gateway")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+GATEWAY_PASS = 'pass'
+GATEWAY_DROP = 'drop'
+GATEWAY_REMAP = 'remap'
+A_TO_B = 'a_to_b'
+B_TO_A = 'b_to_a'
+
+
+class CanGatewayRule:
+    """
+    What the gateway does with one frame ID: pass it, drop it or send it
+    under another ID, optionally with signals overridden.
+
+    Overrides are compiled into one keep mask and one set of bits over the
+    big-endian integer of the payload, little-endian signals included, so
+    overriding any number of signals costs a single and/or per frame. The
+    checksum rule, if any, is recomputed after the override. A frame whose
+    length differs from the DBC cannot be overridden and is dropped.
+    """
+
+    def __init__(self, action=GATEWAY_PASS, remap_id=None, remap_extended=None,
+                 codec=None, overrides=None, checksum=None):
+        if action not in (GATEWAY_PASS, GATEWAY_DROP, GATEWAY_REMAP):
+            raise ValueError(f"[{self.__class__.__name__}] Unknown gateway action: {action}!")
+        if action == GATEWAY_REMAP and remap_id is None:
+            raise ValueError(f"[{self.__class__.__name__}] Remap rule without a target ID!")
+        self.action = action
+        self.remap_id = remap_id
+        self.remap_extended = remap_extended
+        self.checksum = checksum
+        self.keep_mask = None
+        self.set_bits = 0
+        self.length = 0
+        if overrides:
+            self.__compile_overrides(codec, overrides)
+
+    def __compile_overrides(self, codec, overrides):
+        self.length = length = codec.length
+        full_mask = (1 << (8 * length)) - 1
+        mask = 0
+        for signal_name, value in overrides.items():
+            layout = codec.get_layout(signal_name)
+            if layout.multiplexer_ids is not None:
+                raise ValueError(f"[{self.__class__.__name__}] Multiplexed signal {signal_name} "
+                                 f"cannot be overridden!")
+            layout.check_range(value)
+            signal_mask = layout.mask
+            signal_bits = layout.physical_to_bits(value) << layout.shift
+            if layout.byteorder != BIG_ENDIAN:
+                signal_mask = int.from_bytes(signal_mask.to_bytes(length, 'little'), 'big')
+                signal_bits = int.from_bytes(signal_bits.to_bytes(length, 'little'), 'big')
+            mask |= signal_mask
+            self.set_bits = (self.set_bits & ~signal_mask) | signal_bits
+        self.keep_mask = full_mask & ~mask
+
+
+def load_gateway_rules(dbc, rules_json_path, frame_rules_json_path=None, logger=_logger):
+    """
+    {"a_to_b": {"default": "pass",
+                "0x2b9": {"action": "drop"},
+                "0x101": {"override": {"GTW_epasControlType": "WITH_ANGLE"}},
+                "0x488": {"action": "remap", "id": "0x489"}},
+     "b_to_a": {...}}
+    Returns {direction: (default action, {msg_id: CanGatewayRule})}.
+    """
+    with open(rules_json_path, 'r') as f:
+        rules_dict = json.load(f)
+    frame_rules = dict()
+    if frame_rules_json_path:
+        frame_rules = load_frame_rules(dbc, frame_rules_json_path, logger=logger)
+
+    gateway_rules = dict()
+    for direction in (A_TO_B, B_TO_A):
+        direction_dict = dict(rules_dict.get(direction, dict()))
+        default = direction_dict.pop('default', GATEWAY_PASS)
+        rules = dict()
+        for msg_id_str, rule_dict in direction_dict.items():
+            try:
+                msg_id = int(msg_id_str, 16)
+                overrides = rule_dict.get('override')
+                remap_id = rule_dict.get('id')
+                codec = None
+                checksum = None
+                if overrides:
+                    codec = get_codec(dbc.get_message_by_frame_id(msg_id))
+                    out_id = int(remap_id, 16) if remap_id else msg_id
+                    if out_id in frame_rules:
+                        checksum = frame_rules[out_id].checksum
+                rules[msg_id] = CanGatewayRule(
+                    action=rule_dict.get('action', GATEWAY_PASS),
+                    remap_id=int(remap_id, 16) if remap_id else None,
+                    remap_extended=rule_dict.get('extended'),
+                    codec=codec, overrides=overrides, checksum=checksum)
+            except (KeyError, TypeError, ValueError, OverflowError) as e:
+                logger.error(f"[load_gateway_rules] Invalid {direction} rule for {msg_id_str}: {e}")
+        gateway_rules[direction] = (default, rules)
+    return gateway_rules
+
+
+class _CanGatewayPath:
+    # One direction of the gateway: its rules, counters and forwarding latency
+    def __init__(self, name, default, rules, send, logger):
+        self.name = name
+        self.default = default
+        self.rules = rules
+        self.send = send
+        self.logger = logger
+        self.received = 0
+        self.forwarded = 0
+        self.dropped = 0
+        self.remapped = 0
+        self.overridden = 0
+        self.length_mismatches = 0
+        self.tx_errors = 0
+        self.max_latency = 0.0
+        self.latency = CanHistogram(LATENCY_BUCKETS)
+
+    def on_can_msg(self, msg):
+        self.received += 1
+        rule = self.rules.get(msg.arbitration_id)
+        if rule is None:
+            if self.default == GATEWAY_DROP:
+                self.dropped += 1
+                return
+        else:
+            action = rule.action
+            if action == GATEWAY_DROP:
+                self.dropped += 1
+                return
+            if rule.keep_mask is not None:
+                data = msg.data
+                if len(data) != rule.length:
+                    # Forwarding it unmodified would leak the value the override exists to hide
+                    self.length_mismatches += 1
+                    self.dropped += 1
+                    return
+                value = (int.from_bytes(data, 'big') & rule.keep_mask) | rule.set_bits
+                msg.data = data = bytearray(value.to_bytes(rule.length, 'big'))
+                if rule.checksum is not None:
+                    rule.checksum.apply(data)
+                self.overridden += 1
+            if action == GATEWAY_REMAP:
+                msg.arbitration_id = rule.remap_id
+                if rule.remap_extended is not None:
+                    msg.is_extended_id = rule.remap_extended
+                self.remapped += 1
+
+        try:
+            self.send(msg)
+        except can.CanError as e:
+            self.tx_errors += 1
+            self.logger.warning(f"[CanGateway] {self.name} failed to forward {hex(msg.arbitration_id)}: {e}")
+            return
+        self.forwarded += 1
+        latency = time.time() - msg.timestamp
+        self.latency.observe(latency)
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+    def stats(self, elapsed):
+        latency = self.latency.snapshot()
+        return {"received": self.received,
+                "forwarded": self.forwarded,
+                "dropped": self.dropped,
+                "remapped": self.remapped,
+                "overridden": self.overridden,
+                "length_mismatches": self.length_mismatches,
+                "tx_errors": self.tx_errors,
+                "throughput": self.forwarded / elapsed if elapsed else 0.0,
+                "mean_latency": latency["sum"] / latency["count"] if latency["count"] else 0.0,
+                "max_latency": self.max_latency,
+                "latency": latency}
+
+
+class CanGateway:
+    """
+    Forwards frames between two channels, e.g. a real ECU on can0 and the
+    simulated network on vcan0, through one CanTransceiver per channel.
+
+    Each receive thread applies the rules of its direction to the received
+    frame and sends it straight on the other bus: pass-through frames are
+    never decoded or re-encoded. When a direction drops by default, the
+    kernel filters of its receiving channel only accept the IDs with rules.
+    Latency is measured from the receive timestamp of the frame to the
+    return of send().
+    """
+
+    def __init__(self, channel_a=VCAN, channel_b='vcan1', interface_a=SOCKET_CAN, interface_b=SOCKET_CAN,
+                 bitrate_a=BAUD_RATE_500K, bitrate_b=BAUD_RATE_500K, rules=None, logger=_logger):
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        rules = rules or dict()
+        self.__trx_a = CanTransceiver(channel=channel_a, interface=interface_a, bitrate=bitrate_a,
+                                      logger=logger)
+        self.__trx_b = CanTransceiver(channel=channel_b, interface=interface_b, bitrate=bitrate_b,
+                                      logger=logger)
+        self.__trx_a.daemon = True
+        self.__trx_b.daemon = True
+
+        default, path_rules = rules.get(A_TO_B, (GATEWAY_PASS, dict()))
+        self.__a_to_b = _CanGatewayPath(A_TO_B, default, path_rules, self.__trx_b.send_evt_msg, logger)
+        default, path_rules = rules.get(B_TO_A, (GATEWAY_PASS, dict()))
+        self.__b_to_a = _CanGatewayPath(B_TO_A, default, path_rules, self.__trx_a.send_evt_msg, logger)
+        self.__narrow_filters(self.__trx_a, self.__a_to_b)
+        self.__narrow_filters(self.__trx_b, self.__b_to_a)
+
+        self.__trx_a.set_on_can_msg_callback(self.__a_to_b.on_can_msg)
+        self.__trx_b.set_on_can_msg_callback(self.__b_to_a.on_can_msg)
+        self.__started = None
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __narrow_filters(trx, path):
+        if path.default != GATEWAY_DROP:
+            return
+        msg_ids = [msg_id for msg_id, rule in path.rules.items() if rule.action != GATEWAY_DROP]
+        trx.set_filtered_msg_ids(msg_ids, extended_msg_ids=[msg_id for msg_id in msg_ids
+                                                            if msg_id > 0x7ff])
+
+    def start(self):
+        with self.__lock:
+            self.__started = time.perf_counter()
+            self.__trx_a.start()
+            self.__trx_b.start()
+        self.logger.info(f"[{self.__class_name}] Gateway started")
+
+    def stop(self):
+        with self.__lock:
+            self.__trx_a.stop()
+            self.__trx_b.stop()
+        self.logger.info(f"[{self.__class_name}] Gateway stopped: {self.stats}")
+
+    @property
+    def stats(self):
+        elapsed = time.perf_counter() - self.__started if self.__started is not None else 0.0
+        return {A_TO_B: self.__a_to_b.stats(elapsed),
+                B_TO_A: self.__b_to_a.stats(elapsed)}
+
+
+if __name__ == '__main__':
+    import argparse
+    import cantools
+    import os
+
+    parser = argparse.ArgumentParser(description="Forward CAN frames between two channels.")
+    parser.add_argument('--channel-a', default='can0')
+    parser.add_argument('--channel-b', default=VCAN)
+    parser.add_argument('--interface', default=SOCKET_CAN)
+    parser.add_argument('--dbc', default=os.path.join('res', 'tesla_can.dbc'))
+    parser.add_argument('--rules', help="Gateway rules JSON")
+    parser.add_argument('--frame-rules', help="Checksum rules JSON, recomputed after overrides, "
+                                              "e.g. res/tx_msg_rules.json for res/gateway_rules.json")
+    parser.add_argument('--interval', type=float, default=5.0, help="Seconds between stats lines")
+    args = parser.parse_args()
+
+    gateway_rules = None
+    if args.rules:
+        gateway_rules = load_gateway_rules(cantools.database.load_file(args.dbc), args.rules,
+                                           frame_rules_json_path=args.frame_rules)
+    gateway = CanGateway(channel_a=args.channel_a, channel_b=args.channel_b,
+                         interface_a=args.interface, interface_b=args.interface, rules=gateway_rules)
+    gateway.start()
+    try:
+        while True:
+            time.sleep(args.interval)
+            for direction, stats in gateway.stats.items():
+                print(f"{direction}: {stats['forwarded']} forwarded, {stats['dropped']} dropped, "
+                      f"{stats['throughput']:.0f} frames/s, mean {stats['mean_latency'] * 1e6:.0f} us, "
+                      f"max {stats['max_latency'] * 1e6:.0f} us")
+    except KeyboardInterrupt:
+        gateway.stop()
@@ -0,0 +1,280 @@
+from CAN_bulk_decoder import CanBulkDecoder
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import cantools
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+import logging
+_logger = logging.getLogger("CAN_log_decoder")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+CANDUMP = 'candump'
+ASC = 'asc'
+CSV = 'csv'
+NPZ = 'npz'
+MANIFEST_NAME = '_manifest.txt'
+
+
+"""
+Log parsing, runs in the worker processes
+"""
+
+
+def _parse_candump_line(line):
+    # (1436509052.249713) vcan0 488#DE594407
+    tokens = line.split()
+    if len(tokens) < 3 or not tokens[0].startswith('(') or '#' not in tokens[2]:
+        return None
+    can_id, data = tokens[2].split('#', 1)
+    if data.startswith('R') or data.startswith('#'):
+        return None  # Remote and CAN FD frames are not decoded
+    try:
+        return float(tokens[0][1:-1]), int(can_id, 16), bytes.fromhex(data)
+    except ValueError:
+        return None  # Torn last line of a crashed capture
+
+
+def _parse_asc_line(line):
+    # 1.234567 1  488             Rx   d 4 DE 59 44 07
+    tokens = line.split()
+    if len(tokens) < 6 or tokens[4].lower() != 'd':
+        return None
+    try:
+        timestamp = float(tokens[0])
+        can_id = int(tokens[2].rstrip('xX'), 16)
+        dlc = int(tokens[5], 16)
+        data = bytes(int(byte, 16) for byte in tokens[6:6 + dlc])
+    except ValueError:
+        return None  # Header, error frame or event line
+    return timestamp, can_id, data
+
+
+def parse_lines(lines, log_format):
+    # Also returns how many non-blank lines held no decodable frame
+    parse = _parse_asc_line if log_format == ASC else _parse_candump_line
+    timestamps = []
+    ids = []
+    payloads = bytearray()
+    skipped = 0
+    for line in lines:
+        frame = parse(line)
+        if frame is None:
+            if line.strip():
+                skipped += 1
+            continue
+        timestamps.append(frame[0])
+        ids.append(frame[1])
+        payloads += frame[2][:8].ljust(8, b'\x00')
+    return (np.array(timestamps, dtype=np.float64), np.array(ids, dtype=np.uint32),
+            np.frombuffer(bytes(payloads), dtype=np.uint8).reshape(-1, 8), skipped)
+
+
+_worker_decoder = None
+
+
+def _init_worker(dbc):
+    # The DBC is unpickled once per worker, codecs are compiled on first use
+    global _worker_decoder
+    _worker_decoder = CanBulkDecoder(dbc)
+
+
+def _decode_chunk(chunk_index, lines, log_format, out_dir, output_format):
+    timestamps, ids, payloads, skipped = parse_lines(lines, log_format)
+    counts = dict()
+    if not len(ids):
+        return chunk_index, counts, skipped
+    for msg_name, columns in _worker_decoder.decode(timestamps, ids, payloads).items():
+        msg_dir = os.path.join(out_dir, msg_name)
+        os.makedirs(msg_dir, exist_ok=True)
+        _write_part(os.path.join(msg_dir, f"part_{chunk_index:06d}.{output_format}"),
+                    columns, output_format)
+        counts[msg_name] = len(columns['timestamp'])
+    return chunk_index, counts, skipped
+
+
+def _write_part(path, columns, output_format):
+    # Write next to the target and rename, a crash never leaves a partial part file
+    names = ['timestamp'] + [name for name in columns if name != 'timestamp']
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        if output_format == NPZ:
+            np.savez(f, **{name: columns[name] for name in names})
+        else:
+            np.savetxt(f, np.column_stack([columns[name] for name in names]),
+                       delimiter=',', fmt='%.10g', header=','.join(names), comments='')
+    os.replace(tmp_path, path)
+
+
+class CanLogDecoder:
+    """
+    Decodes candump (-L) and Vector ASC logs into per-message columnar files.
+
+    The log is streamed in chunks of `chunk_lines` lines and every chunk is
+    parsed and bulk-decoded by a process pool. Each worker writes
+    <out_dir>/<message name>/part_<chunk>.<csv|npz>, and only the chunk index
+    travels back, so memory is bounded by the chunks in flight rather than the
+    log size. Finished chunks are appended to a manifest; a rerun with
+    `resume` skips them. Lines without a decodable frame (headers, remote
+    or CAN FD frames, a torn last line) are skipped and counted.
+    """
+
+    def __init__(self, dbc_path, workers=None, chunk_lines=200000, output_format=NPZ,
+                 logger=_logger):
+        if output_format not in (CSV, NPZ):
+            raise ValueError(f"[{self.__class__.__name__}] Unknown output format: {output_format}!")
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        self.__dbc = cantools.database.load_file(dbc_path)
+        self.__workers = workers or os.cpu_count()
+        self.__chunk_lines = chunk_lines
+        self.__output_format = output_format
+        self.__skipped_lines = 0
+
+    def decode(self, log_path, out_dir, log_format=None, resume=True, progress=None):
+        log_format = log_format or (ASC if log_path.lower().endswith('.asc') else CANDUMP)
+        os.makedirs(out_dir, exist_ok=True)
+        header = f"{os.path.abspath(log_path)} {os.path.getsize(log_path)} " \
+                 f"{self.__chunk_lines} {self.__output_format}"
+        done = self.__read_manifest(out_dir, header) if resume else set()
+        if not done:
+            self.__remove_parts(out_dir)
+            with open(os.path.join(out_dir, MANIFEST_NAME), 'w') as manifest:
+                manifest.write(header + '\n')
+
+        total_bytes = os.path.getsize(log_path)
+        frames = 0
+        self.__skipped_lines = 0
+        start = time.perf_counter()
+        with open(os.path.join(out_dir, MANIFEST_NAME), 'a') as manifest, \
+                ProcessPoolExecutor(max_workers=self.__workers, initializer=_init_worker,
+                                    initargs=(self.__dbc,)) as pool:
+            pending = dict()
+            read_bytes = 0
+            for chunk_index, lines, chunk_bytes in self.__read_chunks(log_path):
+                read_bytes += chunk_bytes
+                if chunk_index in done:
+                    continue
+                # Keep at most two chunks per worker in flight
+                while len(pending) >= 2 * self.__workers:
+                    frames += self.__collect(pending, manifest, block=True)
+                future = pool.submit(_decode_chunk, chunk_index, lines, log_format,
+                                     out_dir, self.__output_format)
+                pending[future] = read_bytes
+                frames += self.__collect(pending, manifest, block=False)
+                if progress is not None:
+                    progress(read_bytes, total_bytes)
+            while pending:
+                frames += self.__collect(pending, manifest, block=True)
+
+        elapsed = time.perf_counter() - start
+        self.logger.info(f"[{self.__class_name}] Decoded {frames} frames of {log_path} "
+                         f"in {elapsed:.1f} s")
+        if self.__skipped_lines:
+            self.logger.warning(f"[{self.__class_name}] Skipped {self.__skipped_lines} lines "
+                                f"without a decodable frame")
+        return frames
+
+    def __collect(self, pending, manifest, block):
+        finished, _ = wait(list(pending), timeout=None if block else 0,
+                           return_when=FIRST_COMPLETED)
+        frames = 0
+        for future in finished:
+            pending.pop(future)
+            chunk_index, counts, skipped = future.result()
+            manifest.write(f"{chunk_index} {sum(counts.values())} {skipped}\n")
+            frames += sum(counts.values())
+            self.__skipped_lines += skipped
+        manifest.flush()
+        return frames
+
+    def __read_chunks(self, log_path):
+        with open(log_path, 'r', errors='replace') as f:
+            chunk_index = 0
+            lines = []
+            chunk_bytes = 0
+            for line in f:
+                lines.append(line)
+                chunk_bytes += len(line)
+                if len(lines) == self.__chunk_lines:
+                    yield chunk_index, lines, chunk_bytes
+                    chunk_index += 1
+                    lines = []
+                    chunk_bytes = 0
+            if lines:
+                yield chunk_index, lines, chunk_bytes
+
+    def __remove_parts(self, out_dir):
+        # Starting over, part files of an earlier run must not mix into this one
+        removed = 0
+        for entry in os.scandir(out_dir):
+            if not entry.is_dir():
+                continue
+            for part in os.scandir(entry.path):
+                if part.name.startswith('part_') or part.name.endswith('.tmp'):
+                    os.remove(part.path)
+                    removed += 1
+            if not os.listdir(entry.path):
+                os.rmdir(entry.path)
+        if removed:
+            self.logger.info(f"[{self.__class_name}] Removed {removed} part files of a previous run")
+
+    def __read_manifest(self, out_dir, header):
+        path = os.path.join(out_dir, MANIFEST_NAME)
+        try:
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return set()
+        if not lines or lines[0] != header:
+            self.logger.warning(
+                f"[{self.__class_name}] {path} belongs to another log or settings, starting over")
+            return set()
+        done = {int(line.split()[0]) for line in lines[1:] if line.strip()}
+        if done:
+            self.logger.info(f"[{self.__class_name}] Resuming, {len(done)} chunks already decoded")
+        return done
+
+    @property
+    def skipped_lines(self):
+        # Lines of the chunks decoded by the last decode() call that held no frame
+        return self.__skipped_lines
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Decode a candump or ASC log into per-message columnar files.")
+    parser.add_argument('log')
+    parser.add_argument('out_dir')
+    parser.add_argument('--dbc', default=os.path.join('res', 'tesla_can.dbc'))
+    parser.add_argument('--log-format', choices=(CANDUMP, ASC), default=None,
+                        help="Defaults to asc for *.asc files, candump otherwise")
+    parser.add_argument('--format', choices=(NPZ, CSV), default=NPZ)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-lines', type=int, default=200000)
+    parser.add_argument('--no-resume', action='store_true')
+    args = parser.parse_args()
+
+    def print_progress(read_bytes, total_bytes):
+        sys.stderr.write(f"\r{100 * read_bytes / max(total_bytes, 1):5.1f}% "
+                         f"({read_bytes >> 20} / {total_bytes >> 20} MiB)")
+        sys.stderr.flush()
+
+    decoder = CanLogDecoder(args.dbc, workers=args.workers, chunk_lines=args.chunk_lines,
+                            output_format=args.format)
+    frames = decoder.decode(args.log, args.out_dir, log_format=args.log_format,
+                            resume=not args.no_resume, progress=print_progress)
+    sys.stderr.write('\n')
+    print(f"{frames} frames decoded into {args.out_dir}, {decoder.skipped_lines} lines skipped")
@@ -1,9 +1,18 @@
 from CAN_message import CanMessage
 from CAN_transceiver import CanTransceiver
-
+from CAN_decoder import CanDecodeCache
+from CAN_frame_rules import load_frame_rules
+from CAN_signal_store import CanSignalStore
+from CAN_subscription import CanSubscriptionTable
+from CAN_tx_journal import CanTxJournal
+from CAN_bus_load import CanBusLoad
+from CAN_startup_cache import CanStartupCache, DEFAULT_CACHE_DIR
+
+import can
 import cantools
 import logging
 import json
+import time
 
 _logger = logging.getLogger("CAN_manager")
 _logger.setLevel(logging.DEBUG)
@@ -24,16 +33,31 @@ class CanManager:
     SOCKET_CAN = 'socketcan'
     BAUD_RATE_500K = 500000
     BAUD_RATE_125K = 125000
+    BUS_LOAD_WARN = 'warn'
+    BUS_LOAD_REJECT = 'reject'
 
     def __init__(self,
                  dbc_path, init_tx_msgs_json_path, last_modified_tx_msgs_json_path=None,
+                 tx_rules_json_path=None, tx_journal_path=None,
                  channel=VCAN, interface=SOCKET_CAN, bitrate=BAUD_RATE_500K, default_can_period=0.5,
                  logging_rec_msg=False, record_last_msgs=False,
-                 target_names=None,
-                 logger=_logger):
+                 target_names=None, decode_cache_size=1024, tx_scheduler=False,
+                 use_startup_cache=False, startup_cache_dir=DEFAULT_CACHE_DIR,
+                 rx_workers=0, rx_queue_size=4096, rx_batch_size=64, rx_overflow_policy='drop_oldest',
+                 bus_load_limit=None, bus_load_policy=BUS_LOAD_WARN, measure_rx_load=False,
+                 metrics=False, metrics_tx_jitter=False, shared_table_name=None, logger=_logger):
         self.logger = logger
-        self.__dbc = cantools.database.load_file(dbc_path)
+        self.__startup_bundle = None
+        if use_startup_cache:
+            self.__startup_bundle = CanStartupCache(cache_dir=startup_cache_dir, logger=logger).load(
+                dbc_path=dbc_path, init_tx_msgs_json_path=init_tx_msgs_json_path)
+            self.__dbc = self.__startup_bundle.dbc
+        else:
+            self.__dbc = cantools.database.load_file(dbc_path)
         self.__default_can_period = default_can_period
+        self.__decode_cache = CanDecodeCache(
+            dbc=self.__dbc, max_size=decode_cache_size)
+        self.__bulk_decoder = None
 
         """
         Init for target messages management 
@@ -42,6 +66,8 @@ class CanManager:
         self.__target_names = target_names
         self.__target_messages = None
         self.__target_message_ids = None
+        self.__extended_message_ids = [
+            msg.frame_id for msg in self.__all_messages if msg.is_extended_frame]
         self.__set_target_messages()
 
         """
@@ -52,21 +78,77 @@ class CanManager:
         self.__init_tx_msgs_dict = None
         self.__last_modified_tx_msgs_dict = None
         self.__msgs_bundle = dict()
+        self.__pending_init_msg_ids = dict()
+        self.__tx_journal = None
+        self.__restored_tx_msgs = dict()
+        if tx_journal_path:
+            self.__tx_journal = CanTxJournal(
+                journal_path=tx_journal_path,
+                snapshot_path=last_modified_tx_msgs_json_path or f"{tx_journal_path}.json",
+                logger=logger)
         self.__get_init_msgs_from_json()
         self.__construct_init_messages()
 
+        """
+        Init rolling counter and checksum rules of transmitted messages
+        """
+        self.__tx_frame_rules = dict()
+        if tx_rules_json_path:
+            self.__tx_frame_rules = load_frame_rules(
+                dbc=self.__dbc, rules_json_path=tx_rules_json_path, logger=logger)
+
+        """
+        Init bus load model and admission control of the TX schedule
+        """
+        self.__bus_load = CanBusLoad(bitrate)
+        self.__bus_load_limit = bus_load_limit
+        self.__bus_load_policy = bus_load_policy
+        self.__measure_rx_load = measure_rx_load
+
+        """
+        Init metrics, None keeps the hot paths uninstrumented
+        """
+        # metrics_tx_jitter also instruments kernel-driven periodic tasks, moving them onto Python threads
+        self.__metrics = None
+        if metrics:
+            # Optional subsystems are imported on first use to keep startup cheap
+            from CAN_metrics import CanMetrics
+            self.__metrics = CanMetrics(tx_jitter=metrics_tx_jitter)
+        self.__metrics_server = None
+
         """
         Init CAN Transceiver 
         """
         self.__record_last_msgs = record_last_msgs
+        self.__signal_store = None
+        if self.__record_last_msgs:
+            self.__signal_store = CanSignalStore(
+                dbc=self.__dbc, msg_ids=self.__target_message_ids)
+        # Published from start() to stop(), readers attach with CanSharedSignalReader
+        # and the same DBC and target messages, and reattach after a restart
+        self.__shared_table_name = shared_table_name
+        self.__shared_table = None
+        self.__signal_history = None
+        self.__subscriptions = CanSubscriptionTable(self.__dbc)
+        self.__recorder = None
+        self.__scenario_players = dict()
+        self.__responder = None
+        self.__started = False
         self.__logging_rec_msgs_enabled = logging_rec_msg
         self.__can_trx = CanTransceiver(channel=channel,
                                         interface=interface,
                                         bitrate=bitrate,
                                         filtered_msg_ids=self.__target_message_ids,
-                                        record_last_msgs=self.__record_last_msgs,
-                                        logger=logger)
+                                        extended_msg_ids=self.__extended_message_ids,
+                                        logger=logger,
+                                        tx_scheduler=tx_scheduler,
+                                        rx_workers=rx_workers,
+                                        rx_queue_size=rx_queue_size,
+                                        rx_batch_size=rx_batch_size,
+                                        rx_overflow_policy=rx_overflow_policy,
+                                        metrics=self.__metrics)
         self.__external_on_can_msg_callback = None
+        self.__external_on_can_msgs_callback = None
         self.__external_modified_msg_callback = None
 
     """
@@ -74,37 +156,131 @@ class CanManager:
     """
 
     def __construct_init_messages(self):
+        # Messages are only built when first used, see __get_bundle_msg
         for msg_id_str in self.__init_tx_msgs_dict:
             msg_id = self.convert_string_to_hex(msg_id_str)
-            msg = CanMessage(dbc=self.__dbc, can_id=msg_id,
-                             init_can_data=self.__init_tx_msgs_dict[msg_id_str],
-                             logger=self.logger)
+            self.__pending_init_msg_ids[msg_id] = msg_id_str
+
+    def __get_bundle_msg(self, msg_id):
+        if msg_id in self.__pending_init_msg_ids:
+            msg_id_str = self.__pending_init_msg_ids.pop(msg_id)
+            if self.__startup_bundle is not None:
+                can_data, payload = self.__startup_bundle.init_payloads[msg_id]
+                init_can_data = self.__init_tx_msgs_dict[msg_id_str]
+                init_can_data.update(can_data)
+                msg = CanMessage(dbc=self.__dbc, can_id=msg_id, init_can_data=init_can_data,
+                                 logger=self.logger, init_payload=payload)
+            else:
+                msg = CanMessage(dbc=self.__dbc, can_id=msg_id,
+                                 init_can_data=self.__init_tx_msgs_dict[msg_id_str],
+                                 logger=self.logger)
+            if msg_id in self.__restored_tx_msgs:
+                msg.modify_signals(can_data=self.__restored_tx_msgs.pop(msg_id))
             self.__msgs_bundle[msg_id] = msg
+        return self.__msgs_bundle[msg_id]
 
     def __get_init_msgs_from_json(self):
-        with open(self.__init_tx_msgs_json_path, 'r') as f:
-            self.__init_tx_msgs_dict = json.load(f)
+        if self.__startup_bundle is not None:
+            self.__init_tx_msgs_dict = self.__startup_bundle.init_tx_msgs_dict
             self.__last_modified_tx_msgs_dict = self.__init_tx_msgs_dict.copy()
+        else:
+            with open(self.__init_tx_msgs_json_path, 'r') as f:
+                self.__init_tx_msgs_dict = json.load(f)
+                self.__last_modified_tx_msgs_dict = self.__init_tx_msgs_dict.copy()
+
+        if self.__tx_journal is not None:
+            self.__restore_tx_msgs_from_journal()
+
+    def __restore_tx_msgs_from_journal(self):
+        # init_tx_msgs.json + snapshot + journal, only differences to the init values are reapplied
+        init_by_id = {self.convert_string_to_hex(msg_id_str): data
+                      for msg_id_str, data in self.__init_tx_msgs_dict.items()}
+        self.__last_modified_tx_msgs_dict = self.__tx_journal.restore(self.__init_tx_msgs_dict)
+        for msg_id_str, data in self.__last_modified_tx_msgs_dict.items():
+            msg_id = self.convert_string_to_hex(msg_id_str)
+            if msg_id not in init_by_id:
+                continue
+            changed = {name: value for name, value in data.items()
+                       if init_by_id[msg_id].get(name) != value}
+            if changed:
+                self.__restored_tx_msgs.setdefault(msg_id, dict()).update(changed)
 
     def __load_init_msgs_to_can_trx(self):
 
-        for msg_id in self.__msgs_bundle:
-            if self.__msgs_bundle[msg_id].period:
-                self.__can_trx.add_periodic_tx_msg(msg=self.__msgs_bundle[msg_id].can_msg,
-                                                   period=self.__msgs_bundle[msg_id].period / 1000)
-            else:
-                self.__can_trx.add_periodic_tx_msg(msg=self.__msgs_bundle[msg_id].can_msg,
-                                                   period=self.__default_can_period / 1000)
+        for msg_id in list(self.__msgs_bundle) + list(self.__pending_init_msg_ids):
+            msg = self.__get_bundle_msg(msg_id)
+            if not self.__admit_tx_msg(msg):
+                continue
+            self.__can_trx.add_periodic_tx_msg(msg=msg.can_msg,
+                                               period=self.__get_period(msg),
+                                               modifier=self.__get_periodic_modifier(msg))
+
+    def __get_frame_modifier(self, msg_id):
+        if msg_id in self.__tx_frame_rules:
+            return self.__tx_frame_rules[msg_id].apply
+        return None
+
+    def __get_periodic_modifier(self, msg):
+        # Multiplexed messages cycle their pre-encoded pages, counter/checksum rules apply after
+        frame_modifier = self.__get_frame_modifier(msg.can_id)
+        if not msg.is_paged:
+            return frame_modifier
+        if frame_modifier is None:
+            return msg.apply_next_page
+
+        apply_next_page = msg.apply_next_page
+
+        def apply_next_page_and_rules(frame):
+            apply_next_page(frame)
+            frame_modifier(frame)
+
+        return apply_next_page_and_rules
+
+    def __admit_tx_msg(self, msg):
+        # Adds the message to the bus load model unless it pushes the load over the limit
+        period = self.__get_period(msg)
+        length = len(msg.can_msg.data)
+        extended = msg.can_msg.is_extended_id
+        if self.__bus_load_limit is not None:
+            projected = self.__bus_load.projected_utilization(msg.can_id, length, period, extended)
+            if projected > self.__bus_load_limit:
+                if self.__bus_load_policy == self.BUS_LOAD_REJECT:
+                    self.logger.error(
+                        f"[{self.__class__}] Rejected {hex(msg.can_id)}: projected bus load "
+                        f"{projected:.1%} exceeds {self.__bus_load_limit:.1%}!")
+                    return False
+                self.logger.warning(
+                    f"[{self.__class__}] Adding {hex(msg.can_id)} raises the projected bus load "
+                    f"to {projected:.1%}, above {self.__bus_load_limit:.1%}!")
+        self.__bus_load.add(msg.can_id, length, period, extended)
+        return True
+
+    def __get_period(self, can_msg):
+        # DBC cycle times are in milliseconds, default_can_period is in seconds
+        if can_msg.period:
+            return can_msg.period / 1000
+        return self.__default_can_period
 
     """
     CAN Transceiver Callback
     """
 
     def __on_can_msg_callback(self, msg):
-        msg_id = msg.arbitration_id
-        dbc_msg = self.__dbc.get_message_by_frame_id(msg_id)
-        data = dbc_msg.decode(msg.data)
-        if self.__logging_rec_msgs_enabled:
+        if self.__measure_rx_load:
+            self.__bus_load.observe(msg)
+        if self.__signal_store is not None:
+            self.__signal_store.update(msg)
+        shared_table = self.__shared_table
+        if shared_table is not None:
+            shared_table.update(msg)
+        if self.__signal_history is not None:
+            self.__signal_history.update(msg)
+        self.__subscriptions.dispatch(msg)
+
+        # Decoding is lazy, consumers share the cached result via decode_msg
+        if self.__logging_rec_msgs_enabled and self.logger.isEnabledFor(logging.DEBUG):
+            msg_id = msg.arbitration_id
+            data = self.decode_msg(msg)
             self.logger.debug(
                 f"[{self.__class__}] Receiving {hex(msg_id)}: {data}")
 
@@ -113,11 +289,17 @@ class CanManager:
 
     def __modified_tx_msg_callback(self, msg):
         msg_id = msg.arbitration_id
-        dbc_msg = self.__dbc.get_message_by_frame_id(msg_id)
-        data = dbc_msg.decode(msg.data)
-        self.logger.info(
-            f"[{self.__class__}] Modified {hex(msg_id)} as {data}")
+        if self.__is_in_msg_bundle(msg_id):
+            # Signal values are already known from the update, skip decoding
+            data = dict(self.__get_bundle_msg(msg_id).can_data)
+        else:
+            data = self.decode_msg(msg)
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                f"[{self.__class__}] Modified {hex(msg_id)} as {data}")
         self.__update_msg_dict(msg_id=msg_id, decoded_data=data)
+        if self.__tx_journal is not None:
+            self.__tx_journal.append(hex(msg_id), data)
 
         if self.__external_modified_msg_callback:
             self.__external_modified_msg_callback(msg)
@@ -147,23 +329,49 @@ class CanManager:
         else:
             pass
 
+    def __update_can_filters(self):
+        # Without target names, only narrow the kernel filters when nothing needs every frame
+        if self.__target_message_ids is None and (
+                not len(self.__subscriptions) or self.__record_last_msgs or
+                self.__shared_table_name or self.__logging_rec_msgs_enabled or
+                self.__recorder is not None or self.__measure_rx_load or
+                self.__external_on_can_msg_callback or self.__external_on_can_msgs_callback):
+            if self.__can_trx.can_filters is not None:
+                self.__can_trx.set_filtered_msg_ids(None)
+            return
+        msg_ids = set(self.__target_message_ids or ())
+        msg_ids.update(self.__subscriptions.msg_ids)
+        if self.__signal_history is not None:
+            msg_ids.update(self.__signal_history.msg_ids)
+        self.__can_trx.set_filtered_msg_ids(sorted(msg_ids))
+
     @staticmethod
     def convert_string_to_hex(msg_id):
         return int(msg_id, 16)
 
     def __is_in_msg_bundle(self, msg_id):
-        return self.__msgs_bundle.__contains__(msg_id)
+        return self.__msgs_bundle.__contains__(msg_id) or self.__pending_init_msg_ids.__contains__(msg_id)
 
     """
     Exposed APIs
     """
 
     def decode_msg(self, msg):
-        msg_id = msg.arbitration_id
-        dbc_msg = self.__dbc.get_message_by_frame_id(msg_id)
-        data = dbc_msg.decode(msg.data)
+        # The returned dict is shared with other consumers, do not modify it
+        if self.__metrics is None:
+            return self.__decode_cache.decode(msg.arbitration_id, msg.data)
+        start = time.perf_counter()
+        data = self.__decode_cache.decode(msg.arbitration_id, msg.data)
+        self.__metrics.decode_time.observe(time.perf_counter() - start)
         return data
 
+    def decode_msgs(self, timestamps, arbitration_ids, payloads):
+        # Bulk decode of N frames, payloads as an N x 8 uint8 array
+        if self.__bulk_decoder is None:
+            from CAN_bulk_decoder import CanBulkDecoder
+            self.__bulk_decoder = CanBulkDecoder(self.__dbc)
+        return self.__bulk_decoder.decode(timestamps, arbitration_ids, payloads)
+
     def add_init_msg(self, can_msg):
         if not isinstance(can_msg, CanMessage):
             raise TypeError(
@@ -175,6 +383,7 @@ class CanManager:
 
     def add_init_msgs(self, can_msg_list):
         for msg in can_msg_list:
+            self.__pending_init_msg_ids.pop(msg.can_id, None)
             self.__msgs_bundle[msg.can_id] = msg
 
     def add_tx_msg(self, can_msg):
@@ -182,8 +391,11 @@ class CanManager:
             raise TypeError(
                 f"[{self.__class__}] Input can_msg is not an instance of CanMessage!")
 
+        if not self.__admit_tx_msg(can_msg):
+            return -1
         self.__can_trx.add_periodic_tx_msg(
-            msg=can_msg.can_msg, period=can_msg.period / 1000)
+            msg=can_msg.can_msg, period=self.__get_period(can_msg),
+            modifier=self.__get_periodic_modifier(can_msg))
         msg_id = can_msg.can_id
         if not self.__is_in_msg_bundle(msg_id):
             self.__msgs_bundle[msg_id] = can_msg
@@ -192,44 +404,316 @@ class CanManager:
         for msg in can_msg_list:
             self.add_tx_msg(msg)
 
-    def start(self):
+    def start(self, loop=None):
+        # With an asyncio loop, frames are received and dispatched from that loop
         self.__can_trx.set_on_can_msg_callback(self.__on_can_msg_callback)
         self.__can_trx.set_modify_tx_msg_callback(
             self.__modified_tx_msg_callback)
         self.__load_init_msgs_to_can_trx()
-        self.__can_trx.start()
+        if self.__shared_table_name and self.__shared_table is None:
+            from CAN_shared_table import CanSharedSignalTable
+            try:
+                self.__shared_table = CanSharedSignalTable(
+                    dbc=self.__dbc, name=self.__shared_table_name, msg_ids=self.__target_message_ids)
+            except FileExistsError as e:
+                self.logger.error(f"[{self.__class__}] Not publishing the shared table: {e}")
+        self.__started = True
+        if self.__tx_journal is not None:
+            self.__tx_journal.start()
+        if loop is not None:
+            self.__can_trx.start_in_loop(loop)
+        else:
+            self.__can_trx.start()
 
     def stop(self):
-        self.__store_last_modified_msg_json()
+        if self.__tx_journal is not None:
+            # Compacting the journal writes the last modified JSON
+            self.__tx_journal.stop()
+        else:
+            self.__store_last_modified_msg_json()
+        self.stop_responder()
         self.__can_trx.stop()
+        self.stop_recording()
+        if self.__metrics_server is not None:
+            self.__metrics_server.stop()
+            self.__metrics_server = None
+        shared_table = self.__shared_table
+        if shared_table is not None:
+            self.__shared_table = None
+            shared_table.close()
+
+    def pause(self):
+        self.__can_trx.pause()
+
+    def resume(self):
+        self.__can_trx.resume()
+
+    def stop_periodic_tx_msg(self, msg_id):
+        msg_id = self.convert_string_to_hex(msg_id)
+        result = self.__can_trx.stop_periodic_tx_msg(msg_id)
+        if result == 0:
+            self.__bus_load.remove(msg_id)
+        return result
+
+    def start_periodic_tx_msg(self, msg_id):
+        msg_id = self.convert_string_to_hex(msg_id)
+        if self.__is_in_msg_bundle(msg_id) and msg_id not in self.__bus_load.schedule:
+            if not self.__admit_tx_msg(self.__get_bundle_msg(msg_id)):
+                return -1
+        result = self.__can_trx.start_periodic_tx_msg(msg_id)
+        if result == -1 and msg_id not in self.__can_trx.periodic_tx_msg_tasks:
+            self.__bus_load.remove(msg_id)
+        return result
 
     def modify_tx_msg(self, msg_id, can_data, event=False, **signals):
         msg_id = self.convert_string_to_hex(msg_id)
         if self.__is_in_msg_bundle(msg_id):
-            msg = self.__msgs_bundle[msg_id]
-            msg.modify_signals(can_data=can_data, **signals)
+            if not event and self.__started and msg_id not in self.__can_trx.periodic_tx_msg_tasks:
+                # E.g. refused by the bus load admission control
+                self.logger.error(
+                    f"[{self.__class__}] Message {hex(msg_id)} is not sent periodically!")
+                return -1
+            msg = self.__get_bundle_msg(msg_id)
+            if self.__metrics is not None:
+                start = time.perf_counter()
+                result = msg.modify_signals(can_data=can_data, **signals)
+                self.__metrics.encode_time.observe(time.perf_counter() - start)
+            else:
+                result = msg.modify_signals(can_data=can_data, **signals)
+            if result == -1:
+                self.logger.error(
+                    f"[{self.__class__}] Rejected modification of message {hex(msg_id)}!")
+                return -1
 
+            debug = self.logger.isEnabledFor(logging.DEBUG)
             if event:
-                self.logger.debug(
-                    f"[{self.__class__}] Send event message {hex(msg_id)} from msg_bundle_list!")
-                self.__can_trx.send_evt_msg(msg.can_msg)
+                if debug:
+                    self.logger.debug(
+                        f"[{self.__class__}] Send event message {hex(msg_id)} from msg_bundle_list!")
+                frame = msg.can_msg
+                modifier = self.__get_frame_modifier(msg_id)
+                if modifier is not None:
+                    # Patch a copy, the periodic task may be sending msg.can_msg right now
+                    frame = can.Message(arbitration_id=frame.arbitration_id, data=bytearray(frame.data),
+                                        is_extended_id=frame.is_extended_id)
+                    modifier(frame)
+                self.__can_trx.send_evt_msg(frame)
             else:
-                self.logger.debug(
-                    f"[{self.__class__}] Modified message {hex(msg_id)} from msg_bundle_list!")
+                if debug:
+                    self.logger.debug(
+                        f"[{self.__class__}] Modified message {hex(msg_id)} from msg_bundle_list!")
                 self.__can_trx.modify_tx_msg(msg.can_msg)
+            return 0
         else:
             self.logger.error(
                 f"[{self.__class__}] Message {hex(msg_id)} is not in the CanManager msg_bundle_list!")
+            return -1
+
+    def set_tx_page_schedule(self, msg_id, pages):
+        # Page order of a multiplexed periodic message, e.g. [0, 0, 1]; default is round robin
+        msg_id = self.convert_string_to_hex(msg_id)
+        if not self.__is_in_msg_bundle(msg_id):
+            self.logger.error(
+                f"[{self.__class__}] Message {hex(msg_id)} is not in the CanManager msg_bundle_list!")
+            return -1
+        return self.__get_bundle_msg(msg_id).set_page_schedule(pages)
+
+    def play_scenario(self, scenario, loop=False):
+        # Stream a pre-rendered CanScenario / CanScenarioChain (or its JSON file) through the periodic tasks
+        from CAN_scenario import CanScenarioPlayer, load_scenario
+        if isinstance(scenario, str):
+            scenario = load_scenario(scenario)
+        msg_ids = scenario.msg_ids(self.__dbc)
+        for msg_id in msg_ids:
+            if not self.__is_in_msg_bundle(msg_id) or \
+                    msg_id not in self.__can_trx.periodic_tx_msg_tasks:
+                self.logger.error(
+                    f"[{self.__class__}] Scenario message {hex(msg_id)} is not sent periodically!")
+                return -1
+
+        msgs = {msg_id: self.__get_bundle_msg(msg_id) for msg_id in msg_ids}
+        for msg_id, msg in msgs.items():
+            # Payloads are rendered from one frame, playing them would stop the page cycling
+            if msg.is_paged:
+                self.logger.error(
+                    f"[{self.__class__}] Scenario message {hex(msg_id)} is multiplexed, "
+                    f"scenarios only drive non-multiplexed messages!")
+                return -1
+        try:
+            rendered = scenario.render(
+                self.__dbc,
+                base_payloads={msg_id: bytes(msg.can_msg.data) for msg_id, msg in msgs.items()},
+                periods={msg_id: self.__get_period(msg) for msg_id, msg in msgs.items()})
+        except (ValueError, KeyError) as e:
+            self.logger.error(f"[{self.__class__}] Invalid scenario: {e}")
+            return -1
+
+        self.stop_scenario()
+        for msg_id, payloads in rendered.items():
+            player = CanScenarioPlayer(payloads, loop=loop, modifier=self.__get_frame_modifier(msg_id))
+            self.__scenario_players[msg_id] = player
+            self.__can_trx.set_periodic_tx_modifier(msg_id, player.apply)
+        return self.__scenario_players
+
+    def wait_scenario(self, timeout=None):
+        # True once every message of the scenario sent its last payload
+        return all(player.finished.wait(timeout) for player in self.__scenario_players.values())
+
+    def stop_scenario(self):
+        # Back to the bundle payloads and the plain frame rules
+        for msg_id in list(self.__scenario_players):
+            del self.__scenario_players[msg_id]
+            msg = self.__get_bundle_msg(msg_id)
+            self.__can_trx.set_periodic_tx_modifier(msg_id, self.__get_periodic_modifier(msg))
+            msg.modify_signals(can_data={})
+            self.__can_trx.modify_tx_msg(msg.can_msg)
+
+    def track_signal_history(self, signal_name, capacity=1000):
+        # Keep the last `capacity` samples of a received signal for windowed queries
+        if self.__signal_history is None:
+            from CAN_signal_history import CanSignalHistory
+            self.__signal_history = CanSignalHistory(self.__dbc)
+        buffer = self.__signal_history.subscribe(signal_name, capacity=capacity)
+        self.__update_can_filters()
+        return buffer
+
+    def untrack_signal_history(self, signal_name):
+        if self.__signal_history is not None:
+            self.__signal_history.unsubscribe(signal_name)
+            self.__update_can_filters()
+
+    def subscribe_msg(self, msg, callback, on_change=False):
+        # msg is an arbitration ID or message name, callback(msg) runs on the receive path
+        subscription = self.__subscriptions.subscribe_msg(msg, callback, on_change=on_change)
+        self.__update_can_filters()
+        return subscription
+
+    def subscribe_signal(self, signal_name, callback, on_change=False, deadband=0.0):
+        # callback(signal_name, value, timestamp), deadband only applies with on_change
+        subscription = self.__subscriptions.subscribe_signal(
+            signal_name, callback, on_change=on_change, deadband=deadband)
+        self.__update_can_filters()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.__subscriptions.unsubscribe(subscription)
+        self.__update_can_filters()
+
+    def signal_history(self, signal_name):
+        try:
+            if self.__signal_history is not None:
+                return self.__signal_history.get(signal_name)
+        except KeyError:
+            pass
+        self.logger.error(f"[{self.__class__}] Signal history of {signal_name} is not tracked!")
+        return -1
+
+    def start_responder(self, rules_json_path, tx_msgs_json_path=None):
+        # Answer trigger frames by rules, tx_msgs_json_path adds the responding ECU's own messages
+        from CAN_responder import CanResponder, load_responder_rules
+        if self.__responder is not None:
+            self.logger.error(f"[{self.__class__}] Responder is already running!")
+            return -1
+        if tx_msgs_json_path:
+            with open(tx_msgs_json_path, 'r') as f:
+                tx_msgs_dict = json.load(f)
+            for msg_id_str, can_data in tx_msgs_dict.items():
+                msg_id = self.convert_string_to_hex(msg_id_str)
+                if self.__is_in_msg_bundle(msg_id):
+                    continue
+                msg = CanMessage(dbc=self.__dbc, can_id=msg_id, init_can_data=can_data,
+                                 logger=self.logger)
+                if self.__started:
+                    self.add_tx_msg(msg)
+                else:
+                    # Sent from start() together with the init messages
+                    self.__msgs_bundle[msg_id] = msg
+        rules = []
+        for rule in load_responder_rules(self.__dbc, rules_json_path, logger=self.logger):
+            # A response to a message outside the TX bundle could never be sent
+            missing = sorted({action.msg_id for _, actions in rule.steps for action in actions
+                              if not self.__is_in_msg_bundle(self.convert_string_to_hex(action.msg_id))})
+            if missing:
+                self.logger.error(
+                    f"[{self.__class__}] Rejected responder rule {rule.name}: "
+                    f"{', '.join(missing)} not in the CanManager msg_bundle_list!")
+                continue
+            rules.append(rule)
+        self.__responder = CanResponder(self, rules, logger=self.logger)
+        self.__responder.start()
+        return self.__responder
+
+    def stop_responder(self):
+        if self.__responder is None:
+            return None
+        self.__responder.stop()
+        stats = self.__responder.stats
+        self.__responder = None
+        return stats
+
+    def start_recording(self, record_dir, **kwargs):
+        # Record every received frame to binary chunk files, see CanRecorder for kwargs
+        from CAN_recorder import CanRecorder
+        if self.__recorder is not None:
+            self.logger.error(
+                f"[{self.__class__}] Already recording to {self.__recorder.record_dir}!")
+            return -1
+        self.__recorder = CanRecorder(record_dir, logger=self.logger, **kwargs)
+        self.__recorder.start()
+        self.__can_trx.set_recorder(self.__recorder)
+        self.__update_can_filters()
+
+    def stop_recording(self):
+        if self.__recorder is None:
+            return None
+        self.__can_trx.set_recorder(None)
+        self.__recorder.stop()
+        stats = self.__recorder.stats
+        self.__recorder = None
+        self.__update_can_filters()
+        return stats
+
+    def replay(self, record_dir, speed=1.0, msg_ids=None, overrides=None, spin_threshold=0.0):
+        # Plays a recording through the transmit side in the background, join() it to wait
+        from CAN_replay import CanReplay
+        replay = CanReplay(record_dir, send=self.__can_trx.send_evt_msg, dbc=self.__dbc,
+                           speed=speed, msg_ids=msg_ids, overrides=overrides,
+                           extended_msg_ids=self.__extended_message_ids,
+                           spin_threshold=spin_threshold, logger=self.logger)
+        replay.start()
+        return replay
+
+    def set_filtered_msg_ids(self, msg_ids):
+        # Replace the kernel CAN filters, None receives every frame
+        return self.__can_trx.set_filtered_msg_ids(msg_ids)
 
     def set_on_can_msg_callback(self, callback):
         self.__external_on_can_msg_callback = callback
+        self.__update_can_filters()
+
+    def set_on_can_msgs_callback(self, callback):
+        # Called with a list of frames per batch, only when rx_workers is set
+        self.__external_on_can_msgs_callback = callback
+        self.__can_trx.set_on_can_msgs_callback(callback)
+        self.__update_can_filters()
 
     def set_modified_msg_callback(self, callback):
         self.__external_modified_msg_callback = callback
 
     @property
-    def last_msgs(self):
-        return self.__can_trx.last_rec_msgs
+    def last_signals(self):
+        # Latest physical value of every received signal, replaces the former last_msgs frames
+        if self.__signal_store is None:
+            return -1
+        return self.__signal_store.snapshot().to_dict()
+
+    @property
+    def signal_store(self):
+        return self.__signal_store
+
+    @property
+    def shared_table_name(self):
+        return self.__shared_table_name
 
     @property
     def last_modified_tx_msgs_dict(self):
@@ -243,6 +727,53 @@ class CanManager:
     def dbc(self):
         return self.__dbc
 
+    @property
+    def filter_stats(self):
+        return self.__can_trx.filter_stats
+
+    @property
+    def rx_stats(self):
+        # Dropped frames and queue high-water mark of the receive workers
+        return self.__can_trx.rx_stats
+
+    def metrics_snapshot(self):
+        # Per-ID counters and latency/jitter/codec histograms, None when metrics are disabled
+        if self.__metrics is None:
+            return None
+        return self.__metrics.snapshot()
+
+    def start_metrics_server(self, host='127.0.0.1', port=0):
+        # Serves /metrics (text) and /metrics.json, returns the bound (host, port)
+        if self.__metrics is None:
+            self.logger.error(f"[{self.__class__}] Metrics are disabled!")
+            return -1
+        if self.__metrics_server is None:
+            from CAN_metrics import CanMetricsServer
+            self.__metrics_server = CanMetricsServer(self.__metrics, host=host, port=port)
+            self.__metrics_server.start()
+        return self.__metrics_server.address
+
+    def set_measure_rx_load(self, enabled):
+        # Starts or stops measuring the RX load, the kernel filters stay open while measuring
+        self.__measure_rx_load = enabled
+        self.__bus_load.measured_utilization(reset=True)
+        self.__update_can_filters()
+
+    def bus_load_report(self):
+        # Projected TX utilization, worst-case latency per ID and, when measured, the RX load
+        report = self.__bus_load.report()
+        if self.__measure_rx_load:
+            report["measured_rx_utilization"] = self.__bus_load.measured_utilization()
+        return report
+
+    @property
+    def bus_load(self):
+        return self.__bus_load
+
+    @property
+    def decode_cache_info(self):
+        return self.__decode_cache.cache_info()
+
 
 if __name__ == '__main__':
     import time
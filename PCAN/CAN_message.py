@@ -1,3 +1,6 @@
+from CAN_codec import get_codec
+from cantools.database.errors import EncodeError
+
 import decimal
 import can
 import logging
@@ -14,55 +17,122 @@ _logger.addHandler(_ch)
 
 
 class CanMessage:
-    def __init__(self, dbc, can_id, init_can_data=None, logger=_logger):
+    def __init__(self, dbc, can_id, init_can_data=None, logger=_logger, init_payload=None):
         self.logger = logger
         self.__dbc = dbc
         self.__can_id = can_id
         self.__msg_dbc = self.__dbc.get_message_by_frame_id(self.__can_id)
-        self.__signal_names = list(
-            map(lambda signal: signal.name, self.__msg_dbc.signals))
+        self.__codec = get_codec(self.__msg_dbc)
+        self.__signal_names = self.__codec.signal_names
         self.__msg_name = self.__msg_dbc.name
         self.__period = self.__msg_dbc.cycle_time
         self.__can_data = init_can_data
         self.__extended = self.__msg_dbc.is_extended_frame
-        self.__construct_default_msg()
+        self.__payload = None
+
+        # Multiplexed messages keep one encoded payload per page of the top level multiplexer
+        self.__mux_layout = None
+        self.__pages = None
+        self.__page_schedule = None
+        self.__page_index = 0
+        self.__current_page = None
+        if self.__codec.is_multiplexed:
+            self.__mux_layout = next(layout for layout in self.__codec.layouts.values()
+                                     if layout.is_multiplexer and layout.multiplexer_ids is None)
+
+        if init_payload is None or self.__mux_layout is not None:
+            self.__construct_default_msg()
+        else:
+            # Complete can_data with its pre-encoded payload, e.g. from the startup cache
+            self.__payload = bytearray(init_payload)
+            self.__can_msg = can.Message(arbitration_id=self.__can_id, data=bytes(self.__payload),
+                                         is_extended_id=self.__extended)
 
     def modify_signals(self, can_data=None, **signals):
         if can_data is None:
-            for signal in signals.keys():
-                self.modify_signal(signal_name=signal,
-                                   signal_value=signals[signal])
-        else:
-            for signal in can_data.keys():
-                self.modify_signal(signal_name=signal,
-                                   signal_value=can_data[signal])
+            can_data = signals
+
+        # Validate the whole batch first, then encode once
+        signal_list = []
+        for signal_name in can_data.keys():
+            try:
+                signal = self.__get_signal_by_name(signal_name)
+            except KeyError:
+                self.logger.error(
+                    f"[{self.__class__}] This message doesn't contain this signal: {signal_name}!")
+                return -1
+            if not self.__is_valid_value(signal, can_data[signal_name]):
+                return -1
+            signal_list.append(signal)
+
+        if not self.__commit(can_data, signal_list):
+            return -1
         return self.__can_msg
 
     def modify_signal(self, signal_name, signal_value):
         try:
             signal = self.__get_signal_by_name(signal_name)
+        except KeyError:
+            self.logger.error(
+                f"[{self.__class__}] This message doesn't contain this signal: {signal_name}!")
+            return -1
+        if not self.__is_valid_value(signal, signal_value):
+            return -1
+        if not self.__commit({signal_name: signal_value}, [signal]):
+            return -1
+        return self.__can_msg
+
+    def __commit(self, can_data, signal_list):
+        # The encoders read __can_data, so apply the values and roll them back if encoding fails
+        previous = {signal_name: self.__can_data[signal_name]
+                    for signal_name in can_data if signal_name in self.__can_data}
+        self.__can_data.update(can_data)
+        try:
+            self.__patch_msg(signal_list)
+            return True
+        except (TypeError, ValueError, OverflowError, EncodeError, decimal.InvalidOperation) as e:
+            self.logger.error(
+                f"[{self.__class__}] Invalid input signal values: {can_data}! {e}")
+        for signal_name in can_data:
+            if signal_name in previous:
+                self.__can_data[signal_name] = previous[signal_name]
+            else:
+                del self.__can_data[signal_name]
+        # A failed patch may have touched the payload, rebuild it from the restored values
+        if self.__pages is not None:
+            self.__encode_pages()
+        else:
+            self.__encode_msg()
+        return False
+
+    def __is_valid_value(self, signal, signal_value):
+        try:
             min_value = signal.minimum
             max_value = signal.maximum
             if min_value and max_value:
                 if (signal_value < min_value) or (signal_value > max_value):
                     self.logger.error(f"[{self.__class__}] Out of range input signal value: "
                                       f"{signal_value} from {min_value} to {max_value}!")
-                    return -1
-            self.__can_data[signal_name] = signal_value
-            self.__encode_msg()
-            return self.__can_msg
-        except IndexError as e:
+                    return False
+            signal.check_range(signal_value)
+            return True
+        except EncodeError as e:
             self.logger.error(
-                f"[{self.__class__}] This message doesn't contain this signal: {signal_name}!", e)
-        except TypeError as e:
+                f"[{self.__class__}] Out of range input signal value: {signal_value}! {e}")
+            return False
+        except (TypeError, ValueError, OverflowError) as e:
             self.logger.error(
-                f"[{self.__class__}] Invalid input signal value: {signal_value}!", e)
+                f"[{self.__class__}] Invalid input signal value: {signal_value}! {e}")
+            return False
 
     def __construct_default_msg(self):
         if self.__can_data is None or type(self.__can_data) != dict:
             self.__can_data = dict()
         self.__fill_can_data()
-        self.__encode_msg()
+        if self.__mux_layout is not None:
+            self.__encode_pages()
+        else:
+            self.__encode_msg()
 
     def __fill_can_data(self):
         if len(self.__can_data) < len(self.__signal_names):
@@ -78,9 +148,27 @@ class CanMessage:
                         self.__can_data[signal_name] = 0
 
     def __get_signal_by_name(self, signal_name):
-        signal = list(filter(lambda can_signal: can_signal.name ==
-                      signal_name, self.__msg_dbc.signals))[0]
-        return signal
+        return self.__codec.get_layout(signal_name)
+
+    def __patch_msg(self, signal_list):
+        if self.__pages is not None:
+            self.__patch_pages(signal_list)
+            return
+
+        if any(signal.is_multiplexer for signal in signal_list):
+            # Switching mux page changes which signals are encoded
+            self.__encode_msg()
+            return
+
+        try:
+            for signal in signal_list:
+                self.__codec.patch(self.__payload, signal.name,
+                                   self.__can_data[signal.name])
+        except (OverflowError, ValueError, KeyError, TypeError):
+            self.__encode_msg()
+            return
+        self.__can_msg = can.Message(arbitration_id=self.__can_id, data=bytes(self.__payload),
+                                     is_extended_id=self.__extended)
 
     def __encode_msg(self):
         try:
@@ -94,9 +182,114 @@ class CanMessage:
         except OverflowError:
             dbc_data = self.__msg_dbc.encode(
                 self.__can_data, scaling=False, strict=False)
+        self.__payload = bytearray(dbc_data)
         self.__can_msg = can.Message(arbitration_id=self.__can_id, data=dbc_data,
                                      is_extended_id=self.__extended)
 
+    """
+    Multiplexed messages
+    """
+
+    def __encode_pages(self):
+        mux = self.__mux_layout
+        page_ids = sorted({page for layout in self.__codec.layouts.values()
+                           if layout.multiplexer_signal == mux.name for page in layout.multiplexer_ids})
+        self.__pages = dict()
+        for page in page_ids:
+            can_data = dict(self.__can_data)
+            can_data[mux.name] = page * mux.scale + mux.offset
+            try:
+                self.__pages[page] = self.__codec.encode(can_data)
+            except (OverflowError, ValueError, EncodeError, TypeError, decimal.InvalidOperation):
+                self.__pages[page] = self.__codec.encode(can_data, scaling=False, strict=False)
+
+        if self.__page_schedule is None:
+            self.__page_schedule = tuple(page_ids)
+        self.__current_page = self.__page_of(self.__can_data.get(mux.name))
+        if self.__current_page is None:
+            self.__current_page = page_ids[0]
+        self.__can_msg = can.Message(arbitration_id=self.__can_id,
+                                     data=bytes(self.__pages[self.__current_page]),
+                                     is_extended_id=self.__extended)
+
+    def __page_of(self, mux_value):
+        try:
+            page = self.__mux_layout.physical_to_bits(mux_value)
+        except (OverflowError, ValueError, KeyError, TypeError):
+            return None
+        return page if page in self.__pages else None
+
+    def __owner_pages(self, layout):
+        # Top level pages a signal is encoded in, following nested multiplexers up
+        mux_name = self.__mux_layout.name
+        while layout.multiplexer_ids is not None and layout.multiplexer_signal != mux_name:
+            layout = self.__codec.get_layout(layout.multiplexer_signal)
+        if layout.multiplexer_ids is None:
+            return list(self.__pages)
+        return [page for page in layout.multiplexer_ids if page in self.__pages]
+
+    def __patch_pages(self, signal_list):
+        # Only the pages owning a changed signal are patched, the frame is the last page touched
+        current = self.__current_page
+        try:
+            for signal in signal_list:
+                if signal is self.__mux_layout:
+                    page = self.__page_of(self.__can_data[signal.name])
+                    if page is None:
+                        raise ValueError(f"{self.__can_data[signal.name]} is not a page of {signal.name}")
+                    current = page
+                    continue
+                pages = self.__owner_pages(signal)
+                for page in pages:
+                    self.__codec.patch(self.__pages[page], signal.name, self.__can_data[signal.name])
+                if signal.multiplexer_ids is not None and pages:
+                    current = pages[0]
+        except (OverflowError, ValueError, KeyError, TypeError):
+            self.__encode_pages()
+            return
+        self.__current_page = current
+        self.__can_msg = can.Message(arbitration_id=self.__can_id, data=bytes(self.__pages[current]),
+                                     is_extended_id=self.__extended)
+
+    def apply_next_page(self, msg):
+        # Periodic modifier: copies the next scheduled page into the outgoing frame, no encoding
+        # The schedule is an immutable tuple read once and the index wrapped against it,
+        # so set_page_schedule from another thread can never push the index out of range
+        schedule = self.__page_schedule
+        index = self.__page_index % len(schedule)
+        msg.data[:] = self.__pages[schedule[index]]
+        self.__page_index = index + 1
+
+    def set_page_schedule(self, pages):
+        # Order in which pages are sent, e.g. [0, 0, 1] sends page 0 twice as often
+        if self.__pages is None:
+            self.logger.error(f"[{self.__class__}] Message {self.__msg_name} is not multiplexed!")
+            return -1
+        unknown = [page for page in pages if page not in self.__pages]
+        if unknown or not pages:
+            self.logger.error(f"[{self.__class__}] Invalid page schedule {pages} of {self.__msg_name}, "
+                              f"pages are {list(self.__pages)}!")
+            return -1
+        self.__page_schedule = tuple(pages)
+        self.__page_index = 0
+        return list(self.__page_schedule)
+
+    @property
+    def is_paged(self):
+        return self.__pages is not None
+
+    @property
+    def pages(self):
+        if self.__pages is None:
+            return None
+        return {page: bytes(payload) for page, payload in self.__pages.items()}
+
+    @property
+    def page_schedule(self):
+        if self.__page_schedule is None:
+            return None
+        return list(self.__page_schedule)
+
     @property
     def can_msg(self):
         return self.__can_msg
@@ -0,0 +1,222 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import json
+import threading
+import time
+
+"""
+Bucket upper bounds in seconds, the last bucket catches everything above
+"""
+LATENCY_BUCKETS = (50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3)
+JITTER_BUCKETS = (10e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 50e-3)
+CODEC_BUCKETS = (1e-6, 2.5e-6, 5e-6, 10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 1e-3, 10e-3)
+
+
+class CanHistogram:
+    """
+    Fixed-bucket histogram. observe() is a bisect and two increments with
+    no lock: under the GIL a concurrent update can at worst lose a count,
+    which is acceptable for monitoring.
+    """
+
+    def __init__(self, bounds):
+        self.__bounds = tuple(bounds)
+        self.__counts = [0] * (len(self.__bounds) + 1)
+        self.__sum = 0.0
+
+    def observe(self, value):
+        self.__counts[bisect_left(self.__bounds, value)] += 1
+        self.__sum += value
+
+    def snapshot(self):
+        counts = list(self.__counts)
+        return {"bounds": list(self.__bounds), "counts": counts,
+                "count": sum(counts), "sum": self.__sum}
+
+
+class CanMetrics:
+    """
+    Counters and histograms of the transceiver and manager hot paths.
+
+    Components hold None instead of a CanMetrics when metrics are disabled,
+    so the disabled cost is one `is not None` check per frame.
+
+    Periodic TX is only counted where frames already pass through Python
+    (a modifier or the TX scheduler). Wrapping a bare kernel BCM task would
+    move it onto a Python thread and change the path being measured, so
+    such IDs are listed as uncounted unless `tx_jitter` opts into that.
+    """
+
+    def __init__(self, tx_jitter=False):
+        self.__started = time.time()
+        self.__tx_jitter = tx_jitter
+        self.__rx_frames = dict()
+        self.__tx_frames = dict()
+        self.__tx_last = dict()
+        self.__tx_uncounted = dict()
+        self.rx_latency = CanHistogram(LATENCY_BUCKETS)
+        self.tx_jitter = CanHistogram(JITTER_BUCKETS)
+        self.encode_time = CanHistogram(CODEC_BUCKETS)
+        self.decode_time = CanHistogram(CODEC_BUCKETS)
+
+    def on_rx(self, msg):
+        # Receive-to-callback latency against the bus timestamp of the frame
+        rx_frames = self.__rx_frames
+        msg_id = msg.arbitration_id
+        rx_frames[msg_id] = rx_frames.get(msg_id, 0) + 1
+        self.rx_latency.observe(time.time() - msg.timestamp)
+
+    def on_tx(self, msg_id):
+        tx_frames = self.__tx_frames
+        tx_frames[msg_id] = tx_frames.get(msg_id, 0) + 1
+
+    def tx_modifier(self, msg_id, period, modifier=None, python_path=False):
+        # Wraps the modifier of a periodic task to count sends and the interval jitter
+        # between them, measured when the modifier runs right before each send
+        if modifier is None and not python_path and not self.__tx_jitter:
+            self.__tx_uncounted[msg_id] = period
+            return None
+        self.__tx_uncounted.pop(msg_id, None)
+        tx_frames = self.__tx_frames
+        tx_last = self.__tx_last
+        tx_jitter = self.tx_jitter
+        perf_counter = time.perf_counter
+
+        def on_periodic_tx(msg):
+            now = perf_counter()
+            last = tx_last.get(msg_id)
+            if last is not None:
+                tx_jitter.observe(abs(now - last - period))
+            tx_last[msg_id] = now
+            tx_frames[msg_id] = tx_frames.get(msg_id, 0) + 1
+            if modifier is not None:
+                modifier(msg)
+
+        return on_periodic_tx
+
+    def snapshot(self):
+        return {"uptime": time.time() - self.__started,
+                "rx_frames": {hex(msg_id): count for msg_id, count in list(self.__rx_frames.items())},
+                "tx_frames": {hex(msg_id): count for msg_id, count in list(self.__tx_frames.items())},
+                "tx_uncounted": {hex(msg_id): period for msg_id, period in list(self.__tx_uncounted.items())},
+                "rx_latency": self.rx_latency.snapshot(),
+                "tx_jitter": self.tx_jitter.snapshot(),
+                "encode_time": self.encode_time.snapshot(),
+                "decode_time": self.decode_time.snapshot()}
+
+    def to_text(self):
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = [f"pcan_uptime_seconds {snapshot['uptime']:.3f}"]
+        for direction in ('rx', 'tx'):
+            lines.append(f"# TYPE pcan_{direction}_frames_total counter")
+            for msg_id, count in sorted(snapshot[f"{direction}_frames"].items()):
+                lines.append(f'pcan_{direction}_frames_total{{id="{msg_id}"}} {count}')
+        lines.append("# TYPE pcan_tx_uncounted_period_seconds gauge")
+        for msg_id, period in sorted(snapshot["tx_uncounted"].items()):
+            lines.append(f'pcan_tx_uncounted_period_seconds{{id="{msg_id}"}} {period}')
+        for name in ('rx_latency', 'tx_jitter', 'encode_time', 'decode_time'):
+            histogram = snapshot[name]
+            lines.append(f"# TYPE pcan_{name}_seconds histogram")
+            cumulative = 0
+            for bound, count in zip(histogram["bounds"] + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                lines.append(f'pcan_{name}_seconds_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"pcan_{name}_seconds_sum {histogram['sum']}")
+            lines.append(f"pcan_{name}_seconds_count {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+class CanMetricsServer:
+    """
+    Local HTTP endpoint serving /metrics as text and /metrics.json.
+    """
+
+    def __init__(self, metrics, host='127.0.0.1', port=0):
+        metrics_ref = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics_ref.to_text().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(metrics_ref.snapshot()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    @property
+    def address(self):
+        return self.__server.server_address
+
+
+if __name__ == '__main__':
+    import can
+    import os
+    import timeit
+    from CAN_manager import CanManager
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    init_tx_msgs_path = os.path.join(cwd, r'res/init_tx_msgs.json')
+
+    # Per-frame cost of the instrumentation itself
+    msg = can.Message(timestamp=time.time(), arbitration_id=0x488, data=bytes(4))
+    metrics = CanMetrics()
+    disabled = None
+    n = 200000
+    off = timeit.timeit(lambda: disabled is not None and disabled.on_rx(msg), number=n) / n
+    on = timeit.timeit(lambda: metrics.on_rx(msg), number=n) / n
+    print(f"per frame: disabled {off * 1e9:.0f} ns, enabled {on * 1e9:.0f} ns")
+
+    # End to end receive throughput on a virtual bus, median of interleaved runs
+    frames = 20000
+    rates = {False: [], True: []}
+    for run, enabled in [(run, enabled) for run in range(5) for enabled in (False, True)]:
+        channel = f"metrics_bench_{run}_{enabled}"
+        can_mgr = CanManager(dbc_path=dbc_path, init_tx_msgs_json_path=init_tx_msgs_path,
+                             last_modified_tx_msgs_json_path=os.devnull, channel=channel,
+                             interface='virtual', record_last_msgs=True, metrics=enabled)
+        received = threading.Event()
+        count = [0]
+
+        def on_can_msg(rx_msg):
+            count[0] += 1
+            if count[0] == frames:
+                received.set()
+
+        can_mgr.set_on_can_msg_callback(on_can_msg)
+        can_mgr.start()
+        sender = can.interface.Bus(interface='virtual', channel=channel)
+        start = time.perf_counter()
+        for i in range(frames):
+            sender.send(can.Message(arbitration_id=0x488, is_extended_id=False,
+                                    data=bytes.fromhex('de594407')))
+        received.wait(30)
+        rates[enabled].append(frames / (time.perf_counter() - start))
+        sender.shutdown()
+        can_mgr.stop()
+    for enabled, values in rates.items():
+        print(f"metrics {'on ' if enabled else 'off'}: median {sorted(values)[len(values) // 2]:.0f} frames/s "
+              f"over {len(values)} runs (min {min(values):.0f}, max {max(values):.0f})")
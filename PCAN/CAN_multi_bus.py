@@ -0,0 +1,405 @@
+from multiprocessing.connection import wait
+
+import can
+import itertools
+import multiprocessing
+import threading
+import time
+import logging
+_logger = logging.getLogger("CAN_multi_bus")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+_MSG_EVENT = 'm'
+_SIGNAL_EVENT = 's'
+
+
+class CanBusSpec:
+    """
+    One bus of a CanMultiBusManager. Extra keyword arguments are passed to
+    the CanManager of the worker, e.g. tx_scheduler=True.
+    """
+
+    def __init__(self, channel, interface, bitrate, dbc_path, init_tx_msgs_json_path, **kwargs):
+        self.channel = channel
+        self.manager_kwargs = dict(kwargs, channel=channel, interface=interface, bitrate=bitrate,
+                                   dbc_path=dbc_path, init_tx_msgs_json_path=init_tx_msgs_json_path)
+
+
+"""
+Worker process, one CanManager per bus
+"""
+
+
+def _run_bus_worker(manager_kwargs, command_conn, event_conn, flush_interval):
+    from CAN_manager import CanManager
+
+    can_mgr = CanManager(**manager_kwargs)
+    pending = []
+    pending_lock = threading.Lock()
+    running = threading.Event()
+    running.set()
+    subscriptions = dict()
+
+    def flush_events():
+        # Group commit of events: one pickle and one pipe write per interval
+        while running.is_set():
+            time.sleep(flush_interval)
+            with pending_lock:
+                if not pending:
+                    continue
+                batch = pending[:]
+                del pending[:]
+            try:
+                event_conn.send(batch)
+            except (OSError, ValueError):
+                return
+
+    def on_msg(key, decode):
+        def callback(msg):
+            data = can_mgr.decode_msg(msg) if decode else None
+            event = (_MSG_EVENT, key, msg.timestamp, msg.arbitration_id, msg.is_extended_id,
+                     bytes(msg.data), data)
+            with pending_lock:
+                pending.append(event)
+        return callback
+
+    def on_signal(key):
+        def callback(signal_name, value, timestamp):
+            with pending_lock:
+                pending.append((_SIGNAL_EVENT, key, signal_name, value, timestamp))
+        return callback
+
+    def modify(msg_id, can_data, event):
+        try:
+            return can_mgr.modify_tx_msg(msg_id, can_data, event=event)
+        except (KeyError, TypeError, ValueError) as e:
+            can_mgr.logger.error(f"[_run_bus_worker] Invalid modification of {msg_id}: {e}")
+            return -1
+
+    def execute(name, args):
+        if name == 'modify':
+            # A batch of (msg_id, can_data, event) in one round trip
+            return [modify(msg_id, can_data, event) for msg_id, can_data, event in args[0]]
+        elif name == 'subscribe_msg':
+            key, msg, on_change, decode = args
+            subscriptions[key] = can_mgr.subscribe_msg(msg, on_msg(key, decode), on_change=on_change)
+        elif name == 'subscribe_signal':
+            key, signal_name, on_change, deadband = args
+            subscriptions[key] = can_mgr.subscribe_signal(
+                signal_name, on_signal(key), on_change=on_change, deadband=deadband)
+        elif name == 'unsubscribe':
+            subscription = subscriptions.pop(args[0], None)
+            if subscription is not None:
+                can_mgr.unsubscribe(subscription)
+        else:
+            raise ValueError(f"Unknown command {name}")
+        return None
+
+    flusher = threading.Thread(target=flush_events, daemon=True)
+    flusher.start()
+    can_mgr.start()
+
+    try:
+        while True:
+            try:
+                command = command_conn.recv()
+            except EOFError:
+                break
+            name, args = command[0], command[1:]
+            if name == 'stop':
+                break
+            # Replies are (ok, result or error text), a failed command must not end the worker
+            try:
+                reply = (True, execute(name, args))
+            except Exception as e:
+                reply = (False, f"{type(e).__name__}: {e}")
+            command_conn.send(reply)
+    finally:
+        # Always stop the manager, its non-daemon threads would keep the process alive
+        can_mgr.stop()
+        running.clear()
+        flusher.join()
+    try:
+        command_conn.send((True, None))
+    except (OSError, ValueError):
+        pass
+
+
+class CanBusCommandError(Exception):
+    # A command the bus worker received but failed to execute
+    pass
+
+
+class _CanBusWorker:
+    # Front end state of one bus, survives restarts of its process
+    def __init__(self, spec):
+        self.spec = spec
+        self.process = None
+        self.command_conn = None
+        self.event_conn = None
+        self.lock = threading.Lock()
+        self.subscriptions = dict()  # key -> command, only those the worker accepted
+        self.callbacks = dict()  # key -> callback
+        self.modifications = dict()  # msg_id -> merged can_data, replayed after a restart
+        self.restarts = 0
+        self.events = 0
+        self.alive = False
+
+
+class CanMultiBusManager:
+    """
+    Runs every bus in its own process with its own CanManager, so receive
+    threads and periodic tasks of different buses never share a GIL.
+
+    Commands go to a worker over a pipe and wait for its reply. Subscription
+    events are batched by the worker every `flush_interval` seconds and
+    dispatched to the callbacks by one front end thread. A worker that dies
+    is restarted with its subscriptions and TX modifications replayed, up
+    to `max_restarts` times; the other buses keep running meanwhile.
+    """
+
+    def __init__(self, specs, auto_restart=True, max_restarts=5, flush_interval=0.005,
+                 command_timeout=10.0, logger=_logger):
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        self.__context = multiprocessing.get_context('spawn')
+        self.__workers = {spec.channel: _CanBusWorker(spec) for spec in specs}
+        self.__auto_restart = auto_restart
+        self.__max_restarts = max_restarts
+        self.__flush_interval = flush_interval
+        self.__command_timeout = command_timeout
+        self.__keys = itertools.count(1)
+        self.__running = False
+        self.__dispatcher = None
+
+    def start(self):
+        self.__running = True
+        for worker in self.__workers.values():
+            self.__spawn(worker)
+        self.__dispatcher = threading.Thread(target=self.__dispatch_loop, daemon=True)
+        self.__dispatcher.start()
+
+    def stop(self):
+        self.__running = False
+        for worker in self.__workers.values():
+            with worker.lock:
+                if worker.alive:
+                    try:
+                        self.__call(worker, ('stop',))
+                    except (EOFError, OSError, TimeoutError, CanBusCommandError):
+                        pass
+                worker.process.join(timeout=5)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                worker.alive = False
+        if self.__dispatcher is not None:
+            self.__dispatcher.join()
+
+    def __spawn(self, worker):
+        command_conn, worker_command_conn = self.__context.Pipe()
+        event_conn, worker_event_conn = self.__context.Pipe(duplex=False)
+        worker.process = self.__context.Process(
+            target=_run_bus_worker, name=f"can-bus-{worker.spec.channel}", daemon=True,
+            args=(worker.spec.manager_kwargs, worker_command_conn, worker_event_conn,
+                  self.__flush_interval))
+        worker.process.start()
+        worker_command_conn.close()
+        worker_event_conn.close()
+        worker.command_conn = command_conn
+        worker.event_conn = event_conn
+        worker.alive = True
+
+        # Replay state so a restarted worker continues where the old one stopped
+        for key, command in list(worker.subscriptions.items()):
+            try:
+                self.__call(worker, command)
+            except CanBusCommandError as e:
+                worker.subscriptions.pop(key, None)
+                self.logger.error(f"[{self.__class_name}] Dropped subscription {key} on replay: {e}")
+        if worker.modifications:
+            self.__call(worker, ('modify', [(msg_id, can_data, False) for msg_id, can_data
+                                            in worker.modifications.items()]))
+
+    def __call(self, worker, command):
+        # Waits for the reply or the worker's exit, never longer than command_timeout
+        worker.command_conn.send(command)
+        ready = wait([worker.command_conn, worker.process.sentinel], timeout=self.__command_timeout)
+        if not ready:
+            # A late reply would desynchronize the pipe, restart the worker instead
+            worker.process.terminate()
+            raise TimeoutError(f"no reply within {self.__command_timeout} s, worker terminated")
+        if not worker.command_conn.poll():
+            raise EOFError("worker exited")
+        ok, result = worker.command_conn.recv()
+        if not ok:
+            raise CanBusCommandError(result)
+        return result
+
+    def __command(self, channel, command):
+        worker = self.__workers[channel]
+        with worker.lock:
+            if not worker.alive:
+                self.logger.error(f"[{self.__class_name}] Bus {channel} is not running!")
+                return -1
+            try:
+                return self.__call(worker, command)
+            except CanBusCommandError as e:
+                self.logger.error(f"[{self.__class_name}] Bus {channel} rejected {command[0]}: {e}")
+                return -1
+            except (EOFError, OSError, TimeoutError) as e:
+                self.logger.error(f"[{self.__class_name}] Bus {channel} did not answer: {e}")
+                return -1
+
+    """
+    Event dispatch and crash handling
+    """
+
+    def __dispatch_loop(self):
+        while self.__running:
+            conns = dict()
+            for worker in self.__workers.values():
+                if worker.alive:
+                    conns[worker.event_conn] = worker
+                    conns[worker.process.sentinel] = worker
+            if not conns:
+                time.sleep(0.1)
+                continue
+            for ready in wait(list(conns), timeout=0.1):
+                worker = conns[ready]
+                if ready is worker.event_conn:
+                    try:
+                        batch = worker.event_conn.recv()
+                    except (EOFError, OSError):
+                        continue
+                    self.__dispatch(worker, batch)
+                elif self.__running and not worker.process.is_alive():
+                    self.__on_worker_exit(worker)
+
+    def __dispatch(self, worker, batch):
+        worker.events += len(batch)
+        callbacks = worker.callbacks
+        for event in batch:
+            callback = callbacks.get(event[1])
+            if callback is None:
+                continue
+            try:
+                if event[0] == _MSG_EVENT:
+                    _, _, timestamp, msg_id, extended, data, decoded = event
+                    msg = can.Message(timestamp=timestamp, arbitration_id=msg_id,
+                                      is_extended_id=extended, data=data,
+                                      channel=worker.spec.channel)
+                    if decoded is None:
+                        callback(msg)
+                    else:
+                        callback(msg, decoded)
+                else:
+                    _, _, signal_name, value, timestamp = event
+                    callback(signal_name, value, timestamp)
+            except Exception as e:
+                self.logger.exception(f"[{self.__class_name}] Subscriber callback failed: {e}")
+
+    def __on_worker_exit(self, worker):
+        with worker.lock:
+            worker.alive = False
+            channel = worker.spec.channel
+            self.logger.error(f"[{self.__class_name}] Bus worker {channel} exited with code "
+                              f"{worker.process.exitcode}!")
+            if not self.__auto_restart or worker.restarts >= self.__max_restarts:
+                return
+            worker.restarts += 1
+            self.logger.info(f"[{self.__class_name}] Restarting bus worker {channel} "
+                             f"({worker.restarts}/{self.__max_restarts})")
+            try:
+                self.__spawn(worker)
+            except (EOFError, OSError, TimeoutError, CanBusCommandError) as e:
+                worker.alive = False
+                self.logger.error(f"[{self.__class_name}] Failed to restart bus {channel}: {e}")
+
+    """
+    Exposed APIs
+    """
+
+    def modify_tx_msg(self, channel, msg_id, can_data=None, event=False, **signals):
+        if can_data is None:
+            can_data = signals
+        return self.modify_tx_msgs(channel, [(msg_id, can_data, event)])[0]
+
+    def modify_tx_msgs(self, channel, modifications):
+        # Several (msg_id, can_data, event) in one round trip, one result per modification
+        results = self.__command(channel, ('modify', list(modifications)))
+        if results == -1:
+            return [-1] * len(modifications)
+        worker = self.__workers[channel]
+        for (msg_id, can_data, event), result in zip(modifications, results):
+            # Only modifications the worker applied are replayed after a restart
+            if result == 0:
+                worker.modifications.setdefault(msg_id, dict()).update(can_data)
+        return results
+
+    def subscribe_msg(self, channel, msg, callback, on_change=False, decode=False):
+        # callback(msg), or callback(msg, decoded) with decode, runs on the dispatcher thread
+        return self.__subscribe(channel, callback, 'subscribe_msg', msg, on_change, decode)
+
+    def subscribe_signal(self, channel, signal_name, callback, on_change=False, deadband=0.0):
+        return self.__subscribe(channel, callback, 'subscribe_signal', signal_name, on_change, deadband)
+
+    def __subscribe(self, channel, callback, name, *args):
+        key = next(self.__keys)
+        command = (name, key) + args
+        worker = self.__workers[channel]
+        # The callback is set first so no early event is lost, the command is only
+        # kept for replay once the worker accepted it
+        worker.callbacks[key] = callback
+        if self.__command(channel, command) == -1:
+            worker.callbacks.pop(key, None)
+            return -1
+        worker.subscriptions[key] = command
+        return channel, key
+
+    def unsubscribe(self, handle):
+        channel, key = handle
+        worker = self.__workers[channel]
+        worker.subscriptions.pop(key, None)
+        worker.callbacks.pop(key, None)
+        return self.__command(channel, ('unsubscribe', key))
+
+    @property
+    def channels(self):
+        return list(self.__workers)
+
+    @property
+    def stats(self):
+        return {channel: {"alive": worker.alive,
+                          "pid": worker.process.pid if worker.process else None,
+                          "restarts": worker.restarts,
+                          "events": worker.events}
+                for channel, worker in self.__workers.items()}
+
+
+if __name__ == '__main__':
+    import os
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    init_tx_msgs_path = os.path.join(cwd, r'res/init_tx_msgs.json')
+
+    multi_bus = CanMultiBusManager([
+        CanBusSpec('vcan0', 'socketcan', 500000, dbc_path, init_tx_msgs_path,
+                   last_modified_tx_msgs_json_path=os.path.join(cwd, r'res/last_modified_msgs.json')),
+        CanBusSpec('vcan1', 'socketcan', 500000, dbc_path, init_tx_msgs_path,
+                   last_modified_tx_msgs_json_path=os.devnull)])
+    multi_bus.start()
+    multi_bus.subscribe_signal('vcan1', 'DAS_steeringAngleRequest',
+                               lambda name, value, ts: print(f"vcan1 {name} = {value}"), on_change=True)
+    multi_bus.modify_tx_msg('vcan0', "0x488", {"DAS_steeringAngleRequest": 10})
+    time.sleep(2)
+    print(multi_bus.stats)
+    multi_bus.stop()
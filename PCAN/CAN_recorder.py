@@ -0,0 +1,212 @@
+import numpy as np
+import os
+import struct
+import threading
+import time
+import logging
+_logger = logging.getLogger("CAN_recorder")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+"""
+File layout: a 16 byte header (magic, version, record size) followed by
+fixed-size little-endian records, so a chunk can be memory-mapped as a
+numpy structured array.
+"""
+RECORD_MAGIC = b'PCANREC\x00'
+RECORD_VERSION = 1
+_HEADER = struct.Struct('<8sII')
+_RECORD = struct.Struct('<dIBB2x8s')
+HEADER_SIZE = _HEADER.size
+RECORD_SIZE = _RECORD.size
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('arbitration_id', '<u4'), ('flags', 'u1'),
+                         ('dlc', 'u1'), ('pad', 'V2'), ('data', 'u1', (8,))])
+
+FLAG_EXTENDED = 0x01
+FLAG_REMOTE = 0x02
+FLAG_ERROR = 0x04
+FLAG_RX = 0x08
+
+
+def chunk_files(record_dir):
+    return sorted(os.path.join(record_dir, name) for name in os.listdir(record_dir)
+                  if name.startswith('can_') and name.endswith('.bin'))
+
+
+def open_chunk(path):
+    # Read-only memory map of the records of one chunk file
+    with open(path, 'rb') as f:
+        magic, version, record_size = _HEADER.unpack(f.read(HEADER_SIZE))
+    if magic != RECORD_MAGIC or version != RECORD_VERSION or record_size != RECORD_SIZE:
+        raise ValueError(f"{path} is not a version {RECORD_VERSION} CAN record file!")
+    count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_SIZE
+    if not count:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+class CanRecorder:
+    """
+    Append-only binary recorder of every received frame.
+
+    The receive path only packs a 24 byte record into the current block.
+    Full blocks, and the current block every `flush_interval` seconds, are
+    written by a background thread to chunk files of at most `chunk_records`
+    records. At most `max_pending_blocks` blocks wait for the writer; beyond
+    that, blocks are dropped and counted so memory stays bounded.
+    """
+
+    def __init__(self, record_dir, chunk_records=1 << 20, block_records=4096,
+                 max_pending_blocks=64, flush_interval=1.0, logger=_logger):
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        self.__record_dir = record_dir
+        self.__chunk_records = chunk_records
+        self.__block_records = block_records
+        self.__max_pending_blocks = max_pending_blocks
+        self.__flush_interval = flush_interval
+
+        self.__block = bytearray(block_records * RECORD_SIZE)
+        self.__block_count = 0
+        self.__pending = []
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__writer = None
+
+        self.__file = None
+        self.__file_index = 0
+        self.__files_written = 0
+        self.__file_records = 0
+        self.__recorded = 0
+        self.__written = 0
+        self.__dropped = 0
+
+    def start(self):
+        os.makedirs(self.__record_dir, exist_ok=True)
+        # Continue after the highest existing chunk, never overwrite one
+        self.__file_index = max((int(os.path.basename(path)[4:-4]) for path in chunk_files(self.__record_dir)
+                                 if os.path.basename(path)[4:-4].isdigit()), default=-1) + 1
+        self.__running = True
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__writer.start()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__writer is not None:
+            self.__writer.join()
+        self.__close_file()
+
+    def put(self, msg):
+        flags = FLAG_RX
+        if msg.is_extended_id:
+            flags |= FLAG_EXTENDED
+        if msg.is_remote_frame:
+            flags |= FLAG_REMOTE
+        if msg.is_error_frame:
+            flags |= FLAG_ERROR
+        with self.__condition:
+            _RECORD.pack_into(self.__block, self.__block_count * RECORD_SIZE, msg.timestamp,
+                              msg.arbitration_id, flags, msg.dlc, bytes(msg.data[:8]))
+            self.__block_count += 1
+            self.__recorded += 1
+            if self.__block_count == self.__block_records:
+                self.__hand_off_block()
+
+    def put_batch(self, msgs):
+        for msg in msgs:
+            self.put(msg)
+
+    def __hand_off_block(self):
+        # Called with the condition held
+        if len(self.__pending) < self.__max_pending_blocks:
+            self.__pending.append(bytes(self.__block[:self.__block_count * RECORD_SIZE]))
+            self.__condition.notify()
+        else:
+            self.__dropped += self.__block_count
+        self.__block_count = 0
+
+    def __write_loop(self):
+        while True:
+            with self.__condition:
+                if self.__running and not self.__pending:
+                    self.__condition.wait(self.__flush_interval)
+                if self.__block_count and (not self.__pending or not self.__running):
+                    self.__hand_off_block()
+                pending, self.__pending = self.__pending, []
+                running = self.__running
+            for block in pending:
+                self.__write_block(block)
+            if self.__file is not None:
+                self.__file.flush()
+            if not running and not pending:
+                return
+
+    def __write_block(self, block):
+        offset = 0
+        while offset < len(block):
+            if self.__file is None or self.__file_records == self.__chunk_records:
+                self.__open_next_file()
+            count = min((len(block) - offset) // RECORD_SIZE,
+                        self.__chunk_records - self.__file_records)
+            try:
+                self.__file.write(block[offset:offset + count * RECORD_SIZE])
+            except OSError as e:
+                self.logger.error(f"[{self.__class_name}] Failed to write CAN records: {e}")
+                self.__dropped += (len(block) - offset) // RECORD_SIZE
+                return
+            offset += count * RECORD_SIZE
+            self.__file_records += count
+            self.__written += count
+
+    def __open_next_file(self):
+        self.__close_file()
+        path = os.path.join(self.__record_dir, f"can_{self.__file_index:05d}.bin")
+        self.__file_index += 1
+        self.__files_written += 1
+        self.__file = open(path, 'wb')
+        self.__file.write(_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, RECORD_SIZE))
+        self.__file_records = 0
+        self.logger.debug(f"[{self.__class_name}] Recording to {path}")
+
+    def __close_file(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    @property
+    def record_dir(self):
+        return self.__record_dir
+
+    @property
+    def stats(self):
+        return {"recorded_frames": self.__recorded,
+                "written_frames": self.__written,
+                "dropped_frames": self.__dropped,
+                "pending_blocks": len(self.__pending),
+                "chunk_files": self.__files_written}
+
+
+if __name__ == '__main__':
+    import can
+    import tempfile
+
+    record_dir = tempfile.mkdtemp()
+    recorder = CanRecorder(record_dir, chunk_records=1000, block_records=256)
+    recorder.start()
+    start = time.time()
+    for i in range(5000):
+        recorder.put(can.Message(timestamp=start + i * 0.001, arbitration_id=0x488,
+                                 is_extended_id=False, data=i.to_bytes(4, 'little')))
+    recorder.stop()
+    print(f"{recorder.stats} in {chunk_files(record_dir)}")
+    records = open_chunk(chunk_files(record_dir)[-1])
+    print(f"last record: {records[-1]}")
@@ -0,0 +1,237 @@
+from CAN_codec import get_codec
+from CAN_metrics import CanHistogram, JITTER_BUCKETS
+from CAN_recorder import chunk_files, open_chunk, FLAG_EXTENDED, FLAG_REMOTE, FLAG_ERROR
+from CAN_filter import STANDARD_ID_MASK
+from CAN_scheduler import FAILURE_LOG_INTERVAL
+
+from cantools.database.errors import EncodeError
+import can
+import numpy as np
+import threading
+import time
+import logging
+_logger = logging.getLogger("CAN_replay")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+
+class CanReplay(threading.Thread):
+    """
+    Plays back a CanRecorder directory through `send`.
+
+    Chunk files are memory-mapped and walked chunk by chunk. Every frame is
+    sent at an absolute deadline derived from its recorded offset, so
+    sleep jitter never accumulates. `speed` scales time, None or 0 sends as
+    fast as possible. Frames are paced with time.sleep; a `spin_threshold`
+    above 0 sleeps only until that close to a deadline and busy-waits the
+    rest, for precision below the sleep resolution at the cost of holding
+    the GIL. `msg_ids` limits playback to those IDs, IDs above 0x7FF or in
+    `extended_msg_ids` match 29-bit frames only, the others 11-bit frames
+    only. `overrides` ({signal name: physical value}) patches signals of the
+    DBC into every replayed frame of their message, every override is range
+    checked here so a bad value fails at construction rather than in the
+    replay thread.
+    """
+
+    def __init__(self, record_dir, send, dbc=None, speed=1.0, msg_ids=None, overrides=None,
+                 extended_msg_ids=None, spin_threshold=0.0, logger=_logger):
+        super(CanReplay, self).__init__(daemon=True)
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        self.__files = chunk_files(record_dir)
+        self.__send = send
+        self.__speed = speed
+        self.__spin_threshold = spin_threshold
+        self.__msg_keys = None
+        if msg_ids is not None:
+            extended_msg_ids = set(extended_msg_ids or ())
+            self.__msg_keys = np.array(sorted(
+                self.__msg_key(msg_id, msg_id > STANDARD_ID_MASK or msg_id in extended_msg_ids)
+                for msg_id in msg_ids), dtype=np.uint32)
+        self.__patches = self.__build_patches(dbc, overrides or {})
+        self.__running = threading.Event()
+        self.__running.set()
+
+        self.__sent = 0
+        self.__patch_errors = 0
+        self.__send_errors = 0
+        self.__failures = dict()
+        # Absolute timing error of each send, bounded memory however long the recording
+        self.__timing_errors = CanHistogram(JITTER_BUCKETS)
+        self.__max_timing_error = 0.0
+        self.__duration = 0.0
+
+    @staticmethod
+    def __msg_key(msg_id, extended):
+        # 29-bit ID with the frame format above it, so 0x100 and extended 0x100 differ
+        return int(msg_id) | (int(bool(extended)) << 29)
+
+    @staticmethod
+    def __build_patches(dbc, overrides):
+        # msg_id -> (codec, [(signal name, value), ...])
+        patches = dict()
+        if not overrides:
+            return patches
+        if dbc is None:
+            raise ValueError("Signal overrides need a DBC!")
+        for signal_name, value in overrides.items():
+            msg_dbc = next((msg_dbc for msg_dbc in dbc.messages
+                            if any(signal.name == signal_name for signal in msg_dbc.signals)), None)
+            if msg_dbc is None:
+                raise KeyError(f"Signal {signal_name} is not in the DBC!")
+            codec = get_codec(msg_dbc)
+            layout = codec.get_layout(signal_name)
+            layout.check_range(value)
+            layout.physical_to_bits(value)
+            patches.setdefault(msg_dbc.frame_id, (codec, []))[1].append((signal_name, value))
+        return patches
+
+    def run(self):
+        speed = self.__speed
+        spin_threshold = self.__spin_threshold
+        first_timestamp = None
+        start = time.perf_counter()
+        timing_errors = self.__timing_errors
+        for path in self.__files:
+            records = open_chunk(path)
+            if self.__msg_keys is not None:
+                extended = (records['flags'] & FLAG_EXTENDED).astype(np.uint32) << 29
+                records = records[np.isin(records['arbitration_id'] | extended, self.__msg_keys)]
+            if not len(records):
+                continue
+            if first_timestamp is None:
+                first_timestamp = float(records['timestamp'][0])
+
+            timestamps = records['timestamp'].tolist()
+            ids = records['arbitration_id'].tolist()
+            flags = records['flags'].tolist()
+            dlcs = records['dlc'].tolist()
+            payloads = records['data'].tobytes()
+            for i, timestamp in enumerate(timestamps):
+                if not self.__running.is_set():
+                    return self.__finish(start)
+                msg = self.__build_msg(ids[i], flags[i], dlcs[i], payloads[i * 8:i * 8 + 8])
+
+                if speed:
+                    deadline = start + (timestamp - first_timestamp) / speed
+                    remaining = deadline - time.perf_counter()
+                    if remaining > spin_threshold:
+                        time.sleep(remaining - spin_threshold)
+                    if spin_threshold:
+                        while time.perf_counter() < deadline:
+                            pass
+                    error = time.perf_counter() - deadline
+                    timing_errors.observe(error)
+                    if error > self.__max_timing_error:
+                        self.__max_timing_error = error
+                try:
+                    self.__send(msg)
+                    self.__sent += 1
+                except can.CanError as e:
+                    self.__log_failure(msg, f"Failed to replay {msg}: {e}")
+                except Exception as e:
+                    # A failing send must not end the replay of the remaining frames
+                    self.__log_failure(msg, f"Failed to replay {hex(msg.arbitration_id)}: "
+                                            f"{type(e).__name__}: {e}")
+        self.__finish(start)
+
+    def __build_msg(self, msg_id, flags, dlc, data):
+        data = data[:min(dlc, 8)]
+        patch = self.__patches.get(msg_id)
+        if patch is not None:
+            codec, signals = patch
+            payload = bytearray(data.ljust(codec.length, b'\x00'))
+            try:
+                for signal_name, value in signals:
+                    codec.patch(payload, signal_name, value)
+                data = bytes(payload)
+            except (EncodeError, ValueError, OverflowError) as e:
+                # Replay the recorded payload rather than kill the thread
+                self.__patch_errors += 1
+                if self.__patch_errors == 1:
+                    self.logger.error(f"[{self.__class_name}] Failed to patch {hex(msg_id)}: {e}")
+        return can.Message(arbitration_id=msg_id, data=data, dlc=dlc,
+                           is_extended_id=bool(flags & FLAG_EXTENDED),
+                           is_remote_frame=bool(flags & FLAG_REMOTE),
+                           is_error_frame=bool(flags & FLAG_ERROR))
+
+    def __log_failure(self, msg, text):
+        self.__send_errors += 1
+        now = time.perf_counter()
+        last_log, suppressed = self.__failures.get(msg.arbitration_id, (None, 0))
+        if last_log is not None and now - last_log < FAILURE_LOG_INTERVAL:
+            self.__failures[msg.arbitration_id] = (last_log, suppressed + 1)
+            return
+        if suppressed:
+            text += f" ({suppressed} similar failures suppressed)"
+        self.logger.error(f"[{self.__class_name}] {text}")
+        self.__failures[msg.arbitration_id] = (now, 0)
+
+    def __finish(self, start):
+        self.__duration = time.perf_counter() - start
+        self.logger.info(f"[{self.__class_name}] Replayed {self.__sent} frames: {self.report}")
+
+    def stop(self):
+        self.__running.clear()
+        if self.is_alive():
+            self.join()
+
+    @property
+    def report(self):
+        # Achieved timing error of sends against their deadlines, in seconds
+        report = {"sent_frames": self.__sent, "patch_errors": self.__patch_errors,
+                  "send_errors": self.__send_errors,
+                  "duration": self.__duration}
+        timing_errors = self.__timing_errors.snapshot()
+        if timing_errors["count"]:
+            # p99 is the upper bound of the bucket holding it
+            p99 = self.__max_timing_error
+            threshold = 0.99 * timing_errors["count"]
+            seen = 0
+            for bound, count in zip(timing_errors["bounds"], timing_errors["counts"]):
+                seen += count
+                if seen >= threshold:
+                    p99 = min(bound, self.__max_timing_error)
+                    break
+            report.update({"mean_timing_error": timing_errors["sum"] / timing_errors["count"],
+                           "p99_timing_error": p99,
+                           "max_timing_error": self.__max_timing_error,
+                           "timing_error": timing_errors})
+        return report
+
+
+if __name__ == '__main__':
+    import argparse
+    import cantools
+    import os
+
+    parser = argparse.ArgumentParser(description="Replay a CanRecorder directory onto a CAN bus.")
+    parser.add_argument('record_dir')
+    parser.add_argument('--channel', default='vcan0')
+    parser.add_argument('--interface', default='socketcan')
+    parser.add_argument('--speed', type=float, default=1.0, help="0 replays as fast as possible")
+    parser.add_argument('--ids', nargs='*', help="Only replay these IDs, e.g. 0x488")
+    parser.add_argument('--dbc', default=os.path.join('res', 'tesla_can.dbc'))
+    parser.add_argument('--override', nargs='*', default=[], help="SIGNAL=VALUE")
+    parser.add_argument('--spin', type=float, default=0.0,
+                        help="Busy-wait this many seconds before each deadline instead of sleeping")
+    args = parser.parse_args()
+
+    overrides = {name: float(value) for name, value in
+                 (override.split('=', 1) for override in args.override)}
+    bus = can.interface.Bus(bustype=args.interface, channel=args.channel)
+    replay = CanReplay(args.record_dir, send=bus.send,
+                       dbc=cantools.database.load_file(args.dbc) if overrides else None,
+                       speed=args.speed,
+                       msg_ids=[int(msg_id, 16) for msg_id in args.ids] if args.ids else None,
+                       overrides=overrides, spin_threshold=args.spin)
+    replay.start()
+    replay.join()
+    bus.shutdown()
@@ -0,0 +1,342 @@
+from CAN_codec import get_codec, BIG_ENDIAN
+from CAN_metrics import CanHistogram, LATENCY_BUCKETS
+
+import heapq
+import itertools
+import json
+import operator
+import threading
+import time
+import logging
+_logger = logging.getLogger("CAN_responder")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+_OPERATORS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+              '>': operator.gt, '>=': operator.ge}
+_FLIPPED = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+
+"""
+Compiled conditions, each a callable(data, payload_ints) on the raw payload
+"""
+
+
+class _CanMaskCondition:
+    # (payload & mask) == value over the big-endian integer of the payload
+    def __init__(self, mask, value):
+        self.__mask = mask
+        self.__value = value
+
+    def __call__(self, data, big, little):
+        return big & self.__mask == self.__value
+
+
+class _CanSignalCondition:
+    """
+    Compares the raw field of a signal with a threshold converted to raw
+    once at compile time, so a frame is never scaled or decoded.
+    """
+
+    def __init__(self, codec, signal_name, op, value):
+        if op not in _OPERATORS and op != 'in':
+            raise ValueError(f"Unknown condition operator: {op}!")
+        self.__codec = codec
+        self.__layout = layout = codec.get_layout(signal_name)
+        if op == 'in':
+            self.__value = frozenset(self.__to_raw(item) for item in value)
+            self.__op = operator.contains
+            self.__reversed = True
+            return
+        if op in _FLIPPED and layout.scale < 0:
+            op = _FLIPPED[op]
+        if op in ('==', '!='):
+            self.__value = self.__to_raw(value)
+        else:
+            self.__value = (value - layout.offset) / layout.scale
+        self.__op = _OPERATORS[op]
+        self.__reversed = False
+
+    def __to_raw(self, value):
+        layout = self.__layout
+        if isinstance(value, str):
+            return layout.choice_to_number(value)
+        return layout.to_raw(value)
+
+    def __call__(self, data, big, little):
+        layout = self.__layout
+        if layout.multiplexer_ids is not None and not self.__codec.is_active(layout, data):
+            return False
+        raw = layout.raw_from_int(big if layout.byteorder == BIG_ENDIAN else little)
+        if self.__reversed:
+            return self.__op(self.__value, raw)
+        return self.__op(raw, self.__value)
+
+
+def _compile_condition(codec, condition):
+    if 'mask' in condition:
+        return _CanMaskCondition(int(condition['mask'], 16), int(condition['value'], 16))
+    return _CanSignalCondition(codec, condition['signal'], condition.get('op', '=='),
+                               condition['value'])
+
+
+"""
+Compiled actions
+"""
+
+
+class _CanCopySignal:
+    # Physical value of a trigger signal, e.g. to echo a request in the response
+    def __init__(self, codec, signal_name):
+        self.layout = codec.get_layout(signal_name)
+
+    def value(self, big, little):
+        layout = self.layout
+        raw = layout.raw_from_int(big if layout.byteorder == BIG_ENDIAN else little)
+        return raw * layout.scale + layout.offset
+
+
+class _CanModifyAction:
+    def __init__(self, trigger_codec, target_codec, signals, event):
+        self.msg_id = hex(target_codec.frame_id)
+        self.event = event
+        self.static = dict()
+        self.copies = dict()
+        for signal_name, value in signals.items():
+            if isinstance(value, dict):
+                self.copies[signal_name] = _CanCopySignal(trigger_codec, value['copy'])
+            elif isinstance(value, str):
+                # Choice names become physical values once, modify_signals expects numbers
+                layout = target_codec.get_layout(signal_name)
+                self.static[signal_name] = layout.choice_to_number(value) * layout.scale + layout.offset
+            else:
+                self.static[signal_name] = value
+
+    def can_data(self, big, little):
+        if not self.copies:
+            return self.static
+        can_data = dict(self.static)
+        for signal_name, copy in self.copies.items():
+            can_data[signal_name] = copy.value(big, little)
+        return can_data
+
+
+class CanResponseRule:
+    """
+    Trigger (an ID plus conditions on raw payload bits) and the actions run
+    when it matches. A "delay" action defers the actions after it to the
+    responder's timer thread, the ones before it run on the receive path.
+    With `edge` the rule only fires when its conditions become true.
+    """
+
+    def __init__(self, dbc, trigger, actions, edge=False, name=None):
+        self.msg_id = int(trigger['id'], 16)
+        self.name = name or f"{trigger['id']}"
+        codec = get_codec(dbc.get_message_by_frame_id(self.msg_id))
+        self.length = codec.length
+        self.conditions = tuple(_compile_condition(codec, condition)
+                                for condition in trigger.get('conditions', ()))
+        self.edge = edge
+        self.matched = False
+
+        # [(delay before this step, [actions])]
+        self.steps = [(0.0, [])]
+        for action in actions:
+            if 'delay' in action:
+                self.steps.append((float(action['delay']), []))
+                continue
+            if 'modify' in action:
+                spec, event = action['modify'], False
+            elif 'send' in action:
+                spec, event = action['send'], True
+            else:
+                raise ValueError(f"Unknown responder action: {action}!")
+            target_codec = get_codec(dbc.get_message_by_frame_id(int(spec['id'], 16)))
+            self.steps[-1][1].append(
+                _CanModifyAction(codec, target_codec, spec.get('signals', {}), event))
+
+        self.fired = 0
+        self.failed = 0
+        self.max_latency = 0.0
+        self.latency = CanHistogram(LATENCY_BUCKETS)
+
+    def match(self, data, big, little):
+        for condition in self.conditions:
+            if not condition(data, big, little):
+                self.matched = False
+                return False
+        if self.edge and self.matched:
+            return False
+        self.matched = True
+        return True
+
+    def stats(self):
+        latency = self.latency.snapshot()
+        return {"fired": self.fired,
+                "failed": self.failed,
+                "mean_latency": latency["sum"] / latency["count"] if latency["count"] else 0.0,
+                "max_latency": self.max_latency,
+                "latency": latency}
+
+
+def load_responder_rules(dbc, rules_json_path, logger=_logger):
+    """
+    [{"name": "epas_echo",
+      "trigger": {"id": "0x488",
+                  "conditions": [{"signal": "DAS_steeringControlType", "value": "ANGLE_CONTROL"}]},
+      "actions": [{"modify": {"id": "0x370",
+                              "signals": {"EPAS_internalSAS": {"copy": "DAS_steeringAngleRequest"}}}},
+                  {"delay": 0.01},
+                  {"send": {"id": "0x370", "signals": {"EPAS_eacErrorCode": "EAC_ERROR_IDLE"}}}],
+      "edge": false}]
+    """
+    with open(rules_json_path, 'r') as f:
+        rules_list = json.load(f)
+
+    rules = []
+    for index, rule_dict in enumerate(rules_list):
+        try:
+            rules.append(CanResponseRule(dbc, rule_dict['trigger'], rule_dict.get('actions', []),
+                                         edge=rule_dict.get('edge', False),
+                                         name=rule_dict.get('name')))
+        except (KeyError, TypeError, ValueError, OverflowError) as e:
+            logger.error(f"[load_responder_rules] Invalid responder rule {index}: {e}")
+    return rules
+
+
+class CanResponder:
+    """
+    Emulates an ECU on top of a CanManager: rules are compiled into a table
+    indexed by trigger ID, and one manager subscription per trigger ID
+    evaluates them on the receive path against the raw payload.
+
+    Responses go through CanManager.modify_tx_msg, so the target messages
+    must be in the manager's TX bundle; CanManager.start_responder rejects
+    rules targeting any other message. Latency is measured from the
+    receive timestamp of the trigger frame to the end of its immediate
+    actions.
+    """
+
+    def __init__(self, can_mgr, rules, logger=_logger):
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        self.__can_mgr = can_mgr
+        self.__rules = list(rules)
+        self.__table = dict()
+        for rule in self.__rules:
+            self.__table.setdefault(rule.msg_id, []).append(rule)
+        self.__table = {msg_id: tuple(rules) for msg_id, rules in self.__table.items()}
+        self.__subscriptions = []
+
+        self.__timers = []
+        self.__timer_ids = itertools.count()
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__timer_thread = None
+
+    def start(self):
+        self.__running = True
+        if any(len(rule.steps) > 1 for rule in self.__rules):
+            self.__timer_thread = threading.Thread(target=self.__run_timers, daemon=True)
+            self.__timer_thread.start()
+        for msg_id in self.__table:
+            self.__subscriptions.append(self.__can_mgr.subscribe_msg(msg_id, self.__on_trigger))
+
+    def stop(self):
+        for subscription in self.__subscriptions:
+            self.__can_mgr.unsubscribe(subscription)
+        self.__subscriptions = []
+        with self.__condition:
+            self.__running = False
+            self.__timers = []
+            self.__condition.notify()
+        if self.__timer_thread is not None:
+            self.__timer_thread.join()
+            self.__timer_thread = None
+
+    def __on_trigger(self, msg):
+        rules = self.__table.get(msg.arbitration_id)
+        if rules is None:
+            return
+        data = msg.data
+        big = int.from_bytes(data, 'big')
+        little = int.from_bytes(data, 'little')
+        for rule in rules:
+            if len(data) != rule.length or not rule.match(data, big, little):
+                continue
+            rule.fired += 1
+            self.__run_step(rule, 0, big, little)
+            latency = time.time() - msg.timestamp
+            rule.latency.observe(latency)
+            if latency > rule.max_latency:
+                rule.max_latency = latency
+
+    def __run_step(self, rule, index, big, little):
+        for action in rule.steps[index][1]:
+            if self.__can_mgr.modify_tx_msg(action.msg_id, action.can_data(big, little),
+                                            event=action.event) == -1:
+                rule.failed += 1
+        if index + 1 < len(rule.steps):
+            deadline = time.perf_counter() + rule.steps[index + 1][0]
+            with self.__condition:
+                heapq.heappush(self.__timers, (deadline, next(self.__timer_ids),
+                                               rule, index + 1, big, little))
+                self.__condition.notify()
+
+    def __run_timers(self):
+        while True:
+            with self.__condition:
+                while self.__running and (
+                        not self.__timers or self.__timers[0][0] > time.perf_counter()):
+                    timeout = self.__timers[0][0] - time.perf_counter() if self.__timers else None
+                    self.__condition.wait(timeout)
+                if not self.__running:
+                    return
+                _, _, rule, index, big, little = heapq.heappop(self.__timers)
+            try:
+                self.__run_step(rule, index, big, little)
+            except Exception as e:
+                self.logger.exception(f"[{self.__class_name}] Delayed response of {rule.name} failed: {e}")
+
+    @property
+    def stats(self):
+        return {rule.name: rule.stats() for rule in self.__rules}
+
+
+if __name__ == '__main__':
+    import can
+    import os
+    from CAN_manager import CanManager
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    init_tx_msgs_path = os.path.join(cwd, r'res/init_tx_msgs.json')
+
+    # Emulate EPAS: echo the steering angle request of DAS_steeringControl in EPAS_sysStatus
+    can_mgr = CanManager(dbc_path=dbc_path, init_tx_msgs_json_path=init_tx_msgs_path,
+                         last_modified_tx_msgs_json_path=os.devnull,
+                         channel='responder_demo', interface='virtual')
+    responder = can_mgr.start_responder(os.path.join(cwd, r'res/responder_rules.json'),
+                                        tx_msgs_json_path=os.path.join(cwd, r'res/responder_tx_msgs.json'))
+    can_mgr.start()
+    sender = can.interface.Bus(interface='virtual', channel='responder_demo')
+    msg_dbc = can_mgr.dbc.get_message_by_frame_id(0x488)
+    for angle in range(-50, 50):
+        sender.send(can.Message(arbitration_id=0x488, is_extended_id=False, data=msg_dbc.encode({
+            "DAS_steeringHapticRequest": 0, "DAS_steeringAngleRequest": angle,
+            "DAS_steeringControlType": 1, "DAS_steeringControlCounter": 0,
+            "DAS_steeringControlChecksum": 0})))
+        time.sleep(0.002)
+    time.sleep(0.1)
+    for name, stats in responder.stats.items():
+        print(f"{name}: fired {stats['fired']}, mean {stats['mean_latency'] * 1e6:.0f} us, "
+              f"max {stats['max_latency'] * 1e6:.0f} us")
+    sender.shutdown()
+    can_mgr.stop()
@@ -0,0 +1,129 @@
+from collections import deque
+
+import threading
+import logging
+_logger = logging.getLogger("CAN_rx_dispatcher")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+class _CanRxShard:
+    def __init__(self):
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.high_water = 0
+
+
+class CanRxDispatcher:
+    """
+    Hands received frames from the receive thread to a pool of callback workers.
+
+    Each worker owns a bounded queue and frames are sharded by arbitration ID,
+    so frames of one ID are always handled by the same worker in order.
+    Workers pass up to `batch_size` frames at a time to the callback. When a
+    queue is full, `overflow_policy` decides whether the oldest queued frame
+    is dropped, the new frame is dropped, or the receive thread blocks.
+    """
+
+    def __init__(self, callback, workers=1, queue_size=4096, batch_size=64,
+                 overflow_policy=DROP_OLDEST, logger=_logger):
+        if overflow_policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError(
+                f"[{self.__class__.__name__}] Unknown overflow policy: {overflow_policy}!")
+        for name, value in (('workers', workers), ('queue_size', queue_size), ('batch_size', batch_size)):
+            if value < 1:
+                raise ValueError(f"[{self.__class__.__name__}] {name} must be at least 1, got {value}!")
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        self.__callback = callback
+        self.__queue_size = queue_size
+        self.__batch_size = batch_size
+        self.__overflow_policy = overflow_policy
+        self.__shards = [_CanRxShard() for _ in range(workers)]
+        self.__threads = [threading.Thread(target=self.__work, args=(shard,), daemon=True)
+                          for shard in self.__shards]
+        self.__running = False
+
+    def start(self):
+        self.__running = True
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self):
+        self.__running = False
+        for shard in self.__shards:
+            with shard.condition:
+                shard.condition.notify_all()
+        for thread in self.__threads:
+            if thread.is_alive():
+                thread.join()
+
+    def put(self, msgs):
+        if len(self.__shards) == 1:
+            self.__put_shard(self.__shards[0], msgs)
+            return
+
+        shard_count = len(self.__shards)
+        grouped = dict()
+        for msg in msgs:
+            grouped.setdefault(msg.arbitration_id % shard_count, []).append(msg)
+        for index, shard_msgs in grouped.items():
+            self.__put_shard(self.__shards[index], shard_msgs)
+
+    def __put_shard(self, shard, msgs):
+        queue = shard.queue
+        with shard.condition:
+            for msg in msgs:
+                if len(queue) >= self.__queue_size:
+                    if self.__overflow_policy == DROP_OLDEST:
+                        queue.popleft()
+                        shard.dropped += 1
+                    elif self.__overflow_policy == DROP_NEWEST:
+                        shard.dropped += 1
+                        continue
+                    else:
+                        while len(queue) >= self.__queue_size and self.__running:
+                            shard.condition.wait()
+                queue.append(msg)
+            if len(queue) > shard.high_water:
+                shard.high_water = len(queue)
+            shard.condition.notify_all()
+
+    def __work(self, shard):
+        queue = shard.queue
+        while True:
+            with shard.condition:
+                while not queue and self.__running:
+                    shard.condition.wait()
+                if not queue:
+                    return
+                count = min(len(queue), self.__batch_size)
+                batch = [queue.popleft() for _ in range(count)]
+                if self.__overflow_policy == BLOCK:
+                    shard.condition.notify_all()
+
+            try:
+                self.__callback(batch)
+            except Exception as e:
+                self.logger.exception(
+                    f"[{self.__class_name}] Receive callback failed: {e}")
+
+    @property
+    def stats(self):
+        return {"dropped_frames": sum(shard.dropped for shard in self.__shards),
+                "queue_high_water": max(shard.high_water for shard in self.__shards),
+                "queued_frames": sum(len(shard.queue) for shard in self.__shards),
+                "workers": len(self.__shards),
+                "overflow_policy": self.__overflow_policy}
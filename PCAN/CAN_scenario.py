@@ -0,0 +1,274 @@
+from CAN_codec import get_codec, BIG_ENDIAN
+
+import csv
+import json
+import numpy as np
+import os
+import threading
+
+"""
+Trajectories: vectorized physical value of one signal over scenario time
+"""
+
+
+class CanRamp:
+    def __init__(self, start, end, duration, delay=0.0):
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.delay = delay
+
+    def values(self, times):
+        progress = np.clip((times - self.delay) / self.duration, 0.0, 1.0) if self.duration else \
+            (times >= self.delay).astype(np.float64)
+        return self.start + (self.end - self.start) * progress
+
+
+class CanSine:
+    def __init__(self, amplitude, frequency, offset=0.0, phase=0.0):
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.offset = offset
+        self.phase = phase
+
+    def values(self, times):
+        return self.offset + self.amplitude * np.sin(2 * np.pi * self.frequency * times + self.phase)
+
+
+class CanStep:
+    def __init__(self, before, after, at):
+        self.before = before
+        self.after = after
+        self.at = at
+
+    def values(self, times):
+        return np.where(times < self.at, self.before, self.after).astype(np.float64)
+
+
+class CanTable:
+    # Piecewise table of (time, value) points, linear or held between points
+    def __init__(self, points, interpolate=True):
+        points = sorted(points)
+        self.times = np.array([point[0] for point in points], dtype=np.float64)
+        self.points = np.array([point[1] for point in points], dtype=np.float64)
+        self.interpolate = interpolate
+
+    def values(self, times):
+        if self.interpolate:
+            return np.interp(times, self.times, self.points)
+        index = np.clip(np.searchsorted(self.times, times, side='right') - 1, 0, len(self.points) - 1)
+        return self.points[index]
+
+
+def load_csv_trajectory(path, column, time_column='time', interpolate=True):
+    with open(path, 'r', newline='') as f:
+        rows = list(csv.DictReader(f))
+    return CanTable([(float(row[time_column]), float(row[column])) for row in rows],
+                    interpolate=interpolate)
+
+
+_TRAJECTORIES = {'ramp': CanRamp, 'sine': CanSine, 'step': CanStep}
+
+
+def load_trajectory(spec, base_dir='.'):
+    spec = dict(spec)
+    kind = spec.pop('type')
+    if kind == 'table':
+        return CanTable(spec['points'], interpolate=spec.get('interpolate', True))
+    if kind == 'csv':
+        return load_csv_trajectory(os.path.join(base_dir, spec['path']), spec['column'],
+                                   time_column=spec.get('time_column', 'time'),
+                                   interpolate=spec.get('interpolate', True))
+    if kind not in _TRAJECTORIES:
+        raise ValueError(f"Unknown trajectory type: {kind}!")
+    return _TRAJECTORIES[kind](**spec)
+
+
+class CanScenario:
+    """
+    Declarative signal trajectories over `duration` seconds.
+
+    render() turns them into one precomputed payload per cycle of each
+    affected message, starting from the message's current payload so other
+    signals keep their values. Integer signals are converted and packed with
+    NumPy over the whole sequence; only float signals are packed value by
+    value. Out-of-range values fail at render time, not on the bus.
+    """
+
+    def __init__(self, trajectories, duration, name=None):
+        self.trajectories = dict(trajectories)
+        self.duration = duration
+        self.name = name
+
+    @classmethod
+    def from_dict(cls, spec, base_dir='.'):
+        trajectories = {signal_name: load_trajectory(trajectory, base_dir)
+                        for signal_name, trajectory in spec['signals'].items()}
+        return cls(trajectories, spec['duration'], name=spec.get('name'))
+
+    def msg_ids(self, dbc):
+        return {_find_signal_message(dbc, signal_name).frame_id for signal_name in self.trajectories}
+
+    def render(self, dbc, base_payloads, periods, start_times=None):
+        # msg_id -> N x length uint8 array, one row per cycle of that message
+        start_times = start_times or dict()
+        grouped = dict()
+        for signal_name, trajectory in self.trajectories.items():
+            msg_dbc = _find_signal_message(dbc, signal_name)
+            grouped.setdefault(msg_dbc.frame_id, (msg_dbc, []))[1].append((signal_name, trajectory))
+
+        rendered = dict()
+        for msg_id, (msg_dbc, signals) in grouped.items():
+            codec = get_codec(msg_dbc)
+            period = periods[msg_id]
+            start = start_times.get(msg_id, 0.0)
+            times = np.arange(start, self.duration, period)
+            base = np.frombuffer(bytes(base_payloads[msg_id]).ljust(codec.length, b'\x00'),
+                                 dtype=np.uint8)[:codec.length]
+            payloads = np.tile(base, (len(times), 1))
+            for signal_name, trajectory in signals:
+                layout = codec.get_layout(signal_name)
+                values = np.broadcast_to(np.asarray(trajectory.values(times), dtype=np.float64),
+                                         times.shape)
+                _pack(payloads, layout, _to_bits(layout, values))
+            rendered[msg_id] = payloads
+        return rendered
+
+
+class CanScenarioChain:
+    """
+    Scenarios played one after another. A message only driven by some of
+    them keeps sending its last payload while the others run.
+    """
+
+    def __init__(self, scenarios):
+        self.scenarios = list(scenarios)
+        self.duration = sum(scenario.duration for scenario in self.scenarios)
+
+    def msg_ids(self, dbc):
+        return set().union(*(scenario.msg_ids(dbc) for scenario in self.scenarios))
+
+    def render(self, dbc, base_payloads, periods):
+        msg_ids = self.msg_ids(dbc)
+        parts = {msg_id: [] for msg_id in msg_ids}
+        last_payloads = {msg_id: bytes(base_payloads[msg_id]) for msg_id in msg_ids}
+        # Carry each message's phase so cycles stay evenly spaced across segments
+        offsets = {msg_id: 0.0 for msg_id in msg_ids}
+        for scenario in self.scenarios:
+            rendered = scenario.render(dbc, last_payloads, periods, start_times=offsets)
+            for msg_id in msg_ids:
+                period = periods[msg_id]
+                cycles = len(np.arange(offsets[msg_id], scenario.duration, period))
+                if msg_id in rendered:
+                    rows = rendered[msg_id]
+                else:
+                    base = np.frombuffer(last_payloads[msg_id], dtype=np.uint8)
+                    rows = np.tile(base, (cycles, 1))
+                if len(rows):
+                    parts[msg_id].append(rows)
+                    last_payloads[msg_id] = rows[-1].tobytes()
+                offsets[msg_id] = offsets[msg_id] + cycles * period - scenario.duration
+        return {msg_id: np.concatenate(rows) for msg_id, rows in parts.items() if rows}
+
+
+def load_scenario(path):
+    # A JSON file holding one scenario, or {"scenarios": [...]} to chain several
+    with open(path, 'r') as f:
+        spec = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    if 'scenarios' in spec:
+        return CanScenarioChain([CanScenario.from_dict(item, base_dir) for item in spec['scenarios']])
+    return CanScenario.from_dict(spec, base_dir)
+
+
+def _find_signal_message(dbc, signal_name):
+    for msg_dbc in dbc.messages:
+        for signal in msg_dbc.signals:
+            if signal.name == signal_name:
+                return msg_dbc
+    raise KeyError(f"Signal {signal_name} is not in the DBC!")
+
+
+def _to_bits(layout, values):
+    if layout.minimum is not None and np.any(values < layout.minimum - layout.tolerance) or \
+            layout.maximum is not None and np.any(values > layout.maximum + layout.tolerance):
+        raise ValueError(f"Trajectory of {layout.name} leaves [{layout.minimum}, {layout.maximum}]!")
+    if layout.is_float:
+        return np.array([layout.physical_to_bits(float(value)) for value in values], dtype=np.uint64)
+
+    raw = np.round((values - layout.offset) / layout.scale).astype(np.int64)
+    if layout.is_signed:
+        limit = 1 << (layout.length - 1)
+        low, high = -limit, limit - 1
+    else:
+        low, high = 0, layout.value_mask
+    if len(raw) and (raw.min() < low or raw.max() > high):
+        raise ValueError(f"Trajectory of {layout.name} does not fit in {layout.length} bits!")
+    return raw.astype(np.uint64) & np.uint64(layout.value_mask)
+
+
+def _pack(payloads, layout, bits):
+    length = payloads.shape[1]
+    columns = range(length) if layout.byteorder == BIG_ENDIAN else range(length - 1, -1, -1)
+    packed = np.zeros(len(payloads), dtype=np.uint64)
+    for i in columns:
+        packed = (packed << np.uint64(8)) | payloads[:, i]
+    packed = (packed & ~np.uint64(layout.mask)) | (bits << np.uint64(layout.shift))
+    for i in reversed(columns):
+        payloads[:, i] = (packed & np.uint64(0xff)).astype(np.uint8)
+        packed >>= np.uint64(8)
+
+
+class CanScenarioPlayer:
+    """
+    Frame modifier of one message that copies the next pre-rendered payload
+    into the outgoing frame, so playback does no encoding at all. After the
+    last row the final payload is held, or playback restarts with `loop`.
+    """
+
+    def __init__(self, payloads, loop=False, modifier=None, on_finished=None):
+        self.__rows = [row.tobytes() for row in payloads]
+        self.__loop = loop
+        self.__modifier = modifier  # e.g. counter/checksum rules, applied after the payload
+        self.__on_finished = on_finished
+        self.__index = 0
+        self.finished = threading.Event()
+
+    def apply(self, msg):
+        index = self.__index
+        if index < len(self.__rows):
+            msg.data[:] = self.__rows[index]
+            index += 1
+            if index == len(self.__rows):
+                if self.__loop:
+                    index = 0
+                else:
+                    self.finished.set()
+                    if self.__on_finished is not None:
+                        self.__on_finished()
+            self.__index = index
+        if self.__modifier is not None:
+            self.__modifier(msg)
+
+    @property
+    def progress(self):
+        return self.__index, len(self.__rows)
+
+
+if __name__ == '__main__':
+    import cantools
+    import time
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    dbc = cantools.database.load_file(dbc_path)
+    codec = get_codec(dbc.get_message_by_name('DAS_steeringControl'))
+
+    sweep = CanScenarioChain([
+        CanScenario({'DAS_steeringAngleRequest': CanRamp(0, 90, duration=1.0)}, duration=1.0),
+        CanScenario({'DAS_steeringAngleRequest': CanSine(amplitude=90, frequency=0.5)}, duration=10.0)])
+    start = time.perf_counter()
+    rendered = sweep.render(dbc, {0x488: bytes.fromhex('de594407')}, {0x488: 0.01})
+    print(f"Rendered {len(rendered[0x488])} frames in {(time.perf_counter() - start) * 1000:.1f} ms")
+    for row in rendered[0x488][::250]:
+        print(f"{row.tobytes().hex()} -> {codec.msg_dbc.decode(row.tobytes())['DAS_steeringAngleRequest']}")
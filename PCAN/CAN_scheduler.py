@@ -0,0 +1,243 @@
+import can
+import heapq
+import threading
+import time
+import logging
+_logger = logging.getLogger("CAN_scheduler")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+# Failures of one message are logged at most once per interval
+FAILURE_LOG_INTERVAL = 1.0
+
+
+def _phase_fraction(index):
+    # van der Corput sequence: 0, 1/2, 1/4, 3/4, 1/8, ... spreads any number
+    # of messages sharing a period evenly over that period
+    fraction, denominator = 0.0, 1.0
+    while index:
+        denominator *= 2
+        index, remainder = divmod(index, 2)
+        fraction += remainder / denominator
+    return fraction
+
+
+class CanTxTask:
+    """
+    Periodic message driven by a CanTxScheduler.
+
+    Offers the `stop`/`start`/`modify_data` calls CanTransceiver uses on
+    python-can cyclic tasks, so both can live in the same task table.
+    """
+
+    def __init__(self, scheduler, msg, period, phase, modifier=None):
+        self.__scheduler = scheduler
+        self.msg = msg
+        self.modifier = modifier
+        self.period = period
+        self.phase = phase
+        self.running = True
+        self.generation = 0
+
+    @property
+    def arbitration_id(self):
+        return self.msg.arbitration_id
+
+    def stop(self):
+        self.__scheduler.stop_task(self)
+
+    def start(self):
+        self.__scheduler.start_task(self)
+
+    def modify_data(self, msg):
+        # Swapping the reference is atomic, the next cycle sends the new frame
+        self.msg = msg
+
+
+class CanTxScheduler(threading.Thread):
+    """
+    Sends every periodic message from a single thread.
+
+    Deadlines live in a heap ordered by due time. Each deadline advances by
+    exactly one period so there is no cumulative drift, and messages sharing
+    a period are phase-offset so they don't go out in one burst.
+    """
+
+    def __init__(self, bus, logger=_logger):
+        super(CanTxScheduler, self).__init__(daemon=True)
+        self.__class_name = self.__class__.__name__
+        self.logger = logger
+        self.__bus = bus
+        self.__heap = []
+        self.__sequence = 0
+        self.__tasks = dict()
+        self.__period_counts = dict()
+        self.__condition = threading.Condition()
+        self.__epoch = time.perf_counter()
+        self.__paused = False
+        self.__running = True
+        self.__failures = dict()
+
+    def add_task(self, msg, period, modifier=None):
+        with self.__condition:
+            index = self.__period_counts.get(period, 0)
+            self.__period_counts[period] = index + 1
+            task = CanTxTask(scheduler=self, msg=msg, period=period,
+                             phase=_phase_fraction(index) * period, modifier=modifier)
+            self.__tasks[msg.arbitration_id] = task
+            self.__schedule(task, time.perf_counter())
+            self.__condition.notify()
+        return task
+
+    def remove_task(self, msg_id):
+        with self.__condition:
+            task = self.__tasks.pop(msg_id, None)
+            if task is not None:
+                task.running = False
+                task.generation += 1
+
+    def stop_task(self, task):
+        with self.__condition:
+            task.running = False
+            task.generation += 1
+
+    def start_task(self, task):
+        with self.__condition:
+            if task.running:
+                return
+            task.running = True
+            task.generation += 1
+            self.__schedule(task, time.perf_counter())
+            self.__condition.notify()
+
+    def pause(self):
+        with self.__condition:
+            self.__paused = True
+
+    def resume(self):
+        with self.__condition:
+            if not self.__paused:
+                return
+            self.__paused = False
+            now = time.perf_counter()
+            # Rebuild deadlines so paused cycles are not sent in a burst
+            self.__heap = []
+            for task in self.__tasks.values():
+                if task.running:
+                    task.generation += 1
+                    self.__schedule(task, now)
+            self.__condition.notify()
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while True:
+            with self.__condition:
+                task = self.__next_due_task()
+                if task is None:
+                    return
+                msg = task.msg
+                modifier = task.modifier
+
+            try:
+                if modifier is not None:
+                    modifier(msg)
+                self.__bus.send(msg)
+            except can.CanError as e:
+                self.__log_failure(msg, f"Failed to send {hex(msg.arbitration_id)}: {e}")
+            except Exception as e:
+                # A broken modifier must not stop the other periodic messages
+                self.__log_failure(msg, f"Modifier of {hex(msg.arbitration_id)} failed: "
+                                        f"{type(e).__name__}: {e}")
+
+    def __log_failure(self, msg, text):
+        now = time.perf_counter()
+        last_log, suppressed = self.__failures.get(msg.arbitration_id, (None, 0))
+        if last_log is not None and now - last_log < FAILURE_LOG_INTERVAL:
+            self.__failures[msg.arbitration_id] = (last_log, suppressed + 1)
+            return
+        if suppressed:
+            text += f" ({suppressed} similar failures suppressed)"
+        self.logger.warning(f"[{self.__class_name}] {text}")
+        self.__failures[msg.arbitration_id] = (now, 0)
+
+    def __next_due_task(self):
+        # Called with the condition held, blocks until a task is due
+        while self.__running:
+            if self.__paused or not self.__heap:
+                self.__condition.wait()
+                continue
+
+            deadline, _, generation, task = self.__heap[0]
+            if generation != task.generation:
+                heapq.heappop(self.__heap)
+                continue
+
+            now = time.perf_counter()
+            if deadline > now:
+                self.__condition.wait(deadline - now)
+                continue
+
+            heapq.heappop(self.__heap)
+            next_deadline = deadline + task.period
+            if next_deadline <= now:
+                # Fell behind by more than one period, skip missed cycles
+                missed = int((now - deadline) // task.period)
+                next_deadline = deadline + (missed + 1) * task.period
+            self.__push(task, next_deadline)
+            return task
+        return None
+
+    def __schedule(self, task, now):
+        # First deadline on the task's phase grid after `now`
+        elapsed = now - self.__epoch - task.phase
+        cycles = max(0, int(elapsed // task.period) + 1)
+        self.__push(task, self.__epoch + task.phase + cycles * task.period)
+
+    def __push(self, task, deadline):
+        self.__sequence += 1
+        heapq.heappush(self.__heap, (deadline, self.__sequence, task.generation, task))
+
+    @property
+    def tasks(self):
+        return self.__tasks
+
+    @property
+    def paused(self):
+        return self.__paused
+
+
+if __name__ == '__main__':
+    bus = can.interface.Bus(interface='virtual', channel='scheduler_demo')
+    listener = can.interface.Bus(interface='virtual', channel='scheduler_demo')
+    scheduler = CanTxScheduler(bus)
+    for msg_id in range(1, 9):
+        scheduler.add_task(can.Message(arbitration_id=msg_id, data=[msg_id] * 8,
+                                       is_extended_id=False), period=0.01)
+    scheduler.start()
+    time.sleep(1)
+    scheduler.stop()
+
+    stamps = dict()
+    msg = listener.recv(timeout=0)
+    while msg is not None:
+        stamps.setdefault(msg.arbitration_id, []).append(msg.timestamp)
+        msg = listener.recv(timeout=0)
+    for msg_id in sorted(stamps):
+        intervals = [b - a for a, b in zip(stamps[msg_id], stamps[msg_id][1:])]
+        print(f"{hex(msg_id)}: {len(stamps[msg_id])} frames, "
+              f"mean interval {sum(intervals) / len(intervals) * 1000:.3f} ms")
+    bus.shutdown()
+    listener.shutdown()
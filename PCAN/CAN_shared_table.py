@@ -0,0 +1,321 @@
+from CAN_codec import get_codec, BIG_ENDIAN
+
+from multiprocessing import shared_memory
+import hashlib
+import mmap
+import numpy as np
+import os
+import struct
+import threading
+import time
+
+"""
+Segment layout, every region 8 byte aligned:
+    header      magic, version, message count, signal count, writer PID, layout hash
+    sequences   uint64 per message, odd while the writer updates it
+    values      float64 per signal
+    timestamps  float64 per signal
+    counts      uint64 per signal
+Signals are ordered by frame ID, then by their order in the DBC, so a
+reader with the same DBC finds every slot without any lookup in the segment.
+"""
+SHARED_TABLE_MAGIC = b'PCANSHM\x00'
+SHARED_TABLE_VERSION = 2
+_HEADER = struct.Struct('<8sIIII32s')
+DEFAULT_SHARED_TABLE_NAME = 'pcan_signals'
+# How long a reader retries a message whose sequence stays odd, e.g. after the writer died mid-update
+DEFAULT_READ_TIMEOUT = 0.1
+SHARED_MEMORY_DIR = '/dev/shm'
+
+
+def _table_layout(dbc, msg_ids=None):
+    # [(frame_id, msg_dbc, [signal names])] in slot order
+    layout = []
+    for msg_dbc in sorted(dbc.messages, key=lambda msg_dbc: msg_dbc.frame_id):
+        if msg_ids is not None and msg_dbc.frame_id not in msg_ids:
+            continue
+        layout.append((msg_dbc.frame_id, msg_dbc, [signal.name for signal in msg_dbc.signals]))
+    return layout
+
+
+def _layout_hash(layout):
+    digest = hashlib.sha256()
+    for frame_id, _, signal_names in layout:
+        digest.update(f"{frame_id}:{','.join(signal_names)};".encode())
+    return digest.digest()
+
+
+def _process_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Alive, owned by another user
+    return True
+
+
+def _regions(msg_count, signal_count):
+    offset = _HEADER.size
+    regions = dict()
+    for name, count in (('sequences', msg_count), ('values', signal_count),
+                        ('timestamps', signal_count), ('counts', signal_count)):
+        regions[name] = (offset, count * 8)
+        offset += count * 8
+    return regions, offset
+
+
+class _CanSharedTableBase:
+    def __init__(self, dbc, msg_ids):
+        self._layout = _table_layout(dbc, msg_ids)
+        self._msg_index = dict()
+        self._signal_slots = dict()  # signal name -> (message index, signal index)
+        signal_index = 0
+        for msg_index, (frame_id, _, signal_names) in enumerate(self._layout):
+            self._msg_index[frame_id] = msg_index
+            for signal_name in signal_names:
+                # Signal names are unique across the Tesla DBC, keep the first one otherwise
+                self._signal_slots.setdefault(signal_name, (msg_index, signal_index))
+                signal_index += 1
+        self._signal_count = signal_index
+        self._regions, self._size = _regions(len(self._layout), signal_index)
+
+    def _view(self, buffer, region, fmt):
+        offset, size = self._regions[region]
+        return memoryview(buffer)[offset:offset + size].cast(fmt)
+
+    def _array(self, buffer, region, dtype):
+        offset, size = self._regions[region]
+        return np.ndarray(size // 8, dtype=dtype, buffer=buffer, offset=offset)
+
+    @property
+    def signal_names(self):
+        return list(self._signal_slots)
+
+
+class CanSharedSignalTable(_CanSharedTableBase):
+    """
+    Publishes the latest physical value, timestamp and update count of every
+    DBC signal into a named shared memory segment.
+
+    Each message has its own sequence number: the writer makes it odd,
+    writes the slots of that message and makes it even again. Readers in
+    other processes copy straight out of the mapping and retry while the
+    sequence is odd or changed, so they never lock or make syscalls. On the
+    writer side a lock only keeps close() from releasing the mapping under
+    an update() still running on the receive path.
+
+    The header records the writer's PID. An existing segment of the same
+    name is only taken over once that writer is dead; while it is alive,
+    FileExistsError is raised.
+    """
+
+    def __init__(self, dbc, name=DEFAULT_SHARED_TABLE_NAME, msg_ids=None):
+        super(CanSharedSignalTable, self).__init__(dbc, msg_ids)
+        try:
+            self.__shm = shared_memory.SharedMemory(name=name, create=True, size=self._size)
+        except FileExistsError:
+            # Read the header as a plain file, attaching with SharedMemory would register
+            # the segment with this process's resource tracker, which unlinks it on exit
+            with open(os.path.join(SHARED_MEMORY_DIR, name.lstrip('/')), 'rb') as f:
+                header = f.read(_HEADER.size)
+            pid = 0
+            if len(header) == _HEADER.size:
+                magic, version, _, _, pid, _ = _HEADER.unpack(header)
+                if magic != SHARED_TABLE_MAGIC or version != SHARED_TABLE_VERSION:
+                    pid = 0
+            if _process_alive(pid):
+                raise FileExistsError(
+                    f"Shared table {name} is already published by running process {pid}!")
+            # Left behind by a crashed writer, take it over
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.__shm = shared_memory.SharedMemory(name=name, create=True, size=self._size)
+        _HEADER.pack_into(self.__shm.buf, 0, SHARED_TABLE_MAGIC, SHARED_TABLE_VERSION,
+                          len(self._layout), self._signal_count, os.getpid(),
+                          _layout_hash(self._layout))
+
+        self.__sequences = self._view(self.__shm.buf, 'sequences', 'Q')
+        self.__values = self._view(self.__shm.buf, 'values', 'd')
+        self.__timestamps = self._view(self.__shm.buf, 'timestamps', 'd')
+        self.__counts = self._view(self.__shm.buf, 'counts', 'Q')
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+        self.__plans = dict()
+        signal_index = 0
+        for msg_index, (frame_id, msg_dbc, signal_names) in enumerate(self._layout):
+            codec = get_codec(msg_dbc)
+            entries = []
+            for signal_name in signal_names:
+                entries.append((signal_index, codec.get_layout(signal_name)))
+                signal_index += 1
+            self.__plans[frame_id] = (msg_index, codec, entries)
+
+    def update(self, msg):
+        plan = self.__plans.get(msg.arbitration_id)
+        if plan is None:
+            return
+        msg_index, codec, entries = plan
+        data = msg.data
+        if len(data) != codec.length:
+            data = bytes(data[:codec.length]).ljust(codec.length, b'\x00')
+        big = int.from_bytes(data, 'big')
+        little = int.from_bytes(data, 'little')
+        timestamp = msg.timestamp
+        values = self.__values
+        timestamps = self.__timestamps
+        counts = self.__counts
+        sequences = self.__sequences
+
+        with self.__lock:
+            if self.__closed:
+                return
+            sequences[msg_index] += 1
+            for signal_index, layout in entries:
+                if layout.multiplexer_ids is not None and not codec.is_active(layout, data):
+                    continue
+                raw = layout.raw_from_int(big if layout.byteorder == BIG_ENDIAN else little)
+                values[signal_index] = raw * layout.scale + layout.offset
+                timestamps[signal_index] = timestamp
+                counts[signal_index] += 1
+            sequences[msg_index] += 1
+
+    def close(self):
+        # Readers keep their mapping, new readers can no longer attach
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            for view in (self.__sequences, self.__values, self.__timestamps, self.__counts):
+                view.release()
+        self.__shm.close()
+        try:
+            self.__shm.unlink()
+        except FileNotFoundError:
+            pass  # Already removed, e.g. by hand from /dev/shm
+
+    @property
+    def name(self):
+        return self.__shm.name
+
+    @property
+    def size(self):
+        return self._size
+
+
+class CanSharedSignalReader(_CanSharedTableBase):
+    """
+    Reads a CanSharedSignalTable from any process, given the same DBC (and
+    msg_ids) as the writer. Refuses to attach to a segment of another layout.
+
+    The segment is mapped read-only straight from /dev/shm rather than with
+    SharedMemory, whose resource tracker would unlink the writer's segment
+    when the reader exits.
+    """
+
+    def __init__(self, dbc, name=DEFAULT_SHARED_TABLE_NAME, msg_ids=None):
+        super(CanSharedSignalReader, self).__init__(dbc, msg_ids)
+        with open(os.path.join(SHARED_MEMORY_DIR, name.lstrip('/')), 'rb') as f:
+            self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, msg_count, signal_count, _, layout_hash = _HEADER.unpack_from(self.__mmap, 0)
+        if magic != SHARED_TABLE_MAGIC or version != SHARED_TABLE_VERSION or \
+                layout_hash != _layout_hash(self._layout) or len(self.__mmap) < self._size:
+            self.__mmap.close()
+            raise ValueError(f"Shared memory {name} was not written with this DBC layout!")
+
+        self.__sequences = self._array(self.__mmap, 'sequences', np.uint64)
+        self.__values = self._array(self.__mmap, 'values', np.float64)
+        self.__timestamps = self._array(self.__mmap, 'timestamps', np.float64)
+        self.__counts = self._array(self.__mmap, 'counts', np.uint64)
+        # Scalar reads through memoryviews are several times cheaper than NumPy indexing
+        self.__sequence_view = self._view(self.__mmap, 'sequences', 'Q')
+        self.__value_view = self._view(self.__mmap, 'values', 'd')
+        self.__timestamp_view = self._view(self.__mmap, 'timestamps', 'd')
+        self.__count_view = self._view(self.__mmap, 'counts', 'Q')
+
+    def get(self, signal_name, timeout=DEFAULT_READ_TIMEOUT):
+        # (value, timestamp, count) of one signal, consistent with its message
+        msg_index, signal_index = self._signal_slots[signal_name]
+        sequences = self.__sequence_view
+        deadline = None
+        while True:
+            sequence = sequences[msg_index]
+            if not sequence & 1:
+                result = (self.__value_view[signal_index], self.__timestamp_view[signal_index],
+                          self.__count_view[signal_index])
+                if sequence == sequences[msg_index]:
+                    return result
+            deadline = self.__retry(deadline, timeout, signal_name)
+
+    def get_value(self, signal_name, timeout=DEFAULT_READ_TIMEOUT):
+        return self.get(signal_name, timeout)[0]
+
+    def snapshot(self, timeout=DEFAULT_READ_TIMEOUT):
+        # Copies of the value, timestamp and count arrays, each message internally consistent
+        deadline = None
+        while True:
+            before = self.__sequences.copy()
+            values = self.__values.copy()
+            timestamps = self.__timestamps.copy()
+            counts = self.__counts.copy()
+            after = self.__sequences.copy()
+            if not np.any(before & np.uint64(1)) and np.array_equal(before, after):
+                return values, timestamps, counts
+            deadline = self.__retry(deadline, timeout, 'snapshot')
+
+    @staticmethod
+    def __retry(deadline, timeout, what):
+        # The clock is only read once a first attempt has failed
+        now = time.perf_counter()
+        if deadline is None:
+            deadline = now + timeout
+        elif now > deadline:
+            raise TimeoutError(f"Shared table {what} still being written after {timeout} s, "
+                               f"the writer may have died mid-update!")
+        time.sleep(0)
+        return deadline
+
+    def to_dict(self, timeout=DEFAULT_READ_TIMEOUT):
+        # Only signals that have been received at least once
+        values, _, counts = self.snapshot(timeout)
+        return {signal_name: float(values[signal_index])
+                for signal_name, (_, signal_index) in self._signal_slots.items()
+                if counts[signal_index]}
+
+    def signal_index(self, signal_name):
+        return self._signal_slots[signal_name][1]
+
+    def close(self):
+        self.__sequences = self.__values = self.__timestamps = self.__counts = None
+        for view in (self.__sequence_view, self.__value_view, self.__timestamp_view, self.__count_view):
+            view.release()
+        self.__mmap.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import cantools
+    import os
+
+    parser = argparse.ArgumentParser(description="Print the live signal table of a running CanManager.")
+    parser.add_argument('signals', nargs='*')
+    parser.add_argument('--dbc', default=os.path.join('res', 'tesla_can.dbc'))
+    parser.add_argument('--name', default=DEFAULT_SHARED_TABLE_NAME)
+    parser.add_argument('--interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    reader = CanSharedSignalReader(cantools.database.load_file(args.dbc), name=args.name)
+    try:
+        while True:
+            table = reader.to_dict()
+            if args.signals:
+                table = {name: table.get(name) for name in args.signals}
+            print(table)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        reader.close()
@@ -0,0 +1,212 @@
+from CAN_codec import get_codec
+
+import numpy as np
+import threading
+
+
+class CanSignalRingBuffer:
+    """
+    Fixed-size history of (timestamp, value) samples of one signal.
+
+    Window queries take either an absolute `since` timestamp or a `duration`
+    back from the newest sample. They work on views of at most two
+    contiguous segments of the ring, so only the window itself is ever copied.
+    """
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError(
+                f"[{self.__class__.__name__}] capacity must be positive, got {capacity}!")
+        self.__capacity = capacity
+        self.__timestamps = np.zeros(capacity, dtype=np.float64)
+        self.__values = np.zeros(capacity, dtype=np.float64)
+        self.__head = 0  # Next slot to write
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    def append(self, timestamp, value):
+        with self.__lock:
+            self.__timestamps[self.__head] = timestamp
+            self.__values[self.__head] = value
+            self.__head += 1
+            if self.__head == self.__capacity:
+                self.__head = 0
+            if self.__size < self.__capacity:
+                self.__size += 1
+
+    def window(self, since=None, duration=None):
+        with self.__lock:
+            segments = self.__window_segments(since, duration)
+            if not segments:
+                return np.empty(0), np.empty(0)
+            times = np.concatenate([self.__timestamps[seg] for seg in segments])
+            values = np.concatenate([self.__values[seg] for seg in segments])
+        return times, values
+
+    def min(self, since=None, duration=None):
+        return self.__reduce(np.min, min, since, duration)
+
+    def max(self, since=None, duration=None):
+        return self.__reduce(np.max, max, since, duration)
+
+    def mean(self, since=None, duration=None):
+        with self.__lock:
+            segments = self.__window_segments(since, duration)
+            count = sum(seg.stop - seg.start for seg in segments)
+            if not count:
+                return None
+            return float(sum(np.sum(self.__values[seg]) for seg in segments) / count)
+
+    def rate(self, since=None, duration=None):
+        # Average rate of change of the value over the window, per second
+        with self.__lock:
+            first, last = self.__window_ends(since, duration)
+            if first is None or self.__timestamps[last] == self.__timestamps[first]:
+                return None
+            return float((self.__values[last] - self.__values[first]) /
+                         (self.__timestamps[last] - self.__timestamps[first]))
+
+    def first_crossing(self, threshold, since=None, duration=None, direction='any'):
+        # Timestamp of the first sample where the value crosses the threshold
+        if direction not in ('any', 'rising', 'falling'):
+            raise ValueError(
+                f"[{self.__class__.__name__}] direction must be any, rising or falling, got {direction}!")
+        with self.__lock:
+            segments = self.__window_segments(since, duration)
+            previous = None
+            for seg in segments:
+                values = self.__values[seg]
+                if not len(values):
+                    continue
+                above = values >= threshold
+                if previous is not None:
+                    changes = np.flatnonzero(above != np.concatenate(([previous], above[:-1])))
+                else:
+                    changes = np.flatnonzero(above[1:] != above[:-1]) + 1
+                for change in changes:
+                    if direction == 'any' or (direction == 'rising') == bool(above[change]):
+                        return float(self.__timestamps[seg][change])
+                previous = above[-1]
+        return None
+
+    def __reduce(self, np_func, py_func, since, duration):
+        with self.__lock:
+            segments = self.__window_segments(since, duration)
+            partials = [np_func(self.__values[seg]) for seg in segments if seg.stop > seg.start]
+        if not partials:
+            return None
+        return float(py_func(partials))
+
+    def __window_ends(self, since, duration):
+        segments = [seg for seg in self.__window_segments(since, duration) if seg.stop > seg.start]
+        if not segments:
+            return None, None
+        return segments[0].start, segments[-1].stop - 1
+
+    def __window_segments(self, since, duration):
+        # Chronological slices of the ring covering timestamps >= since
+        if self.__size < self.__capacity:
+            segments = [slice(0, self.__size)]
+        else:
+            segments = [slice(self.__head, self.__capacity), slice(0, self.__head)]
+
+        if duration is not None and self.__size:
+            since = self.__timestamps[self.__head - 1] - duration
+        if since is None:
+            return segments
+
+        for i, seg in enumerate(segments):
+            times = self.__timestamps[seg]
+            if len(times) and times[-1] >= since:
+                start = seg.start + int(np.searchsorted(times, since, side='left'))
+                return [slice(start, seg.stop)] + segments[i + 1:]
+        return []
+
+    def __len__(self):
+        return self.__size
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    @property
+    def latest(self):
+        with self.__lock:
+            if not self.__size:
+                return None
+            return float(self.__timestamps[self.__head - 1]), float(self.__values[self.__head - 1])
+
+
+class CanSignalHistory:
+    """
+    Opt-in history ring buffers for subscribed signals, filled from received frames.
+    """
+
+    def __init__(self, dbc):
+        self.__dbc = dbc
+        self.__buffers = dict()
+        self.__plans = dict()  # frame_id -> (codec, [(layout, buffer), ...])
+
+    def subscribe(self, signal_name, capacity=1000):
+        msg_dbc = self.__find_message(signal_name)
+        codec = get_codec(msg_dbc)
+        buffer = CanSignalRingBuffer(capacity)
+        self.__buffers[signal_name] = buffer
+
+        codec, entries = self.__plans.get(msg_dbc.frame_id, (codec, []))
+        entries = [entry for entry in entries if entry[0].name != signal_name]
+        entries.append((codec.get_layout(signal_name), buffer))
+        # Swap in a new list so the receive thread never sees a partial update
+        self.__plans[msg_dbc.frame_id] = (codec, entries)
+        return buffer
+
+    def unsubscribe(self, signal_name):
+        self.__buffers.pop(signal_name, None)
+        for frame_id, (codec, entries) in list(self.__plans.items()):
+            entries = [entry for entry in entries if entry[0].name != signal_name]
+            if entries:
+                self.__plans[frame_id] = (codec, entries)
+            else:
+                del self.__plans[frame_id]
+
+    def update(self, msg):
+        plan = self.__plans.get(msg.arbitration_id)
+        if plan is None:
+            return
+        codec, entries = plan
+        data = msg.data
+        if len(data) != codec.length:
+            data = bytes(data[:codec.length]).ljust(codec.length, b'\x00')
+        for layout, buffer in entries:
+            if layout.multiplexer_ids is not None and not codec.is_active(layout, data):
+                continue
+            raw = layout.raw_from_int(int.from_bytes(data, layout.byteorder))
+            buffer.append(msg.timestamp, raw * layout.scale + layout.offset)
+
+    def get(self, signal_name):
+        return self.__buffers[signal_name]
+
+    def __find_message(self, signal_name):
+        for msg_dbc in self.__dbc.messages:
+            for signal in msg_dbc.signals:
+                if signal.name == signal_name:
+                    return msg_dbc
+        raise KeyError(f"Signal {signal_name} is not in the DBC!")
+
+    @property
+    def signal_names(self):
+        return list(self.__buffers)
+
+    @property
+    def msg_ids(self):
+        return list(self.__plans)
+
+
+if __name__ == '__main__':
+    buffer = CanSignalRingBuffer(capacity=500)
+    for i in range(1000):
+        buffer.append(i * 0.01, np.sin(i * 0.01))
+    print(f"samples: {len(buffer)}, latest: {buffer.latest}")
+    print(f"last 2 s: min {buffer.min(duration=2.0):.3f}, max {buffer.max(duration=2.0):.3f}, "
+          f"mean {buffer.mean(duration=2.0):.3f}, rate {buffer.rate(duration=0.5):.3f}/s")
+    print(f"first rising crossing of 0.5 after t=5: {buffer.first_crossing(0.5, since=5.0, direction='rising')}")
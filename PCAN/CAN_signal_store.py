@@ -0,0 +1,143 @@
+from CAN_codec import get_codec, BIG_ENDIAN
+
+from array import array
+import threading
+import time
+
+
+class CanSignalSnapshot:
+    """
+    Consistent copy of a CanSignalStore taken at one point in time.
+    """
+
+    def __init__(self, signal_ids, values, timestamps, counts):
+        self.__signal_ids = signal_ids
+        self.values = values
+        self.timestamps = timestamps
+        self.counts = counts
+
+    def get(self, signal_name):
+        signal_id = self.__signal_ids[signal_name]
+        return self.values[signal_id], self.timestamps[signal_id], self.counts[signal_id]
+
+    def to_dict(self):
+        # Only signals that have been received at least once
+        return {name: self.values[signal_id] for name, signal_id in self.__signal_ids.items()
+                if self.counts[signal_id]}
+
+
+class CanSignalStore:
+    """
+    Latest physical value, timestamp and update count of every DBC signal.
+
+    Values live in preallocated typed arrays indexed by signal ID, so a
+    received frame only overwrites array slots. The writer bumps a sequence
+    number before and after each frame (odd while writing) and readers retry
+    until they see the same even sequence on both sides of their copy, so
+    reads never block the receive path.
+    """
+
+    def __init__(self, dbc, msg_ids=None):
+        self.__signal_ids = dict()
+        self.__plans = dict()
+        for msg_dbc in dbc.messages:
+            if msg_ids is not None and msg_dbc.frame_id not in msg_ids:
+                continue
+            codec = get_codec(msg_dbc)
+            entries = []
+            for layout in codec.layouts.values():
+                # Signal names are unique across the Tesla DBC, keep the first one otherwise
+                if layout.name in self.__signal_ids:
+                    continue
+                signal_id = len(self.__signal_ids)
+                self.__signal_ids[layout.name] = signal_id
+                entries.append((signal_id, layout))
+            self.__plans[msg_dbc.frame_id] = (codec, entries)
+
+        size = len(self.__signal_ids)
+        self.__values = array('d', bytes(8 * size))
+        self.__timestamps = array('d', bytes(8 * size))
+        self.__counts = array('Q', bytes(8 * size))
+        self.__sequence = 0
+        # Only serializes writers (several rx workers), readers never take it
+        self.__write_lock = threading.Lock()
+
+    def update(self, msg):
+        plan = self.__plans.get(msg.arbitration_id)
+        if plan is None:
+            return
+        codec, entries = plan
+        data = msg.data
+        if len(data) != codec.length:
+            data = bytes(data[:codec.length]).ljust(codec.length, b'\x00')
+        big = int.from_bytes(data, 'big')
+        little = int.from_bytes(data, 'little')
+        timestamp = msg.timestamp
+        values = self.__values
+        timestamps = self.__timestamps
+        counts = self.__counts
+
+        with self.__write_lock:
+            self.__sequence += 1
+            for signal_id, layout in entries:
+                if layout.multiplexer_ids is not None and not codec.is_active(layout, data):
+                    continue
+                raw = layout.raw_from_int(big if layout.byteorder == BIG_ENDIAN else little)
+                values[signal_id] = raw * layout.scale + layout.offset
+                timestamps[signal_id] = timestamp
+                counts[signal_id] += 1
+            self.__sequence += 1
+
+    def get(self, signal_name):
+        signal_id = self.__signal_ids[signal_name]
+        while True:
+            sequence = self.__sequence
+            if sequence & 1:
+                time.sleep(0)  # Writer is mid-frame, let it finish
+                continue
+            result = (self.__values[signal_id], self.__timestamps[signal_id],
+                      self.__counts[signal_id])
+            if sequence == self.__sequence:
+                return result
+
+    def get_value(self, signal_name):
+        return self.get(signal_name)[0]
+
+    def snapshot(self):
+        while True:
+            sequence = self.__sequence
+            if sequence & 1:
+                time.sleep(0)  # Writer is mid-frame, let it finish
+                continue
+            values = array('d', self.__values)
+            timestamps = array('d', self.__timestamps)
+            counts = array('Q', self.__counts)
+            if sequence == self.__sequence:
+                return CanSignalSnapshot(self.__signal_ids, values, timestamps, counts)
+
+    def signal_id(self, signal_name):
+        return self.__signal_ids[signal_name]
+
+    @property
+    def signal_names(self):
+        return list(self.__signal_ids)
+
+    @property
+    def signal_ids(self):
+        return self.__signal_ids
+
+
+if __name__ == '__main__':
+    import cantools
+    import can
+    import os
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    dbc = cantools.database.load_file(dbc_path)
+
+    store = CanSignalStore(dbc)
+    store.update(can.Message(timestamp=1.0, arbitration_id=0x488, is_extended_id=False,
+                             data=bytes.fromhex('de594407')))
+    print(f"DAS_steeringAngleRequest: {store.get('DAS_steeringAngleRequest')}")
+    print(f"snapshot: {store.snapshot().to_dict()}")
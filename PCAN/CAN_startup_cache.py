@@ -0,0 +1,154 @@
+from CAN_codec import get_codec, register_codec
+from CAN_message import CanMessage
+
+import CAN_codec
+import CAN_message
+import cantools
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import logging
+_logger = logging.getLogger("CAN_startup_cache")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get(
+    'PCAN_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'pcan'))
+
+
+def _code_digest():
+    # Sources of the pickled classes, any change to them invalidates the cache
+    digest = hashlib.sha256()
+    for path in (CAN_codec.__file__, CAN_message.__file__, __file__):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.digest()
+
+
+_CODE_DIGEST = _code_digest()
+
+
+class CanStartupBundle:
+    """
+    Everything CanManager needs at startup: the parsed DBC, the compiled
+    codecs and the filled-in, pre-encoded initial TX messages.
+    """
+
+    def __init__(self, dbc, codecs, init_tx_msgs_dict, init_payloads):
+        self.dbc = dbc
+        self.codecs = codecs
+        self.init_tx_msgs_dict = init_tx_msgs_dict
+        # msg_id -> (complete can_data dict, encoded payload bytes)
+        self.init_payloads = init_payloads
+
+
+class CanStartupCache:
+    """
+    On-disk cache of CanStartupBundle keyed by the content hash of the DBC
+    and the init JSON, so a warm start skips DBC parsing and initial encoding.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, logger=_logger):
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        self.__cache_dir = cache_dir
+
+    def load(self, dbc_path, init_tx_msgs_json_path):
+        key = self.cache_key(dbc_path, init_tx_msgs_json_path)
+        path = self.__cache_path(key)
+        try:
+            with open(path, 'rb') as f:
+                bundle = pickle.load(f)
+            for codec in bundle.codecs.values():
+                register_codec(codec)
+            self.logger.debug(
+                f"[{self.__class_name}] Loaded startup bundle from {path}")
+            return bundle
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # Any unpickling failure, e.g. ValueError or TypeError from changed classes, is a miss
+            self.logger.warning(
+                f"[{self.__class_name}] Ignoring unreadable cache file {path}: {e}")
+
+        bundle = self.build(dbc_path, init_tx_msgs_json_path)
+        self.store(key, bundle)
+        return bundle
+
+    def build(self, dbc_path, init_tx_msgs_json_path):
+        dbc = cantools.database.load_file(dbc_path)
+        codecs = {msg_dbc.frame_id: get_codec(msg_dbc) for msg_dbc in dbc.messages}
+
+        with open(init_tx_msgs_json_path, 'r') as f:
+            init_tx_msgs_dict = json.load(f)
+
+        init_payloads = dict()
+        for msg_id_str in init_tx_msgs_dict:
+            msg_id = int(msg_id_str, 16)
+            msg = CanMessage(dbc=dbc, can_id=msg_id,
+                             init_can_data=dict(init_tx_msgs_dict[msg_id_str]),
+                             logger=self.logger)
+            init_payloads[msg_id] = (dict(msg.can_data), bytes(msg.can_msg.data))
+        return CanStartupBundle(dbc=dbc, codecs=codecs,
+                                init_tx_msgs_dict=init_tx_msgs_dict,
+                                init_payloads=init_payloads)
+
+    def store(self, key, bundle):
+        os.makedirs(self.__cache_dir, exist_ok=True)
+        # Write to a temporary file first so concurrent processes never read a partial cache
+        fd, tmp_path = tempfile.mkstemp(dir=self.__cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.__cache_path(key))
+        except OSError as e:
+            self.logger.warning(
+                f"[{self.__class_name}] Failed to write startup cache: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def prewarm(self, dbc_path, init_tx_msgs_json_path):
+        key = self.cache_key(dbc_path, init_tx_msgs_json_path)
+        self.store(key, self.build(dbc_path, init_tx_msgs_json_path))
+        return self.__cache_path(key)
+
+    @staticmethod
+    def cache_key(dbc_path, init_tx_msgs_json_path):
+        digest = hashlib.sha256()
+        digest.update(f"{CACHE_FORMAT_VERSION}:{cantools.__version__}:".encode())
+        digest.update(_CODE_DIGEST)
+        for path in (dbc_path, init_tx_msgs_json_path):
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()
+
+    def __cache_path(self, key):
+        return os.path.join(self.__cache_dir, f"{key}.pickle")
+
+    @property
+    def cache_dir(self):
+        return self.__cache_dir
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Prewarm the CanManager startup cache for a DBC and init JSON.")
+    parser.add_argument('--dbc', default=os.path.join('res', 'tesla_can.dbc'))
+    parser.add_argument('--init', default=os.path.join('res', 'init_tx_msgs.json'))
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    cache = CanStartupCache(cache_dir=args.cache_dir)
+    print(f"Startup cache written to {cache.prewarm(args.dbc, args.init)}")
@@ -0,0 +1,177 @@
+from CAN_codec import get_codec
+
+import threading
+import itertools
+
+
+class CanSubscription:
+    """
+    Handle returned by CanSubscriptionTable.subscribe_*, pass it to unsubscribe.
+    """
+
+    def __init__(self, sub_id, msg_id, callback, on_change=False, layout=None, deadband=0.0):
+        self.sub_id = sub_id
+        self.msg_id = msg_id
+        self.callback = callback
+        self.on_change = on_change
+        self.layout = layout  # None for message subscriptions
+        self.deadband = deadband
+        self.last_value = None
+
+    @property
+    def signal_name(self):
+        if self.layout is None:
+            return None
+        return self.layout.name
+
+
+class _CanDispatchEntry:
+    # Everything dispatch needs for one arbitration ID
+    def __init__(self, codec, msg_subs, signal_subs):
+        self.codec = codec
+        self.msg_subs = msg_subs
+        self.signal_subs = signal_subs
+        self.only_on_change = all(sub.on_change for sub in msg_subs + signal_subs)
+        self.last_payload = None
+
+
+class CanSubscriptionTable:
+    """
+    Dispatches received frames to subscribers of a message or of a single signal.
+
+    Subscriptions are compiled into an arbitration ID -> entry table, so a
+    frame nobody subscribed to costs one dict lookup. Change detection
+    compares the raw payload bytes first: an unchanged frame is dropped
+    before anything is decoded when all subscribers of its ID only want
+    changes. Signal subscribers with a deadband are only called once the
+    physical value moved by more than the deadband since their last call.
+    """
+
+    def __init__(self, dbc):
+        self.__dbc = dbc
+        self.__subscriptions = dict()
+        self.__table = dict()
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+
+    def subscribe_msg(self, msg, callback, on_change=False):
+        # msg is an arbitration ID or a DBC message name, callback(msg)
+        msg_dbc = self.__find_message(msg)
+        return self.__add(CanSubscription(sub_id=next(self.__ids), msg_id=msg_dbc.frame_id,
+                                          callback=callback, on_change=on_change))
+
+    def subscribe_signal(self, signal_name, callback, on_change=False, deadband=0.0):
+        # callback(signal_name, value, timestamp) with the physical value
+        msg_dbc = self.__find_signal_message(signal_name)
+        layout = get_codec(msg_dbc).get_layout(signal_name)
+        return self.__add(CanSubscription(sub_id=next(self.__ids), msg_id=msg_dbc.frame_id,
+                                          callback=callback, on_change=on_change,
+                                          layout=layout, deadband=deadband))
+
+    def unsubscribe(self, subscription):
+        with self.__lock:
+            if self.__subscriptions.pop(subscription.sub_id, None) is None:
+                return -1
+            self.__rebuild()
+
+    def dispatch(self, msg):
+        entry = self.__table.get(msg.arbitration_id)
+        if entry is None:
+            return
+
+        data = bytes(msg.data)
+        changed = data != entry.last_payload
+        if not changed and entry.only_on_change:
+            return
+        entry.last_payload = data
+
+        for sub in entry.msg_subs:
+            if changed or not sub.on_change:
+                sub.callback(msg)
+
+        if not entry.signal_subs:
+            return
+        codec = entry.codec
+        if len(data) != codec.length:
+            data = data[:codec.length].ljust(codec.length, b'\x00')
+        for sub in entry.signal_subs:
+            if sub.on_change and not changed:
+                continue
+            layout = sub.layout
+            if layout.multiplexer_ids is not None and not codec.is_active(layout, data):
+                continue
+            raw = layout.raw_from_int(int.from_bytes(data, layout.byteorder))
+            value = raw * layout.scale + layout.offset
+            if sub.on_change and sub.last_value is not None and \
+                    abs(value - sub.last_value) <= sub.deadband:
+                continue
+            sub.last_value = value
+            sub.callback(layout.name, value, msg.timestamp)
+
+    def __add(self, subscription):
+        with self.__lock:
+            self.__subscriptions[subscription.sub_id] = subscription
+            self.__rebuild()
+        return subscription
+
+    def __rebuild(self):
+        grouped = dict()
+        for sub in self.__subscriptions.values():
+            msg_subs, signal_subs = grouped.setdefault(sub.msg_id, ([], []))
+            if sub.layout is None:
+                msg_subs.append(sub)
+            else:
+                signal_subs.append(sub)
+
+        table = dict()
+        for msg_id, (msg_subs, signal_subs) in grouped.items():
+            entry = _CanDispatchEntry(codec=get_codec(self.__dbc.get_message_by_frame_id(msg_id)),
+                                      msg_subs=msg_subs, signal_subs=signal_subs)
+            old_entry = self.__table.get(msg_id)
+            if old_entry is not None:
+                entry.last_payload = old_entry.last_payload
+            table[msg_id] = entry
+        # Swap in the new table so the receive thread never sees a partial update
+        self.__table = table
+
+    def __find_message(self, msg):
+        try:
+            if isinstance(msg, str):
+                return self.__dbc.get_message_by_name(msg)
+            return self.__dbc.get_message_by_frame_id(msg)
+        except KeyError:
+            raise KeyError(f"Message {msg} is not in the DBC!")
+
+    def __find_signal_message(self, signal_name):
+        for msg_dbc in self.__dbc.messages:
+            for signal in msg_dbc.signals:
+                if signal.name == signal_name:
+                    return msg_dbc
+        raise KeyError(f"Signal {signal_name} is not in the DBC!")
+
+    @property
+    def msg_ids(self):
+        return list(self.__table)
+
+    def __len__(self):
+        return len(self.__subscriptions)
+
+
+if __name__ == '__main__':
+    import cantools
+    import can
+    import os
+    cwd = os.getcwd()
+
+    dbc_path = os.path.join(cwd, r'res/tesla_can.dbc')
+    dbc = cantools.database.load_file(dbc_path)
+
+    table = CanSubscriptionTable(dbc)
+    table.subscribe_msg('DAS_steeringControl', lambda msg: print(f"Frame: {msg}"), on_change=True)
+    table.subscribe_signal('DAS_steeringAngleRequest',
+                           lambda name, value, ts: print(f"{name} = {value} at {ts}"),
+                           on_change=True, deadband=0.5)
+    for i, payload in enumerate(('de594407', 'de594407', 'de5a4407', 'de644407')):
+        table.dispatch(can.Message(timestamp=i * 0.01, arbitration_id=0x488,
+                                   is_extended_id=False, data=bytes.fromhex(payload)))
+    print(f"Subscribed IDs: {[hex(msg_id) for msg_id in table.msg_ids]}")
@@ -1,3 +1,7 @@
+from CAN_scheduler import CanTxScheduler
+from CAN_filter import compile_can_filters
+from CAN_rx_dispatcher import CanRxDispatcher, DROP_OLDEST
+
 import can
 import threading
 import logging
@@ -19,8 +23,10 @@ BAUD_RATE_500K = 500000
 
 class CanTransceiver(threading.Thread):
     def __init__(self, channel=VCAN, interface=SOCKET_CAN, bitrate=BAUD_RATE_500K,
-                 filtered_msg_ids=None, record_last_msgs=False,
-                 logger=_logger, logging_rec_msg=False):
+                 filtered_msg_ids=None,
+                 logger=_logger, logging_rec_msg=False, tx_scheduler=False,
+                 extended_msg_ids=None, rx_workers=0, rx_queue_size=4096, rx_batch_size=64,
+                 rx_overflow_policy=DROP_OLDEST, metrics=None):
         super(CanTransceiver, self).__init__()
         self.__class_name = self.__class__.__name__
         self.logger = logger
@@ -31,32 +37,97 @@ class CanTransceiver(threading.Thread):
         self.__running = threading.Event()  # Used to stop threading
         self.__running.set()
         self.__on_can_msg_callback = None
+        self.__on_can_msgs_callback = None
         self.__modify_tx_msg_callback = None
         self.__logging_rec_msg = logging_rec_msg
 
         self.__periodic_tx_msg_tasks = {}
+        self.__channel = channel
         self.__filtered_msg_ids = filtered_msg_ids
+        self.__extended_msg_ids = extended_msg_ids
+        self.__can_filters = None
+        self.__rec_msg_count = 0
+        self.__interface_rx_baseline = None
         self.__set_can_filters()
-        self.__last_rec_msgs = dict()
         self.__stopped_periodic_tx_msg_tasks = list()
 
-        self.__record_last_msgs = record_last_msgs
+        self.__notifier = None  # Set when receiving from an asyncio event loop
+        self.__recorder = None
+        self.__metrics = metrics  # CanMetrics, None disables instrumentation
+
+        # Optionally drive all periodic messages from one scheduler thread
+        self.__tx_scheduler = None
+        if tx_scheduler:
+            self.__tx_scheduler = CanTxScheduler(bus=self.__bus, logger=logger)
+
+        # Optionally drain the bus in batches and run callbacks on a worker pool
+        self.__rx_batch_size = rx_batch_size
+        self.__rx_dispatcher = None
+        if rx_workers:
+            self.__rx_dispatcher = CanRxDispatcher(callback=self.__on_can_messages,
+                                                   workers=rx_workers,
+                                                   queue_size=rx_queue_size,
+                                                   batch_size=rx_batch_size,
+                                                   overflow_policy=rx_overflow_policy,
+                                                   logger=logger)
+
+    def __clear_can_filters(self):
+        self.__reset_filter_stats()
+        self.__can_filters = None
+        self.__bus.set_filters(None)
 
     def __set_can_filters(self):
         if self.__filtered_msg_ids is None:
             self.logger.warning(
                 f"[{self.__class_name}] CAN Filter has not been set!")
+            self.__clear_can_filters()
             return -1
 
-        can_filters = []
-        for msg_id in self.__filtered_msg_ids:
-            self.logger.debug(
-                f"[{self.__class_name}] Set can_filter for ID: {msg_id}")
-            can_filter = {"can_id": msg_id,
-                          "can_mask": 0xfff, "extended": False}
-            can_filters.append(can_filter)
+        self.__reset_filter_stats()
+
+        # Smallest set of (id, mask) pairs accepting exactly the filtered IDs
+        self.__can_filters = compile_can_filters(
+            self.__filtered_msg_ids, self.__extended_msg_ids)
+        self.logger.debug(
+            f"[{self.__class_name}] Set {len(self.__can_filters)} can_filters for "
+            f"{len(self.__filtered_msg_ids)} IDs")
+        self.__bus.set_filters(self.__can_filters)
+
+    def set_filtered_msg_ids(self, msg_ids, extended_msg_ids=None):
+        # Recompile kernel filters at runtime, None accepts every frame
+        self.__filtered_msg_ids = None if msg_ids is None else list(msg_ids)
+        if extended_msg_ids is not None:
+            self.__extended_msg_ids = extended_msg_ids
+        if self.__filtered_msg_ids is None:
+            # Intentional reset, not the missing configuration __set_can_filters warns about
+            self.__clear_can_filters()
+            return
+        return self.__set_can_filters()
+
+    def __read_interface_rx_frames(self):
+        # Frames the network interface received before kernel filtering (Linux only)
+        try:
+            with open(f"/sys/class/net/{self.__channel}/statistics/rx_packets", 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def __reset_filter_stats(self):
+        self.__rec_msg_count = 0
+        self.__interface_rx_baseline = self.__read_interface_rx_frames()
 
-        self.__bus.set_filters(can_filters)
+    @property
+    def filter_stats(self):
+        stats = {"can_filters": len(self.__can_filters) if self.__can_filters else 0,
+                 "userspace_rx_frames": self.__rec_msg_count,
+                 "interface_rx_frames": None,
+                 "kernel_dropped_frames": None}
+        interface_rx_frames = self.__read_interface_rx_frames()
+        if interface_rx_frames is not None and self.__interface_rx_baseline is not None:
+            stats["interface_rx_frames"] = interface_rx_frames - self.__interface_rx_baseline
+            stats["kernel_dropped_frames"] = max(
+                0, stats["interface_rx_frames"] - self.__rec_msg_count)
+        return stats
 
     def stop_periodic_tx_msg(self, msg_id):
         if not self.__is_sending(msg_id):
@@ -94,8 +165,10 @@ class CanTransceiver(threading.Thread):
 
     def send_evt_msg(self, msg):
         self.__bus.send(msg)
+        if self.__metrics is not None:
+            self.__metrics.on_tx(msg.arbitration_id)
 
-    def add_periodic_tx_msg(self, msg, period):
+    def add_periodic_tx_msg(self, msg, period, modifier=None):
         if not self.__is_can_msg(msg):
             return -1
 
@@ -106,7 +179,24 @@ class CanTransceiver(threading.Thread):
 
         self.logger.info(
             f'[{self.__class_name}] Start to send {msg} with period {period} seconds.')
-        task = self.__bus.send_periodic(msgs=msg, period=period)
+        if self.__metrics is not None:
+            modifier = self.__metrics.tx_modifier(msg.arbitration_id, period, modifier,
+                                                  python_path=self.__tx_scheduler is not None)
+        return self.__start_periodic_task(msg, period, modifier)
+
+    def __start_periodic_task(self, msg, period, modifier):
+        if self.__tx_scheduler is not None:
+            task = self.__tx_scheduler.add_task(
+                msg=msg, period=period, modifier=modifier)
+            self.__periodic_tx_msg_tasks[msg.arbitration_id] = task
+            return task
+
+        if modifier is not None:
+            # modifier patches each frame (e.g. counter/checksum) right before it is sent
+            task = self.__bus.send_periodic(
+                msgs=msg, period=period, modifier_callback=modifier)
+        else:
+            task = self.__bus.send_periodic(msgs=msg, period=period)
         if not isinstance(task, can.LimitedDurationCyclicSendTaskABC):
             self.logger.error(f"[{self.__class_name}] "
                               f"This interface doesn't seem to support LimitedDurationCyclicSendTaskABC")
@@ -114,34 +204,118 @@ class CanTransceiver(threading.Thread):
         self.__periodic_tx_msg_tasks[msg.arbitration_id] = task
         return task
 
+    def set_periodic_tx_modifier(self, msg_id, modifier):
+        # Replace the per-frame modifier of a running periodic message, None removes it
+        if not self.__is_sending(msg_id):
+            self.logger.error(
+                f'[{self.__class_name}] Message {msg_id} not in sending tasks.')
+            return -1
+
+        task = self.__periodic_tx_msg_tasks[msg_id]
+        if self.__metrics is not None:
+            modifier = self.__metrics.tx_modifier(msg_id, task.period, modifier,
+                                                  python_path=self.__tx_scheduler is not None)
+        if self.__tx_scheduler is not None:
+            task.modifier = modifier
+            return task
+
+        # python-can binds the modifier when the task is created, restart it
+        msg = task.messages[0]
+        task.stop()
+        task = self.__start_periodic_task(msg, task.period, modifier)
+        if msg_id in self.__stopped_periodic_tx_msg_tasks:
+            task.stop()
+        return task
+
+    def start(self):
+        if self.__tx_scheduler is not None:
+            self.__tx_scheduler.start()
+        if self.__rx_dispatcher is not None:
+            self.__rx_dispatcher.start()
+        super(CanTransceiver, self).start()
+
+    def start_in_loop(self, loop):
+        # Receive from the asyncio event loop instead of this thread, callbacks run in the loop
+        if self.__tx_scheduler is not None:
+            self.__tx_scheduler.start()
+        self.__notifier = can.Notifier(self.__bus, [self.__on_loop_message], timeout=1.0, loop=loop)
+
+    def __on_loop_message(self, msg):
+        if not self.__flag.is_set():
+            return
+        self.__rec_msg_count += 1
+        if self.__recorder is not None:
+            self.__recorder.put(msg)
+        self.__on_can_message(msg)
+
     def run(self):
 
         while self.__running.isSet():
             self.__flag.wait()
             try:
-                for msg in self.__bus:
-                    self.__on_can_message(msg)
+                if self.__rx_dispatcher is not None:
+                    self.__receive_batches()
+                else:
+                    for msg in self.__bus:
+                        self.__rec_msg_count += 1
+                        if self.__recorder is not None:
+                            self.__recorder.put(msg)
+                        self.__on_can_message(msg)
             except OSError:
                 self.logger.info(
                     f"[{self.__class_name}] Successfully close CAN Transceiver")
             except ValueError:
                 self.logger.info(
                     f"[{self.__class_name}] Successfully close CAN Transceiver")
+            except can.CanError:
+                self.logger.info(
+                    f"[{self.__class_name}] Successfully close CAN Transceiver")
+
+    def __receive_batches(self):
+        # Block for the first frame, then drain whatever is already queued
+        while self.__running.isSet() and self.__flag.is_set():
+            msg = self.__bus.recv(timeout=1.0)
+            if msg is None:
+                continue
+            batch = [msg]
+            while len(batch) < self.__rx_batch_size:
+                msg = self.__bus.recv(timeout=0)
+                if msg is None:
+                    break
+                batch.append(msg)
+            self.__rec_msg_count += len(batch)
+            if self.__recorder is not None:
+                self.__recorder.put_batch(batch)
+            self.__rx_dispatcher.put(batch)
 
     def pause(self):
         self.__flag.clear()  # Set as False to pause threading
-        self.__stop_all_periodic_tasks()
+        if self.__tx_scheduler is not None:
+            self.__tx_scheduler.pause()
+        else:
+            self.__stop_all_periodic_tasks()
 
     def resume(self):
         self.__flag.set()  # Set as True to resume threading
-        self.__resume_all_periodic_tasks()
+        if self.__tx_scheduler is not None:
+            self.__tx_scheduler.resume()
+        else:
+            self.__resume_all_periodic_tasks()
 
     def stop(self):
         self.__flag.set()
         self.__running.clear()
-        self.__stop_all_periodic_tasks()
+        if self.__tx_scheduler is not None:
+            self.__tx_scheduler.stop()
+        else:
+            self.__stop_all_periodic_tasks()
+        if self.__notifier is not None:
+            self.__notifier.stop()
         self.__bus.shutdown()
-        self.join()
+        if self.is_alive():
+            self.join()
+        if self.__rx_dispatcher is not None:
+            self.__rx_dispatcher.stop()
 
     def __stop_all_periodic_tasks(self):
         for task in self.__periodic_tx_msg_tasks:
@@ -155,7 +329,16 @@ class CanTransceiver(threading.Thread):
         for task in self.__periodic_tx_msg_tasks:
             self.__periodic_tx_msg_tasks[task].start()
 
+    def __on_can_messages(self, msgs):
+        # Runs on a dispatcher worker with a batch of frames
+        for msg in msgs:
+            self.__on_can_message(msg)
+        if self.__on_can_msgs_callback is not None:
+            self.__on_can_msgs_callback(msgs)
+
     def __on_can_message(self, msg):
+        if self.__metrics is not None:
+            self.__metrics.on_rx(msg)
         if self.__logging_rec_msg:
             self.logger.debug(
                 f'[{self.__class_name}] Receiving message: {msg}')
@@ -163,19 +346,17 @@ class CanTransceiver(threading.Thread):
         if self.__on_can_msg_callback is not None:
             self.__on_can_msg_callback(msg)
 
-        if self.__record_last_msgs:
-            self.__last_rec_msgs[msg.arbitration_id] = msg
-
     def __modify_tx_msg(self, msg):
         if not self.__is_can_msg(msg):
             return -1
 
-        if self.__periodic_tx_msg_tasks[msg.arbitration_id]:
-            task = self.__periodic_tx_msg_tasks[msg.arbitration_id]
+        task = self.__periodic_tx_msg_tasks.get(msg.arbitration_id)
+        if task:
             task.modify_data(msg)
         else:
             self.logger.error(
                 f'[{self.__class_name}] This message {msg} is not in the periodic_tx_msg_tasks!')
+            return -1
 
     def modify_tx_msg(self, msg):
         self.__modify_tx_msg(msg)
@@ -185,6 +366,14 @@ class CanTransceiver(threading.Thread):
     def set_on_can_msg_callback(self, callback):
         self.__on_can_msg_callback = callback
 
+    def set_on_can_msgs_callback(self, callback):
+        # Batch callback, only called when rx_workers is set
+        self.__on_can_msgs_callback = callback
+
+    def set_recorder(self, recorder):
+        # Every received frame is put into the recorder in bus order, None stops recording
+        self.__recorder = recorder
+
     def set_modify_tx_msg_callback(self, callback):
         self.__modify_tx_msg_callback = callback
 
@@ -193,11 +382,18 @@ class CanTransceiver(threading.Thread):
         return self.__periodic_tx_msg_tasks
 
     @property
-    def last_rec_msgs(self):
-        if self.__record_last_msgs:
-            return self.__last_rec_msgs
-        else:
-            return -1
+    def rx_stats(self):
+        if self.__rx_dispatcher is None:
+            return None
+        return self.__rx_dispatcher.stats
+
+    @property
+    def can_filters(self):
+        return self.__can_filters
+
+    @property
+    def tx_scheduler(self):
+        return self.__tx_scheduler
 
     def __is_can_msg(self, msg):
         if isinstance(msg, can.message.Message):
@@ -214,7 +410,7 @@ class CanTransceiver(threading.Thread):
 if __name__ == '__main__':
     import time
     can_trx = CanTransceiver(logging_rec_msg=True, filtered_msg_ids=[
-                             0x002, 0x003], record_last_msgs=True)
+                             0x002, 0x003])
     msg001 = can.Message(arbitration_id=0x001, data=[
                          1, 1, 1, 1, 1, 1], is_extended_id=False)
     msg002 = can.Message(arbitration_id=0x002, data=[
@@ -239,4 +435,4 @@ if __name__ == '__main__':
     can_trx.start_periodic_tx_msg(0x003)
     time.sleep(2)
     can_trx.stop()
-    print(can_trx.last_rec_msgs)
+    print(can_trx.filter_stats)
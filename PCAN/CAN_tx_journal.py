@@ -0,0 +1,215 @@
+from collections import deque
+
+import json
+import os
+import tempfile
+import threading
+import logging
+_logger = logging.getLogger("CAN_tx_journal")
+_logger.setLevel(logging.DEBUG)
+
+_ch = logging.StreamHandler()
+_ch.setLevel(logging.DEBUG)
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_ch.setFormatter(formatter)
+_logger.addHandler(_ch)
+
+
+def _json_default(value):
+    # cantools NamedSignalValue and similar, keep the raw number
+    if hasattr(value, 'value'):
+        return value.value
+    return str(value)
+
+
+class CanTxJournal:
+    """
+    Write-behind journal of last-modified TX message state.
+
+    append() only puts the update on an in-memory queue. A background thread
+    wakes every `commit_interval` seconds and writes everything queued since
+    as JSON lines with one write and one fsync (group commit). Once the
+    journal holds `compact_records` records, the merged state is written
+    atomically to the snapshot JSON and the journal is truncated. Replaying
+    the journal over the snapshot is idempotent, so a crash between the two
+    steps loses nothing.
+    """
+
+    def __init__(self, journal_path, snapshot_path, commit_interval=0.05, compact_records=10000,
+                 logger=_logger):
+        self.logger = logger
+        self.__class_name = self.__class__.__name__
+        self.__journal_path = journal_path
+        self.__snapshot_path = snapshot_path
+        self.__commit_interval = commit_interval
+        self.__compact_records = compact_records
+
+        self.__queue = deque()
+        self.__wake = threading.Event()
+        self.__running = False
+        self.__writer = None
+        self.__journal = None
+        self.__state = dict()
+        self.__journal_records = 0
+        self.__commits = 0
+        self.__compactions = 0
+
+    def restore(self, init_state):
+        # init_state, then the snapshot, then every complete journal record
+        state = {msg_id: dict(data) for msg_id, data in init_state.items()}
+        if os.path.exists(self.__snapshot_path):
+            try:
+                with open(self.__snapshot_path, 'r') as f:
+                    for msg_id, data in json.load(f).items():
+                        state.setdefault(msg_id, dict()).update(data)
+            except ValueError as e:
+                self.logger.warning(
+                    f"[{self.__class_name}] Ignoring unreadable snapshot {self.__snapshot_path}: {e}")
+
+        records = 0
+        if os.path.exists(self.__journal_path):
+            with open(self.__journal_path, 'rb+') as f:
+                valid_end = 0
+                needs_newline = False
+                for line in f:
+                    try:
+                        msg_id, data = json.loads(line)
+                    except ValueError:
+                        break  # Torn last write of a crash
+                    state.setdefault(msg_id, dict()).update(data)
+                    records += 1
+                    valid_end += len(line)
+                    needs_newline = not line.endswith(b'\n')
+                # Cut the torn tail so start() appends after the last complete record
+                f.seek(0, os.SEEK_END)
+                if f.tell() != valid_end:
+                    self.logger.warning(
+                        f"[{self.__class_name}] Truncating {f.tell() - valid_end} bytes of a torn "
+                        f"record from {self.__journal_path}")
+                    f.truncate(valid_end)
+                if needs_newline:
+                    f.seek(valid_end)
+                    f.write(b'\n')
+        if records:
+            self.logger.info(
+                f"[{self.__class_name}] Restored {records} journal records from {self.__journal_path}")
+        self.__state = {msg_id: dict(data) for msg_id, data in state.items()}
+        self.__journal_records = records
+        return state
+
+    def start(self):
+        self.__journal = open(self.__journal_path, 'a')
+        self.__running = True
+        self.__writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__writer.start()
+
+    def stop(self):
+        # Commits what is queued and compacts, so the snapshot alone holds the state
+        self.__running = False
+        self.__wake.set()
+        if self.__writer is not None:
+            self.__writer.join()
+            self.__writer = None
+        if self.__journal is not None:
+            self.__compact()
+            self.__journal.close()
+            self.__journal = None
+        else:
+            # Never started, still leave the last modified state on disk
+            queue = self.__queue
+            while queue:
+                msg_id, data = queue.popleft()
+                self.__state.setdefault(msg_id, dict()).update(data)
+            self.__write_snapshot()
+
+    def append(self, msg_id, data):
+        # Never touches the disk, safe on the modify path
+        self.__queue.append((msg_id, data))
+
+    def __write_loop(self):
+        while self.__running:
+            self.__wake.wait(self.__commit_interval)
+            self.__wake.clear()
+            self.__commit()
+        self.__commit()
+
+    def __commit(self):
+        records = []
+        queue = self.__queue
+        while queue:
+            records.append(queue.popleft())
+        if not records:
+            return
+
+        lines = []
+        for msg_id, data in records:
+            lines.append(json.dumps([msg_id, data], separators=(',', ':'), default=_json_default))
+            self.__state.setdefault(msg_id, dict()).update(data)
+        try:
+            self.__journal.write('\n'.join(lines) + '\n')
+            self.__journal.flush()
+            os.fsync(self.__journal.fileno())
+        except OSError as e:
+            self.logger.error(f"[{self.__class_name}] Failed to write TX journal: {e}")
+            return
+        self.__commits += 1
+        self.__journal_records += len(records)
+        if self.__journal_records >= self.__compact_records:
+            self.__compact()
+
+    def __compact(self):
+        if not self.__write_snapshot():
+            return
+        self.__journal.seek(0)
+        self.__journal.truncate()
+        self.__journal_records = 0
+        self.__compactions += 1
+
+    def __write_snapshot(self):
+        snapshot_dir = os.path.dirname(os.path.abspath(self.__snapshot_path))
+        fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.__state, f, default=_json_default)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.__snapshot_path)
+        except OSError as e:
+            self.logger.error(f"[{self.__class_name}] Failed to compact TX journal: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+    @property
+    def state(self):
+        return self.__state
+
+    @property
+    def stats(self):
+        return {"queued_records": len(self.__queue),
+                "journal_records": self.__journal_records,
+                "commits": self.__commits,
+                "compactions": self.__compactions}
+
+
+if __name__ == '__main__':
+    import time
+
+    journal_dir = tempfile.mkdtemp()
+    journal = CanTxJournal(os.path.join(journal_dir, 'tx.journal'),
+                           os.path.join(journal_dir, 'last_modified_msgs.json'),
+                           compact_records=500)
+    journal.restore({"0x488": {"DAS_steeringAngleRequest": 777}})
+    journal.start()
+    for i in range(1200):
+        journal.append("0x488", {"DAS_steeringAngleRequest": 777 + i * 0.1})
+    time.sleep(0.2)
+    print(f"stats: {journal.stats}")
+    journal.stop()
+
+    restored = CanTxJournal(os.path.join(journal_dir, 'tx.journal'),
+                            os.path.join(journal_dir, 'last_modified_msgs.json'))
+    print(f"restored: {restored.restore({})}")